@@ -0,0 +1,172 @@
+"""
+Runs a PyUSBSpectrometer from asyncio code, without blocking the event loop.
+
+    spectrometer = await AsyncPyUSBSpectrometer.open(fastOpen = True)
+    spectrum = await spectrometer.intensities()
+    headers, spectra = await spectrometer.burst(10000, dtype = None)
+    async with contextlib.aclosing(spectrometer.chunks(1000, numberOfSpectra = 100000)) as chunks:
+        async for headers, spectra in chunks:
+            ...
+    await spectrometer.close()
+
+All USB I/O of one spectrometer runs on one executor thread of its own, so the commands are
+sent one after the other, in the order they were awaited, while other coroutines keep running.
+The waiting for spectra in the onboard buffer happens on that thread too, the event loop only
+wakes up when a result is there.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import numpy as np
+
+from pyUSBSpectrometer import PyUSBSpectrometer
+
+
+class _BurstCall(object):
+    """
+    One burst() of AsyncPyUSBSpectrometer. The stop event of the spectrometer is shared by all
+    bursts, so a cancelled call only sets it while its own burst runs. The burst clears the
+    event when it starts, so the call is also the reduction of its burst and sets the event 
+    again at every chunk once cancelled. A call cancelled before it started does not run.
+    """
+    
+    def __init__(self, spectrometer, reduction):
+        self.spectrometer = spectrometer
+        self.reduction = reduction
+        self.started = False
+        self.finished = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+        
+    def run(self, acquireNumberOfSpectra, **kwargs):
+        with self._lock:
+            if(self.cancelled):
+                return None
+            self.started = True
+        try:
+            return self.spectrometer.burst(acquireNumberOfSpectra, reduction = self, **kwargs)
+        finally:
+            with self._lock:
+                self.finished = True
+        
+    def update(self, headers, spectra):
+        if(self.cancelled):
+            self.spectrometer.stopBurst = True
+        if(self.reduction is not None):
+            self.reduction.update(headers, spectra)
+        
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if(self.started and not self.finished):
+                self.spectrometer.stopBurst = True
+
+
+class AsyncPyUSBSpectrometer(object):
+    """
+    Wraps spectrometer, a PyUSBSpectrometer. The coroutines take the same arguments as the
+    methods of PyUSBSpectrometer with the same name. Other methods run on the executor thread
+    with run(), like await spectrometer.run(spectrometer.spectrometer.triggerMode, 0).
+    executor is a ThreadPoolExecutor with one thread, a new one if None.
+    """
+
+    def __init__(self, spectrometer, executor = None):
+        self.spectrometer = spectrometer
+        if(executor is None):
+            executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix = 'PyUSBSpectrometer I/O')
+        self._executor = executor
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        """
+        Opens a PyUSBSpectrometer with these arguments on the executor thread, which may take
+        seconds without fastOpen.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix = 'PyUSBSpectrometer I/O')
+        try:
+            spectrometer = await asyncio.get_running_loop().run_in_executor(executor, functools.partial(PyUSBSpectrometer, *args, **kwargs))
+        except:
+            executor.shutdown(wait = False)
+            raise
+        return cls(spectrometer, executor = executor)
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) on the executor thread, after the commands awaited before.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    async def intensities(self, *args, **kwargs):
+        return await self.run(self.spectrometer.intensities, *args, **kwargs)
+
+    async def burst(self, acquireNumberOfSpectra, dtype = np.float64, reduction = None, out = None, headersOut = None):
+        """
+        Like PyUSBSpectrometer.burst(). After stop(), only the spectra acquired are returned.
+        Cancelling the task stops this burst, or drops it if it did not start yet. Other 
+        bursts are not affected.
+        """
+        call = _BurstCall(self.spectrometer, reduction)
+        try:
+            return await self.run(call.run, acquireNumberOfSpectra, dtype = dtype, out = out, headersOut = headersOut)
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+
+    async def getNumberInBuffer(self):
+        return await self.run(self.spectrometer.getNumberInBuffer)
+
+    async def getIntegrationTime(self):
+        return await self.run(self.spectrometer.getIntegrationTime)
+
+    async def setIntegrationTime(self, integrationTime):
+        return await self.run(self.spectrometer.setIntegrationTime, integrationTime)
+
+    async def chunks(self, chunkSize = 1000, numberOfSpectra = None, dtype = None, numberOfBuffers = 2):
+        """
+        Yields headers and spectra in blocks of chunkSize spectra, from iterSpectra() on the
+        executor thread. A block is a view on a buffer that is reused after numberOfBuffers
+        blocks, as with iterSpectra(). By default the spectra are in the dtype the spectrometer
+        sends. The onboard buffer is switched off when all blocks were yielded, or when the
+        generator is closed. After a break that only happens when the generator is finalized,
+        at some later time, so commands awaited right after the loop still find buffering on.
+        Loop inside async with contextlib.aclosing(spectrometer.chunks(...)), which closes it
+        when the block is left.
+        """
+        iterator = self.spectrometer.iterSpectra(chunkSize = chunkSize, numberOfSpectra = numberOfSpectra,
+                                                 dtype = dtype, numberOfBuffers = numberOfBuffers)
+        try:
+            while(True):
+                chunk = await self.run(next, iterator, None)
+                if(chunk is None):
+                    break
+                yield chunk
+        finally:
+            # Closing runs the cleanup of iterSpectra on the executor thread as well.
+            await asyncio.shield(self.run(iterator.close))
+
+    def stop(self):
+        """
+        Stops a running burst or chunks() loop. Does not wait for the executor thread, so it
+        can be called from any coroutine.
+        """
+        self.spectrometer.stopBurst = True
+
+    def latest(self, *args, **kwargs):
+        """
+        The newest spectrum of the live view, see PyUSBSpectrometer.latest(). Does not do I/O.
+        """
+        return self.spectrometer.latest(*args, **kwargs)
+
+    async def close(self):
+        """
+        Stops what is running and waits for the executor thread to finish.
+        """
+        self.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.close()
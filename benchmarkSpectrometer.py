@@ -0,0 +1,253 @@
+"""
+Benchmarks of the acquisition path of PyUSBSpectrometer, on the emulated spectrometer.
+
+    python benchmarkSpectrometer.py --output before.json
+    python benchmarkSpectrometer.py --output after.json
+    python benchmarkSpectrometer.py --compare before.json after.json
+
+Micro-benchmarks time the encoding of requests, the framing of replies in _queryPyUSB and the
+decoding of getSpectra replies, for every pixel format and several chunk sizes. End-to-end
+benchmarks run burst() and intensities() on an EmulatedOBPDevice with a given frame rate and
+USB latency. For each benchmark the spectra (or calls) per second, the CPU time per spectrum
+and the peak memory are saved as JSON. --compare lists the differences between two result
+files, and exits with 1 if something got worse by more than --threshold.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+
+from emulatedSpectrometer import EmulatedOBPDevice
+from pyUSBSpectrometer import PyUSBSpectrometer
+
+
+pixelDataFormats = {1 : 'U16', 2 : 'U24', 3 : 'U32', 4 : 'SPFP'}
+
+# Metrics where a higher value is better, the others should be low.
+higherIsBetter = ('spectraPerSecond', 'callsPerSecond')
+
+
+class _ReplayDevice(object):
+    """
+    Replies to every request with the same recorded reply, so _queryPyUSB can be timed without
+    the emulator.
+    """
+
+    def __init__(self, reply):
+        self._transfers = [reply[:64], reply[64:]]
+        self._next = 0
+
+    def write(self, endpoint, data, timeout = None):
+        self._next = 0
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout = None):
+        transfer = self._transfers[self._next]
+        self._next += 1
+        memoryview(size_or_buffer)[:len(transfer)] = transfer
+        return len(transfer)
+
+
+def _openSpectrometer(**emulatorSettings):
+    # Without the self-test and the calibration cache, a benchmark changes nothing outside the working directory.
+    with contextlib.redirect_stdout(io.StringIO()):
+        return PyUSBSpectrometer(device = EmulatedOBPDevice(**emulatorSettings), fastOpen = True, calibrationCache = None)
+
+
+def _recordReply(spectrometer, numberOfSpectra):
+    """
+    Returns a getSpectra reply with numberOfSpectra spectra.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        spectrometer._startBuffering(50000)
+        spectrometer.softwareTrigger()
+        spectrometer.clearBuffer()
+        while(spectrometer.getNumberInBuffer() < numberOfSpectra):
+            time.sleep(1e-3)
+        reply = bytes(spectrometer._query('getSpectra', message = numberOfSpectra))
+        spectrometer._stopBuffering()
+    return reply
+
+
+def _measure(function, numberOfSpectra, repeat, unit = 'spectraPerSecond'):
+    """
+    Runs function repeat times. The rate is from the fastest run, the CPU time per spectrum is
+    averaged over all runs. The peak memory is measured in an extra run with tracemalloc.
+    """
+    wallTimes = []
+    cpuStart = time.process_time()
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        wallTimes.append(time.perf_counter() - start)
+    cpuTime = (time.process_time() - cpuStart) / (repeat * numberOfSpectra)
+
+    tracemalloc.start()
+    function()
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {unit : numberOfSpectra / min(wallTimes),
+            'cpuPerSpectrum' : cpuTime,
+            'peakMemory' : peakMemory}
+
+
+def benchmarkEncoding(repeat):
+    results = {}
+    spectrometer = _openSpectrometer()
+    messageType = spectrometer._commands['getSpectra']
+    numberOfCalls = 10000
+
+    def encodeTemplates():
+        for i in range(numberOfCalls):
+            spectrometer._encodeRequest(messageType, 15)
+
+    def encodeMessages():
+        for i in range(numberOfCalls):
+            PyUSBSpectrometer.makeOBPMessage(b'\x0f\x00\x00\x00', messageType)
+
+    results['encode/template'] = _measure(encodeTemplates, numberOfCalls, repeat, unit = 'callsPerSecond')
+    results['encode/makeOBPMessage'] = _measure(encodeMessages, numberOfCalls, repeat, unit = 'callsPerSecond')
+    return results
+
+
+def benchmarkDecoding(repeat, chunkSizes, numberOfPixels):
+    results = {}
+    for pixelDataFormatCode, name in pixelDataFormats.items():
+        spectrometer = _openSpectrometer(pixelDataFormatCode = pixelDataFormatCode, numberOfPixels = numberOfPixels)
+        for chunkSize in chunkSizes:
+            reply = _recordReply(spectrometer, chunkSize)
+            numberOfReplies = max(1, 2000 // chunkSize)
+
+            def decode():
+                for i in range(numberOfReplies):
+                    spectrometer._processRawSpectalData(reply, asRecords = True)
+
+            def frame():
+                for i in range(numberOfReplies):
+                    spectrometer._query('getSpectra', message = chunkSize, zeroCopy = True)
+
+            results['decode/{}/{}'.format(name, chunkSize)] = _measure(decode, numberOfReplies * chunkSize, repeat)
+            emulator = spectrometer._spectrometer
+            spectrometer._spectrometer = _ReplayDevice(reply)
+            results['frame/{}/{}'.format(name, chunkSize)] = _measure(frame, numberOfReplies * chunkSize, repeat)
+            spectrometer._spectrometer = emulator
+    return results
+
+
+def benchmarkBurst(repeat, numberOfSpectra, integrationTimes, usbLatencies, numberOfPixels, requestsInFlight = (1,)):
+    results = {}
+    for integrationTime in integrationTimes:
+        for usbLatency in usbLatencies:
+            spectrometer = _openSpectrometer(integrationTime = integrationTime, usbLatency = usbLatency, numberOfPixels = numberOfPixels)
+            spectrometer.setIntegrationTime(integrationTime)
+
+            def burst():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    spectrometer.burst(numberOfSpectra, dtype = np.uint16)
+
+            for depth in requestsInFlight:
+                spectrometer.requestsInFlight = depth
+                name = 'burst/{:g}kHz/{:g}us'.format(1e3 / integrationTime, 1e6 * usbLatency)
+                if(depth > 1):
+                    name += '/{}inFlight'.format(depth)
+                results[name] = _measure(burst, numberOfSpectra, repeat)
+    return results
+
+
+def benchmarkIntensities(repeat, usbLatencies, numberOfPixels):
+    results = {}
+    numberOfCalls = 1000
+    for usbLatency in usbLatencies:
+        spectrometer = _openSpectrometer(usbLatency = usbLatency, numberOfPixels = numberOfPixels)
+
+        def intensities():
+            for i in range(numberOfCalls):
+                spectrometer.intensities()
+
+        results['intensities/{:g}us'.format(1e6 * usbLatency)] = _measure(intensities, numberOfCalls, repeat, unit = 'callsPerSecond')
+        spectrometer.startLiveView()
+        results['intensities/liveView/{:g}us'.format(1e6 * usbLatency)] = _measure(intensities, numberOfCalls, repeat, unit = 'callsPerSecond')
+        spectrometer.stopLiveView()
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def runBenchmarks(repeat = 3, numberOfSpectra = 20000, chunkSizes = (1, 15, 100), integrationTimes = (100, 20),
+                  usbLatencies = (0.0, 1e-4), numberOfPixels = 2136, requestsInFlight = (1, 4)):
+    results = {}
+    results.update(benchmarkEncoding(repeat))
+    results.update(benchmarkDecoding(repeat, chunkSizes, numberOfPixels))
+    results.update(benchmarkBurst(repeat, numberOfSpectra, integrationTimes, usbLatencies, numberOfPixels, requestsInFlight))
+    results.update(benchmarkIntensities(repeat, usbLatencies, numberOfPixels))
+    return {'revision' : revision(),
+            'date' : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'machine' : platform.machine(),
+            'results' : results}
+
+
+def compare(oldFileName, newFileName, threshold = 0.1):
+    """
+    Prints the relative change of every metric, and returns the number of changes for the
+    worse larger than threshold.
+    """
+    with open(oldFileName) as f:
+        old = json.load(f)
+    with open(newFileName) as f:
+        new = json.load(f)
+    print('{} ({}) -> {} ({})'.format(oldFileName, old['revision'], newFileName, new['revision']))
+
+    regressions = 0
+    for name in sorted(set(old['results']) & set(new['results'])):
+        for metric, oldValue in old['results'][name].items():
+            newValue = new['results'][name].get(metric)
+            if(newValue is None or oldValue == 0):
+                continue
+            change = newValue / oldValue - 1
+            if(metric in higherIsBetter):
+                worse = change < -threshold
+            else:
+                worse = change > threshold
+            regressions += worse
+            print('{:40s} {:16s} {:12.4g} {:12.4g} {:+7.1%} {}'.format(name, metric, oldValue, newValue, change, 'REGRESSION' if worse else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the acquisition path of PyUSBSpectrometer.')
+    parser.add_argument('--output', default = None, help = 'result file, benchmark_<revision>.json by default')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--spectra', type = int, default = 20000, help = 'number of spectra per burst')
+    parser.add_argument('--chunkSizes', type = int, nargs = '+', default = [1, 15, 100])
+    parser.add_argument('--integrationTimes', type = int, nargs = '+', default = [100, 20], help = 'in us')
+    parser.add_argument('--usbLatencies', type = float, nargs = '+', default = [0.0, 1e-4], help = 'in s')
+    parser.add_argument('--pixels', type = int, default = 2136)
+    parser.add_argument('--requestsInFlight', type = int, nargs = '+', default = [1, 4], help = 'getSpectra requests in flight in a burst')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'))
+    parser.add_argument('--threshold', type = float, default = 0.1)
+    arguments = parser.parse_args()
+
+    if(arguments.compare):
+        raise SystemExit(1 if compare(*arguments.compare, threshold = arguments.threshold) > 0 else 0)
+
+    results = runBenchmarks(repeat = arguments.repeat, numberOfSpectra = arguments.spectra, chunkSizes = arguments.chunkSizes,
+                            integrationTimes = arguments.integrationTimes, usbLatencies = arguments.usbLatencies,
+                            numberOfPixels = arguments.pixels, requestsInFlight = arguments.requestsInFlight)
+    for name, result in results['results'].items():
+        print('{:40s} '.format(name) + ' '.join('{}: {:.4g}'.format(metric, value) for metric, value in result.items()))
+    fileName = arguments.output or 'benchmark_{}.json'.format(results['revision'])
+    with open(fileName, 'w') as f:
+        json.dump(results, f, indent = 1)
+    print('Saved to', fileName)
@@ -0,0 +1,374 @@
+import array
+import struct
+import threading
+import time
+import numpy as np
+
+
+class EmulatedOBPDevice(object):
+    """
+    Emulates an Ocean FX spectrometer at the level of USB transfers, so PyUSBSpectrometer can
+    run without hardware:
+
+        spectrometer = PyUSBSpectrometer(device = EmulatedOBPDevice(integrationTime = 10))
+
+    It has the write() and read() methods of usb.core.Device that _queryPyUSB uses, and answers
+    every command in PyUSBSpectrometer._commands with OBP replies. A reply is read in two transfers,
+    like the real spectrometer sends them: the 44 byte header with the first 20 bytes after it,
+    and the rest.
+
+    Spectra are measured in real time, one every integrationTime + deadTime us. In trigger mode 0
+    the spectrometer measures continuously, and once buffering is switched on, spectra are stored
+    in the onboard buffer after the first getSpectra request. In the other trigger modes, each
+    trigger measures the number of spectra per trigger. In modes 1 and 4 a getSpectra or
+    getSingleSpectrum request is the trigger, in modes 2 and 3 call trigger(), or give a
+    triggerPeriod (in us) for a periodic external trigger. When the buffer is full, new spectra
+    are lost, which shows as a gap in spectrumIndex.
+
+    Pixel i of spectrum k is a fixed spectrum plus k % 256, so spectra can be checked. A reply can
+    be read usbLatency (in s) after its request was written. Requests are answered in order, and
+    the latencies of several requests in flight overlap. usbBandwidth (in bytes/s) limits the
+    transfer rate, if given. Replies echo the regarding field of the request. Use failNext() to
+    make a command reply with an error code. The default serialNumber is not one of a real
+    spectrometer, so the emulator never shares a calibration cache file with one.
+    """
+
+    _commandNames = {b'\x00\x00\x00\x00' : 'reset',
+                     b'\x00\x01\x00\x00' : 'getSerialNumber',
+                     b'\x00\x08\x10\x00' : 'isBuffering',
+                     b'\x10\x08\x10\x00' : 'setBuffering',
+                     b'\x20\x08\x10\x00' : 'getMaximumBufferSize',
+                     b'\x22\x08\x10\x00' : 'getBufferSize',
+                     b'\x30\x08\x10\x00' : 'clearBuffer',
+                     b'\x32\x08\x10\x00' : 'setBufferSize',
+                     b'\x00\x09\x10\x00' : 'getNumberInBuffer',
+                     b'\x80\x09\x10\x00' : 'getSpectra',
+                     b'\x00\x10\x10\x00' : 'getSingleSpectrum',
+                     b'\x00\x00\x11\x00' : 'getIntegrationTime',
+                     b'\x01\x00\x11\x00' : 'getMinimumIntegrationTime',
+                     b'\x02\x00\x11\x00' : 'getMaximumIntegrationTime',
+                     b'\x10\x00\x11\x00' : 'setIntegrationTime',
+                     b'\x00\x01\x11\x00' : 'getTrigger',
+                     b'\x02\x01\x11\x00' : 'getNumberOfSpectraPerTrigger',
+                     b'\x10\x01\x11\x00' : 'setTriggerMode',
+                     b'\x12\x01\x11\x00' : 'setNumberOfSpectraPerTrigger',
+                     b'\x20\x02\x11\x00' : 'getNumberOfPixels'}
+
+    # pixelDataFormatCode: (bytes per pixel, dtype on the wire)
+    _pixelDataFormats = {1 : (2, '<u2'), 2 : (3, 'u1'), 3 : (4, '<u4'), 4 : (4, '<f4')}
+
+    def __init__(self, numberOfPixels = 2136, integrationTime = 10, deadTime = 0, pixelDataFormatCode = 1,
+                 maximumBufferSize = 50000, usbLatency = 0.0, usbBandwidth = None, triggerPeriod = None,
+                 serialNumber = 'EMU00000'):
+        self.numberOfPixels = numberOfPixels
+        self.minimumIntegrationTime = 10
+        self.maximumIntegrationTime = 10000000
+        self.deadTime = deadTime
+        self.pixelDataFormatCode = pixelDataFormatCode
+        self.maximumBufferSize = maximumBufferSize
+        self.usbLatency = usbLatency
+        self.usbBandwidth = usbBandwidth
+        self.triggerPeriod = triggerPeriod
+        self.serial_number = serialNumber
+        self.droppedSpectra = 0
+
+        self._lock = threading.RLock()
+        self._startTime = time.perf_counter()
+        self._errors = {}
+        self._transfers = []
+        self._bufferIndices = np.zeros(maximumBufferSize, dtype = np.uint32)
+        self._bufferTimeStamps = np.zeros(maximumBufferSize, dtype = np.uint64)
+        self._bufferIntegrationTimes = np.zeros(maximumBufferSize, dtype = np.uint32)
+
+        pixels = np.arange(numberOfPixels)
+        self._baseSpectrum = 1000 + 20000 * np.exp(-((pixels - 0.4 * numberOfPixels) / (0.05 * numberOfPixels))**2)
+        self._setDefaults(integrationTime)
+
+
+    def _setDefaults(self, integrationTime):
+        self.integrationTime = integrationTime
+        self.triggerMode = 0
+        self.buffering = False
+        self.bufferSize = self.maximumBufferSize
+        self.spectraPerTrigger = 1
+        self._armed = False
+        self._nextIndex = 0
+        self._bufferStart = 0
+        self._bufferCount = 0
+        # Acquisitions in progress: [start time in us, number of spectra, number done]
+        self._windows = [[self._now(), np.inf, 0]]
+        self._nextTriggerTime = self._now()
+
+
+    def _now(self):
+        return 1e6 * (time.perf_counter() - self._startTime)
+
+    def _period(self):
+        return self.integrationTime + self.deadTime
+
+
+    def wavelengths(self):
+        return np.linspace(350.0, 1000.0, self.numberOfPixels)
+
+    def set_configuration(self):
+        pass
+
+    def failNext(self, command, errorCode):
+        """
+        The next request for command (a name from PyUSBSpectrometer._commands) replies with errorCode.
+        """
+        self._errors[command] = errorCode
+
+
+    def trigger(self):
+        """
+        An external trigger pulse. Starts the measurement of the number of spectra per trigger,
+        unless the previous trigger is still being measured.
+        """
+        with self._lock:
+            self._update()
+            if(self.triggerMode != 0 and len(self._windows) == 0):
+                self._windows.append([self._now(), self.spectraPerTrigger, 0])
+
+
+    def _update(self):
+        """
+        Measures the spectra that are finished by now, and stores them in the buffer.
+        """
+        now = self._now()
+        period = self._period()
+        if(self.triggerPeriod is not None and self.triggerMode in (2, 3)):
+            while(self._nextTriggerTime <= now):
+                if(len(self._windows) == 0 or self._windows[-1][0] + self._windows[-1][1] * period <= self._nextTriggerTime):
+                    self._windows.append([self._nextTriggerTime, self.spectraPerTrigger, 0])
+                self._nextTriggerTime += self.triggerPeriod
+
+        for window in list(self._windows):
+            start, numberOfSpectra, done = window
+            finished = int(min(numberOfSpectra, (now - start) // period))
+            if(finished > done):
+                self._store(start, period, done, finished)
+                window[2] = finished
+            if(window[2] >= numberOfSpectra):
+                self._windows.remove(window)
+            else:
+                break
+
+
+    def _store(self, start, period, done, finished):
+        """
+        Stores spectra done up to finished of an acquisition that started at start.
+        """
+        numberOfSpectra = finished - done
+        indices = self._nextIndex
+        self._nextIndex += numberOfSpectra
+        if(not (self.buffering and (self._armed or self.triggerMode != 0))):
+            return
+
+        free = self.bufferSize - self._bufferCount
+        stored = min(numberOfSpectra, free)
+        self.droppedSpectra += numberOfSpectra - stored
+        slots = (self._bufferStart + self._bufferCount + np.arange(stored)) % self.maximumBufferSize
+        self._bufferIndices[slots] = indices + np.arange(stored)
+        self._bufferTimeStamps[slots] = start + period * np.arange(done + 1, done + 1 + stored)
+        self._bufferIntegrationTimes[slots] = self.integrationTime
+        self._bufferCount += stored
+
+
+    def _setIntegrationTime(self, integrationTime):
+        """
+        Measurements in progress continue with the new integration time after the current spectrum.
+        """
+        oldPeriod = self._period()
+        self.integrationTime = integrationTime
+        for window in self._windows:
+            window[0] += window[2] * (oldPeriod - self._period())
+
+
+    def _pixels(self, indices):
+        """
+        The pixel data of the spectra with these indices, as sent over USB.
+        """
+        spectra = self._baseSpectrum[np.newaxis, :] + (np.asarray(indices) % 256)[:, np.newaxis]
+        bytesPerPixel, wireDtype = self._pixelDataFormats[self.pixelDataFormatCode]
+        if(bytesPerPixel == 3):
+            return spectra.astype('<u4').view('u1').reshape(len(indices), self.numberOfPixels, 4)[:, :, :3]
+        return spectra.astype(wireDtype)
+
+
+    def _frames(self, numberOfSpectra):
+        """
+        Takes numberOfSpectra spectra out of the buffer, each as 64 bytes of metadata, the pixels,
+        and 4 bytes of checksum.
+        """
+        bytesPerPixel, wireDtype = self._pixelDataFormats[self.pixelDataFormatCode]
+        spectrumLengthBytes = bytesPerPixel * self.numberOfPixels
+        if(bytesPerPixel == 3):
+            pixelField = ('u1', (self.numberOfPixels, 3))
+        else:
+            pixelField = (wireDtype, (self.numberOfPixels,))
+        frameDtype = np.dtype({'names'   : ['protocol', 'metaDataLengthBytes', 'spectrumLengthBytes', 'timeStamp', 'integrationTime',
+                                            'pixelDataFormatCode', 'spectrumIndex', 'lastSpectrumIndex', 'timeStampLastSpectrum',
+                                            'numberOfAveraging', 'pixels'],
+                               'formats' : ['<u2', '<u2', '<u4', '<u8', '<u4', '<u4', '<u4', '<u4', '<u8', '<u2', pixelField],
+                               'offsets' : [0, 2, 4, 8, 16, 20, 24, 28, 32, 40, 64],
+                               'itemsize': 64 + spectrumLengthBytes + 4})
+
+        slots = (self._bufferStart + np.arange(numberOfSpectra)) % self.maximumBufferSize
+        self._bufferStart = (self._bufferStart + numberOfSpectra) % self.maximumBufferSize
+        self._bufferCount -= numberOfSpectra
+
+        frames = np.zeros(numberOfSpectra, dtype = frameDtype)
+        frames['protocol'] = 1
+        frames['metaDataLengthBytes'] = 64
+        frames['spectrumLengthBytes'] = spectrumLengthBytes
+        frames['timeStamp'] = self._bufferTimeStamps[slots]
+        frames['integrationTime'] = self._bufferIntegrationTimes[slots]
+        frames['pixelDataFormatCode'] = self.pixelDataFormatCode
+        frames['spectrumIndex'] = self._bufferIndices[slots]
+        frames['lastSpectrumIndex'] = self._nextIndex
+        frames['timeStampLastSpectrum'] = int(self._now())
+        frames['numberOfAveraging'] = 1
+        frames['pixels'] = self._pixels(self._bufferIndices[slots])
+        return frames.tobytes()
+
+
+    @staticmethod
+    def _reply(messageType, regarding = b'\x00' * 4, flags = 1, errorCode = 0, immediateData = b'', payload = b''):
+        return (b'\xC1\xC0' + b'\x00\x00' + struct.pack('<HH', flags, errorCode) + messageType + regarding + b'\x00' * 6 + b'\x00' +
+                struct.pack('<B', len(immediateData)) + immediateData.ljust(16, b'\x00') + struct.pack('<I', 20 + len(payload)) +
+                payload + b'\x00' * 16 + b'\xC5\xC4\xC3\xC2')
+
+
+    def _handle(self, request):
+        """
+        Returns the reply to a request, or None if the spectrometer does not reply.
+        """
+        messageType = request[8:12]
+        regarding = request[12:16]
+        requestAck = bool(request[4] & 4)
+        if(request[0:2] != b'\xC1\xC0'):
+            return self._reply(messageType, regarding, errorCode = 1)
+        if(request[-4:] != b'\xC5\xC4\xC3\xC2'):
+            return self._reply(messageType, regarding, errorCode = 14)
+        if(messageType not in self._commandNames):
+            return self._reply(messageType, regarding, errorCode = 2)
+        command = self._commandNames[messageType]
+        if(request[23] > 0):
+            immediateData = request[24:24 + request[23]]
+        else:
+            immediateData = request[44:-20]
+        value = struct.unpack('<I', immediateData[:4].ljust(4, b'\x00'))[0]
+
+        if(command in self._errors):
+            return self._reply(messageType, regarding, errorCode = self._errors.pop(command))
+
+        self._update()
+        reply = None
+        errorCode = 0
+        payload = b''
+
+        if(command == 'reset'):
+            self._setDefaults(self.integrationTime)
+        elif(command == 'getSerialNumber'):
+            reply = self.serial_number.encode('ascii')[:16]
+        elif(command == 'isBuffering'):
+            reply = struct.pack('<?', self.buffering)
+        elif(command == 'setBuffering'):
+            self.buffering = bool(value)
+            self._armed = False
+        elif(command == 'getMaximumBufferSize'):
+            reply = struct.pack('<I', self.maximumBufferSize)
+        elif(command == 'getBufferSize'):
+            reply = struct.pack('<I', self.bufferSize)
+        elif(command == 'clearBuffer'):
+            self._bufferCount = 0
+        elif(command == 'setBufferSize'):
+            if(value > self.maximumBufferSize):
+                errorCode = 6
+            else:
+                self.bufferSize = value
+                self._bufferCount = min(self._bufferCount, value)
+        elif(command == 'getNumberInBuffer'):
+            reply = struct.pack('<I', self._bufferCount)
+        elif(command == 'getSpectra'):
+            if(self.triggerMode in (1, 4)):
+                self.trigger()
+            self._armed = self.buffering
+            numberOfSpectra = min(value, self._bufferCount)
+            if(numberOfSpectra == 0):
+                errorCode = 13
+            else:
+                payload = self._frames(numberOfSpectra)
+        elif(command == 'getSingleSpectrum'):
+            if(self.triggerMode in (1, 4)):
+                self.trigger()
+            pixels = self._baseSpectrum + max(self._nextIndex - 1, 0) % 256
+            payload = pixels.astype('<u2').tobytes()
+        elif(command == 'getIntegrationTime'):
+            reply = struct.pack('<I', self.integrationTime)
+        elif(command == 'getMinimumIntegrationTime'):
+            reply = struct.pack('<I', self.minimumIntegrationTime)
+        elif(command == 'getMaximumIntegrationTime'):
+            reply = struct.pack('<I', self.maximumIntegrationTime)
+        elif(command == 'setIntegrationTime'):
+            if(value < self.minimumIntegrationTime or value > self.maximumIntegrationTime):
+                errorCode = 6
+            else:
+                self._setIntegrationTime(value)
+        elif(command == 'getTrigger'):
+            reply = struct.pack('<B', self.triggerMode)
+        elif(command == 'getNumberOfSpectraPerTrigger'):
+            reply = struct.pack('<I', self.spectraPerTrigger)
+        elif(command == 'setTriggerMode'):
+            if(value > 4):
+                errorCode = 6
+            else:
+                self.triggerMode = value
+                if(value == 0):
+                    self._windows = [[self._now(), np.inf, 0]]
+                else:
+                    self._windows = []
+                    self._nextTriggerTime = self._now()
+        elif(command == 'setNumberOfSpectraPerTrigger'):
+            self.spectraPerTrigger = value
+        elif(command == 'getNumberOfPixels'):
+            reply = struct.pack('<H', self.numberOfPixels)
+
+        if(reply is None and payload == b'' and errorCode == 0 and not requestAck):
+            return None
+        return self._reply(messageType, regarding, errorCode = errorCode, immediateData = reply or b'', payload = payload)
+
+
+    def write(self, endpoint, data, timeout = None):
+        data = bytes(data)
+        with self._lock:
+            reply = self._handle(data)
+            if(reply is not None):
+                readyTime = time.perf_counter() + self.usbLatency
+                self._transfers.append((readyTime, reply[:64]))
+                if(len(reply) > 64):
+                    self._transfers.append((readyTime, reply[64:]))
+        return len(data)
+
+
+    def read(self, endpoint, size_or_buffer, timeout = None):
+        with self._lock:
+            if(len(self._transfers) == 0):
+                raise IOError('Operation timed out')
+            readyTime, transfer = self._transfers.pop(0)
+
+        waitTime = readyTime - time.perf_counter()
+        if(waitTime > 0):
+            time.sleep(waitTime)
+        if(self.usbBandwidth is not None):
+            time.sleep(len(transfer) / self.usbBandwidth)
+
+        if(isinstance(size_or_buffer, array.array)):
+            if(len(transfer) > len(size_or_buffer)):
+                raise IOError('Overflow')
+            memoryview(size_or_buffer)[:len(transfer)] = transfer
+            return len(transfer)
+        if(len(transfer) > size_or_buffer):
+            raise IOError('Overflow')
+        return array.array('B', transfer)
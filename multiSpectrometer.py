@@ -0,0 +1,332 @@
+"""
+Acquires from several spectrometers at once, each in a process of its own.
+
+    with MultiSpectrometer(integrationTime = 100) as spectrometers:
+        spectrometers.start()
+        while(...):
+            times, devices, headers, spectra = spectrometers.merged()
+        print(spectrometers.statistics())
+
+Every spectrometer is opened by serial number in a worker process, which runs the acquisition
+thread of PyUSBSpectrometer.startAcquisition(). The worker writes into a ring in shared memory
+that this process reads, so decoding runs on as many cores as there are spectrometers, and
+only the spectra cross the process boundary, without pickling.
+
+The time stamps of every spectrometer count us on its own clock. The worker relates them to
+time.perf_counter(), which is the same clock in all processes: after every chunk, the host time
+minus the time stamp of the reply is an upper bound of the clock offset, and the smallest
+bound so far is kept. Aligned times are in s on the perf_counter clock.
+"""
+import os
+import time
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+from pyUSBSpectrometer import PyUSBSpectrometer, _ClockOffset, _SpectrumRing, findSerialNumbers, spectrumHeaderDtype
+
+
+# Status of a worker in shared memory, one float64 each.
+_statusFields = ['state', 'clockOffset', 'startTime', 'updateTime', 'numberOfRequests', 'numberOfStatusQueries']
+_starting, _ready, _running, _stopped, _failed = range(5)
+_stateNames = {_starting : 'starting', _ready : 'ready', _running : 'running', _stopped : 'stopped', _failed : 'failed'}
+
+
+def _openSpectrometer(serialNumber):
+    return PyUSBSpectrometer(serialNumber = serialNumber, fastOpen = True)
+
+
+class _SharedRing(object):
+    """
+    The shared memory of one ring: headers, spectra, the counters of _SpectrumRing and the
+    status of the worker. Made with names None, attached to otherwise.
+    """
+
+    def __init__(self, size, numberOfPixels, dtype, names = None):
+        dtype = np.dtype(dtype)
+        sizes = [size * spectrumHeaderDtype.itemsize, size * numberOfPixels * dtype.itemsize, 3 * 8, len(_statusFields) * 8]
+        if(names is None):
+            self.blocks = [shared_memory.SharedMemory(create = True, size = max(1, blockSize)) for blockSize in sizes]
+        else:
+            self.blocks = [shared_memory.SharedMemory(name = name) for name in names]
+        headers = np.ndarray((size,), dtype = spectrumHeaderDtype, buffer = self.blocks[0].buf)
+        spectra = np.ndarray((size, numberOfPixels), dtype = dtype, buffer = self.blocks[1].buf)
+        counters = np.ndarray((3,), dtype = np.int64, buffer = self.blocks[2].buf)
+        self.status = np.ndarray((len(_statusFields),), dtype = np.float64, buffer = self.blocks[3].buf)
+        if(names is None):
+            counters[:] = 0
+            self.status[:] = 0
+            self.status[_statusFields.index('clockOffset')] = np.inf
+        self.ring = _SpectrumRing(size, numberOfPixels, headers = headers, spectra = spectra, counters = counters)
+
+    @property
+    def names(self):
+        return [block.name for block in self.blocks]
+
+    def setStatus(self, name, value):
+        self.status[_statusFields.index(name)] = value
+
+    def getStatus(self, name):
+        return float(self.status[_statusFields.index(name)])
+
+    def close(self, unlink = False):
+        # The arrays refer to the blocks, which are unmapped by close().
+        self.ring = None
+        self.status = None
+        for block in self.blocks:
+            block.close()
+            if(unlink):
+                block.unlink()
+
+
+class _AligningRing(_SpectrumRing):
+    """
+    The ring of a worker. Every chunk written also updates the clock offset in the status.
+    """
+
+    def __init__(self, sharedRing):
+        ring = sharedRing.ring
+        _SpectrumRing.__init__(self, ring.size, ring.spectra.shape[1], headers = ring.headers, spectra = ring.spectra, counters = ring._counters)
+        self.sharedRing = sharedRing
+        self.clockOffset = _ClockOffset()
+
+    def write(self, headers, spectra):
+        hostTime = time.perf_counter()
+        numberOfSpectra = _SpectrumRing.write(self, headers, spectra)
+        if(self.clockOffset.update(hostTime, headers)):
+            self.sharedRing.setStatus('clockOffset', self.clockOffset.offset)
+        return numberOfSpectra
+
+
+def _acquisitionWorker(serialNumber, openSpectrometer, integrationTime, requestsInFlight, ringSize, connection, startEvent, stopEvent):
+    """
+    Runs in the worker process of one spectrometer. Sends ('ready', number of pixels, dtype,
+    wavelengths), receives the names of the shared memory, waits for startEvent and acquires
+    until stopEvent. Sends ('stopped', flow statistics, integrity report) at the end, or
+    ('failed', message) if something went wrong.
+    """
+    sharedRing = None
+    spectrometer = None
+    try:
+        spectrometer = openSpectrometer(serialNumber)
+        if(integrationTime is not None):
+            spectrometer.setIntegrationTime(integrationTime)
+        spectrometer.requestsInFlight = requestsInFlight
+        # The shared ring is allocated before the first chunk, so the pixel format (U16, U32
+        # or SPFP) has to be known now. Only the metadata of a spectrum tells it.
+        spectrometer.burst(1, dtype = None)
+        connection.send(('ready', spectrometer.getNumberOfPixels(), np.dtype(spectrometer.spectrumDtype()).str, spectrometer.wavelengths()))
+        names = connection.recv()
+        if(names is None):
+            return
+        sharedRing = _SharedRing(ringSize, spectrometer.getNumberOfPixels(), spectrometer.spectrumDtype(), names = names)
+        sharedRing.setStatus('state', _ready)
+
+        startEvent.wait()
+        if(not stopEvent.is_set()):
+            sharedRing.setStatus('startTime', time.perf_counter())
+            spectrometer.startAcquisition(ring = _AligningRing(sharedRing), dtype = None)
+            sharedRing.setStatus('state', _running)
+            while(not stopEvent.wait(0.1) and spectrometer._acquisitionThread.is_alive()):
+                sharedRing.setStatus('updateTime', time.perf_counter())
+            spectrometer.stopAcquisition()
+        flowStatistics = spectrometer.getFlowStatistics()
+        sharedRing.setStatus('updateTime', time.perf_counter())
+        sharedRing.setStatus('numberOfRequests', flowStatistics.get('numberOfRequests', 0))
+        sharedRing.setStatus('numberOfStatusQueries', flowStatistics.get('numberOfStatusQueries', 0))
+        sharedRing.setStatus('state', _stopped)
+        connection.send(('stopped', flowStatistics, spectrometer.getIntegrityReport()))
+    except Exception as e:
+        if(sharedRing is not None):
+            sharedRing.setStatus('state', _failed)
+        connection.send(('failed', '{}: {}'.format(type(e).__name__, e)))
+    finally:
+        if(spectrometer is not None):
+            # The ring of the spectrometer refers to the shared memory as well.
+            spectrometer._ring = None
+        if(sharedRing is not None):
+            sharedRing.close()
+
+
+class MultiSpectrometer(object):
+    """
+    One worker process per spectrometer in serialNumbers, all connected ones if None (see
+    findSerialNumbers). openSpectrometer(serialNumber) opens a spectrometer in the worker, with
+    fastOpen by default; it has to be a function the worker can import. Each worker keeps a
+    ring of ringSize spectra in the dtype the spectrometer sends; spectra that do not fit
+    because read() or merged() was not called in time are dropped and counted.
+
+    The workers open their spectrometers and set integrationTime (in us) when the manager is
+    made, and start acquiring at start(), all at the same time.
+    """
+
+    def __init__(self, serialNumbers = None, integrationTime = None, ringSize = 100000, openSpectrometer = _openSpectrometer,
+                 requestsInFlight = 1, timeout = 60.0):
+        if(serialNumbers is None):
+            serialNumbers = findSerialNumbers()
+        self.serialNumbers = list(serialNumbers)
+        self.ringSize = ringSize
+        self.wavelengths = {}
+        self.flowStatistics = {}
+        self.integrityReports = {}
+        self.errors = {}
+        self._startEvent = multiprocessing.Event()
+        self._stopEvent = multiprocessing.Event()
+        self._processes = []
+        self._connections = []
+        self._rings = []
+        self._startTime = None
+
+        if(os.name == 'posix'):
+            # Started before the workers, so they share it. A tracker of their own would unlink 
+            # the rings when a worker ends.
+            resource_tracker.ensure_running()
+        try:
+            for serialNumber in self.serialNumbers:
+                connection, workerConnection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target = _acquisitionWorker, name = 'Spectrometer ' + serialNumber,
+                                                  args = (serialNumber, openSpectrometer, integrationTime, requestsInFlight,
+                                                          ringSize, workerConnection, self._startEvent, self._stopEvent),
+                                                  daemon = True)
+                process.start()
+                self._processes.append(process)
+                self._connections.append(connection)
+            for serialNumber, connection in zip(self.serialNumbers, self._connections):
+                if(not connection.poll(timeout)):
+                    raise RuntimeError('Spectrometer {} did not open within {} s.'.format(serialNumber, timeout))
+                message = connection.recv()
+                if(message[0] != 'ready'):
+                    raise RuntimeError('Spectrometer {} could not be opened. {}'.format(serialNumber, message[1]))
+                state, numberOfPixels, dtype, wavelengths = message
+                self.wavelengths[serialNumber] = wavelengths
+                self._rings.append(_SharedRing(ringSize, numberOfPixels, dtype))
+            for connection, sharedRing in zip(self._connections, self._rings):
+                connection.send(sharedRing.names)
+        except:
+            self.close()
+            raise
+
+    def start(self):
+        """
+        Starts the acquisition of all spectrometers.
+        """
+        self._startTime = time.perf_counter()
+        self._startEvent.set()
+
+    def read(self, maxNumberOfSpectra = None):
+        """
+        Returns {serial number: (aligned times, headers, spectra)} with what every spectrometer
+        acquired since the last call, at most maxNumberOfSpectra each. Aligned times are nan as
+        long as the clock offset of a spectrometer is not known.
+        """
+        result = {}
+        for serialNumber, sharedRing in zip(self.serialNumbers, self._rings):
+            headers, spectra = sharedRing.ring.read(maxNumberOfSpectra)
+            result[serialNumber] = (self.alignedTimes(serialNumber, headers), headers, spectra)
+        return result
+
+    def alignedTimes(self, serialNumber, headers):
+        """
+        The time stamps of headers from spectrometer serialNumber in s on the perf_counter clock.
+        """
+        clockOffset = self._rings[self.serialNumbers.index(serialNumber)].getStatus('clockOffset')
+        if(not np.isfinite(clockOffset)):
+            return np.full(len(headers), np.nan)
+        return 1e-6 * headers['timeStamp'].astype(np.float64) + clockOffset
+
+    def merged(self, maxNumberOfSpectra = None):
+        """
+        Like read(), but all spectra in one stream, sorted by aligned time. Returns the aligned
+        times, the index in serialNumbers of the spectrometer of every spectrum, the headers and
+        the spectra: a 2D array if all spectrometers have the same number of pixels, a list if not.
+        """
+        chunks = self.read(maxNumberOfSpectra)
+        times = np.concatenate([chunks[serialNumber][0] for serialNumber in self.serialNumbers])
+        devices = np.concatenate([np.full(len(chunks[serialNumber][1]), i, dtype = np.int32) for i, serialNumber in enumerate(self.serialNumbers)])
+        headers = np.concatenate([chunks[serialNumber][1] for serialNumber in self.serialNumbers])
+        order = np.argsort(times, kind = 'stable')
+        spectra = [chunks[serialNumber][2] for serialNumber in self.serialNumbers]
+        if(len(set(chunk.shape[1] for chunk in spectra)) <= 1):
+            spectra = np.concatenate(spectra)[order]
+        else:
+            spectra = [spectrum for chunk in spectra for spectrum in chunk]
+            spectra = [spectra[i] for i in order]
+        return times[order], devices[order], headers[order], spectra
+
+    def statistics(self):
+        """
+        Per serial number: the state of the worker, the number of spectra acquired, dropped
+        because the ring was full, and waiting in the ring, the acquisition rate since start(),
+        the number of getSpectra requests and buffer queries (known after stop()) and the
+        clock offset in s.
+        """
+        statistics = {}
+        for serialNumber, sharedRing in zip(self.serialNumbers, self._rings):
+            ring = sharedRing.ring
+            startTime = sharedRing.getStatus('startTime')
+            duration = sharedRing.getStatus('updateTime') - startTime
+            acquiredSpectra = ring.writeIndex + ring.droppedSpectra
+            statistics[serialNumber] = {'state' : _stateNames[int(sharedRing.getStatus('state'))],
+                                        'acquiredSpectra' : acquiredSpectra,
+                                        'droppedSpectra' : ring.droppedSpectra,
+                                        'numberInRing' : ring.numberAvailable(),
+                                        'spectraPerSecond' : acquiredSpectra / duration if(startTime > 0 and duration > 0) else 0.0,
+                                        'numberOfRequests' : int(sharedRing.getStatus('numberOfRequests')),
+                                        'numberOfStatusQueries' : int(sharedRing.getStatus('numberOfStatusQueries')),
+                                        'clockOffset' : sharedRing.getStatus('clockOffset')}
+            if(serialNumber in self.errors):
+                statistics[serialNumber]['error'] = self.errors[serialNumber]
+        return statistics
+
+    def stop(self, timeout = 10.0):
+        """
+        Stops all acquisitions and waits for the workers. The spectra still in the rings can be
+        read afterwards, until close(). The flow statistics and integrity reports of the workers
+        are then in flowStatistics and integrityReports.
+        """
+        self._stopEvent.set()
+        self._startEvent.set()
+        for serialNumber, connection in zip(self.serialNumbers, self._connections):
+            if(connection.closed or not connection.poll(timeout)):
+                continue
+            try:
+                message = connection.recv()
+            except EOFError:
+                continue
+            if(message[0] == 'stopped'):
+                self.flowStatistics[serialNumber] = message[1]
+                self.integrityReports[serialNumber] = message[2]
+            else:
+                self.errors[serialNumber] = message[1]
+                print('Spectrometer {} failed: {}'.format(serialNumber, message[1]))
+        for process in self._processes:
+            process.join(timeout)
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory.
+        """
+        if(len(self._rings) < len(self._connections)):
+            # Workers that are waiting for the shared memory are told not to wait.
+            for connection in self._connections[len(self._rings):]:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+        self.stop()
+        for process in self._processes:
+            if(process.is_alive()):
+                process.terminate()
+        for sharedRing in self._rings:
+            sharedRing.close(unlink = True)
+        for connection in self._connections:
+            connection.close()
+        self._rings = []
+        self._processes = []
+        self._connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
@@ -0,0 +1,253 @@
+"""
+Decodes many spectra on several cores.
+
+    with ParallelDecoder(numberOfWorkers = 8) as decoder:
+        with decoder.decodeStream(byteString) as decoded:
+            decoded.spectra.mean(axis = 0)
+
+The frames are found with the spectrumLengthBytes of their metadata, and split into ranges
+that are decoded by a pool of processes. Every worker writes its range straight into one
+headers array and one spectra array in shared memory, so nothing is pickled but the task
+description. The result is identical to PyUSBSpectrometer.decodeRawSpectra, byte for byte.
+"""
+import os
+import struct
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+
+from pyUSBSpectrometer import PyUSBSpectrometer, _frameDtype, _pixelDataFormats, spectrumHeaderDtype
+
+
+def _replyLayout(byteString):
+    """
+    Like PyUSBSpectrometer._frameLayout, for complete getSpectra replies in a row. Every reply
+    is 44 header bytes and bytesRemaining more, of which the last 20 are the checksum and footer.
+    The offsets are in byteString.
+    """
+    metaData = []
+    offsets = []
+    lengths = []
+    offset = 0
+    while(len(byteString) - offset >= 44):
+        bytesRemaining = struct.unpack_from('<I', byteString, offset + 40)[0]
+        # The frames, without the 4 bytes after the last one, as in _processRawSpectalData.
+        frames = memoryview(byteString)[offset + 44:offset + 44 + max(bytesRemaining - 24, 0)]
+        replyMetaData, replyOffsets, replyLengths = PyUSBSpectrometer._frameLayout(frames)
+        metaData.append(replyMetaData)
+        offsets.append(replyOffsets + (offset + 44))
+        lengths.append(replyLengths)
+        offset += 44 + bytesRemaining
+    if(len(metaData) == 0):
+        return PyUSBSpectrometer._frameLayout(b'')
+    return np.concatenate(metaData), np.concatenate(offsets), np.concatenate(lengths)
+
+
+def _decodeInto(source, offsets, headers, spectra, frameLength, pixelDataFormatCode, start, stop):
+    """
+    Decodes the frames at offsets[start:stop] in source, a uint8 array, into headers[start:stop]
+    and spectra[start:stop], the same way as decodeRawSpectra.
+    """
+    frameDtype = _frameDtype(pixelDataFormatCode, frameLength - 64)
+    offsets = offsets[start:stop]
+    headers = headers[start:stop]
+    spectra = spectra[start:stop]
+    if(len(offsets) == 0):
+        return
+    # The frames of one reply are the smallest step apart. Each run of them is decoded from a
+    # strided view, without copying; a larger step is the header of the next reply.
+    steps = np.diff(offsets)
+    stride = int(steps.min()) if len(steps) else frameLength
+    if(stride < frameLength):
+        frames = source[offsets.astype(np.int64)[:, None] + np.arange(frameLength)].view(frameDtype)[:, 0]
+        _decodeFrames(frames, headers, spectra, pixelDataFormatCode)
+        return
+    runStarts = np.concatenate(([0], np.flatnonzero(steps != stride) + 1, [len(offsets)])).tolist()
+    for runStart, runStop in zip(runStarts[:-1], runStarts[1:]):
+        frames = np.ndarray((runStop - runStart,), dtype = frameDtype, buffer = source,
+                            offset = int(offsets[runStart]), strides = (stride,))
+        _decodeFrames(frames, headers[runStart:runStop], spectra[runStart:runStop], pixelDataFormatCode)
+
+
+def _decodeFrames(frames, headers, spectra, pixelDataFormatCode):
+    PyUSBSpectrometer._headerRecordsFromMetaData(frames['metaData'], headers = headers)
+    if(_pixelDataFormats[pixelDataFormatCode][1] == 3):
+        spectra[:] = PyUSBSpectrometer._convertPixels(frames['pixels'], pixelDataFormatCode)
+    else:
+        np.copyto(spectra, frames['pixels'], casting = 'unsafe')
+
+
+def _decodeSharedRange(task):
+    """
+    Runs in a worker process. Attaches to the shared memory (or maps the capture file) named in
+    task and decodes one range.
+    """
+    (sourceName, sourceIsFile, offsetsName, headersName, spectraName, numberOfSpectra, numberOfPixels,
+     spectraDtype, frameLength, pixelDataFormatCode, start, stop) = task
+    blocks = []
+    if(sourceIsFile):
+        source = np.memmap(sourceName, dtype = np.uint8, mode = 'r')
+    else:
+        blocks.append(shared_memory.SharedMemory(name = sourceName))
+        source = np.ndarray((blocks[-1].size,), dtype = np.uint8, buffer = blocks[-1].buf)
+    blocks.append(shared_memory.SharedMemory(name = offsetsName))
+    offsets = np.ndarray((numberOfSpectra,), dtype = np.int64, buffer = blocks[-1].buf)
+    blocks.append(shared_memory.SharedMemory(name = headersName))
+    headers = np.ndarray((numberOfSpectra,), dtype = spectrumHeaderDtype, buffer = blocks[-1].buf)
+    blocks.append(shared_memory.SharedMemory(name = spectraName))
+    spectra = np.ndarray((numberOfSpectra, numberOfPixels), dtype = spectraDtype, buffer = blocks[-1].buf)
+
+    _decodeInto(source, offsets, headers, spectra, frameLength, pixelDataFormatCode, start, stop)
+    # The arrays refer to the blocks, which are unmapped by close().
+    del source, offsets, headers, spectra
+    for block in blocks:
+        block.close()
+    return stop - start
+
+
+class SharedSpectra(object):
+    """
+    The headers and spectra decoded by a ParallelDecoder. They are in shared memory, which is
+    freed by close(), or at the end of a with block. The arrays cannot be used after that, so
+    copy what is still needed, or use toArrays(). Other processes can attach to the arrays
+    with headersName and spectraName.
+    """
+
+    def __init__(self, headers, spectra, blocks = ()):
+        self.headers = headers
+        self.spectra = spectra
+        self._blocks = list(blocks)
+
+    @property
+    def headersName(self):
+        return self._blocks[0].name if self._blocks else None
+
+    @property
+    def spectraName(self):
+        return self._blocks[1].name if self._blocks else None
+
+    def toArrays(self):
+        """
+        Returns copies of the headers and spectra, in ordinary memory.
+        """
+        if(isinstance(self.spectra, list)):
+            return self.headers.copy(), [spectrum.copy() for spectrum in self.spectra]
+        return self.headers.copy(), self.spectra.copy()
+
+    def close(self):
+        self.headers = None
+        self.spectra = None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class ParallelDecoder(object):
+    """
+    A pool of numberOfWorkers processes (all cores if None) that decode chunkSize spectra per
+    task. With useThreads the workers are threads in this process, which needs no shared memory.
+    Only spectra of one length and pixel format are decoded in parallel, others one by one.
+    """
+
+    def __init__(self, numberOfWorkers = None, useThreads = False, chunkSize = 5000):
+        self.numberOfWorkers = numberOfWorkers or os.cpu_count()
+        self.useThreads = useThreads
+        self.chunkSize = chunkSize
+        if(useThreads):
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.numberOfWorkers)
+        else:
+            self._pool = concurrent.futures.ProcessPoolExecutor(self.numberOfWorkers)
+
+    def close(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def decodeStream(self, byteString):
+        """
+        Decodes getSpectra replies. byteString is one or more complete replies in a row, as
+        read from the spectrometer (or from a capture file), each starting with its OBP 
+        header. Without a header, byteString is the frames of one reply, like 
+        decodeRawSpectra takes them. Returns a SharedSpectra.
+        """
+        if(bytes(byteString[:2]) == b'\xC1\xC0'):
+            metaData, offsets, lengths = _replyLayout(byteString)
+        else:
+            metaData, offsets, lengths = PyUSBSpectrometer._frameLayout(byteString)
+        if(len(offsets) == 0 or np.any(lengths != lengths[0]) or
+                np.any(metaData['pixelDataFormatCode'] != metaData['pixelDataFormatCode'][0])):
+            source = memoryview(byteString)
+            spectra = [PyUSBSpectrometer._parseRawSpectrum(source[offset:offset + length])[1] 
+                       for offset, length in zip(offsets.tolist(), lengths.tolist())]
+            return SharedSpectra(PyUSBSpectrometer._headerRecordsFromMetaData(metaData), spectra)
+        return self.decodeFrames(byteString, offsets, int(lengths[0]), int(metaData['pixelDataFormatCode'][0]))
+
+    def decodeFrames(self, source, offsets, frameLength, pixelDataFormatCode):
+        """
+        Decodes the frames of frameLength bytes (metadata and pixels) that start at offsets in
+        source. source is a bytes-like object, or the name of a file, like a raw capture, which
+        the workers map themselves. Returns a SharedSpectra.
+        """
+        offsets = np.asarray(offsets, dtype = np.int64)
+        numberOfSpectra = len(offsets)
+        spectraDtype = np.dtype(_pixelDataFormats[pixelDataFormatCode][3])
+        numberOfPixels = (frameLength - 64) // _pixelDataFormats[pixelDataFormatCode][1]
+        ranges = [(start, min(start + self.chunkSize, numberOfSpectra)) for start in range(0, numberOfSpectra, self.chunkSize)]
+        sourceIsFile = isinstance(source, (str, os.PathLike))
+
+        if(self.useThreads):
+            if(sourceIsFile):
+                source = np.memmap(source, dtype = np.uint8, mode = 'r')
+            else:
+                source = np.frombuffer(source, dtype = np.uint8)
+            headers = np.empty(numberOfSpectra, dtype = spectrumHeaderDtype)
+            spectra = np.empty((numberOfSpectra, numberOfPixels), dtype = spectraDtype)
+            futures = [self._pool.submit(_decodeInto, source, offsets, headers, spectra, frameLength, pixelDataFormatCode, start, stop)
+                       for start, stop in ranges]
+            for future in futures:
+                future.result()
+            return SharedSpectra(headers, spectra)
+
+        headersBlock = shared_memory.SharedMemory(create = True, size = max(1, numberOfSpectra * spectrumHeaderDtype.itemsize))
+        spectraBlock = shared_memory.SharedMemory(create = True, size = max(1, numberOfSpectra * numberOfPixels * spectraDtype.itemsize))
+        offsetsBlock = shared_memory.SharedMemory(create = True, size = max(1, offsets.nbytes))
+        np.ndarray(offsets.shape, dtype = np.int64, buffer = offsetsBlock.buf)[:] = offsets
+        sourceBlock = None
+        try:
+            if(sourceIsFile):
+                sourceName = os.fspath(source)
+            else:
+                # The one copy of the input, into memory the workers can see.
+                sourceBytes = np.frombuffer(source, dtype = np.uint8)
+                sourceBlock = shared_memory.SharedMemory(create = True, size = max(1, len(sourceBytes)))
+                np.ndarray(sourceBytes.shape, dtype = np.uint8, buffer = sourceBlock.buf)[:] = sourceBytes
+                sourceName = sourceBlock.name
+            tasks = [(sourceName, sourceIsFile, offsetsBlock.name, headersBlock.name, spectraBlock.name, numberOfSpectra,
+                      numberOfPixels, spectraDtype, frameLength, pixelDataFormatCode, start, stop) for start, stop in ranges]
+            list(self._pool.map(_decodeSharedRange, tasks))
+        except:
+            headersBlock.close()
+            headersBlock.unlink()
+            spectraBlock.close()
+            spectraBlock.unlink()
+            raise
+        finally:
+            for block in (offsetsBlock, sourceBlock):
+                if(block is not None):
+                    block.close()
+                    block.unlink()
+
+        headers = np.ndarray((numberOfSpectra,), dtype = spectrumHeaderDtype, buffer = headersBlock.buf)
+        spectra = np.ndarray((numberOfSpectra, numberOfPixels), dtype = spectraDtype, buffer = spectraBlock.buf)
+        return SharedSpectra(headers, spectra, blocks = (headersBlock, spectraBlock))
@@ -1,21 +1,919 @@
 import sys
 import os
-import copy
+import collections
+import functools
+import json
+import queue
 import numpy as np
 import struct
+import array
 import time
+import threading
 import usb.core
 import usb.util
 import usb.backend
 import usb.backend.libusb1
-import winsound
 
-from spectrometer import *
+try:
+    from spectrometer import *
+except ImportError:
+    # The common base of the lab's spectrometer classes is not needed to run on the emulator.
+    class Spectrometer(object):
+        pass
+from spectrumCorrection import CorrectionPipeline
+
+
+# Layout of the 64 byte metadata block in front of every spectrum in a getSpectra reply.
+_metaDataDtype = np.dtype({'names'   : ['protocol', 'metaDataLengthBytes', 'spectrumLengthBytes', 'timeStamp', 'integrationTime', 
+                                        'pixelDataFormatCode', 'spectrumIndex', 'lastSpectrumIndex', 'timeStampLastSpectrum', 'numberOfAveraging'],
+                           'formats' : ['<u2', '<u2', '<u4', '<u8', '<u4', '<u4', '<u4', '<u4', '<u8', '<u2'],
+                           'offsets' : [0, 2, 4, 8, 16, 20, 24, 28, 32, 40],
+                           'itemsize': 64})
+
+# pixelDataFormatCode: (name, bytes per datapoint, dtype on the wire, dtype of the decoded spectrum)
+_pixelDataFormats = {1 : ('U16', 2, '<u2', np.uint16),
+                     2 : ('U24', 3, 'u1', np.uint32), #no uint24, assembled from the three bytes.
+                     3 : ('U32', 4, '<u4', np.uint32),
+                     4 : ('SPFP', 4, '<f4', np.float32)}
+_bytesPerDatapoint = np.array([0] + [_pixelDataFormats[code][1] for code in sorted(_pixelDataFormats)], dtype = np.uint8)
+
+# Headers of a burst. One record per spectrum, the same fields as the header dictionaries,
+# apart from pixelDataFormat, which follows from pixelDataFormatCode.
+spectrumHeaderDtype = np.dtype([('protocol', np.uint16),
+                                ('metaDataLengthBytes', np.uint16),
+                                ('spectrumLength', np.uint32),
+                                ('timeStamp', np.uint64),
+                                ('integrationTime', np.uint32),
+                                ('pixelDataFormatCode', np.uint8),
+                                ('bytePerDatapoint', np.uint8),
+                                ('spectrumIndex', np.uint32),
+                                ('lastSpectrumIndex', np.uint32),
+                                ('timeStampLastSpectrum', np.uint64),
+                                ('numberOfAveraging', np.uint16),
+                                ('spectrumLengthBytes', np.uint32)])
+
+
+# Wavelength calibrations and fixed properties are cached here per serial number, see fastOpen.
+defaultCalibrationCache = os.path.join(os.path.expanduser('~'), '.pyUSBSpectrometer')
+
+# Cached property name: command that asks for it. These do not change for a spectrometer.
+_staticProperties = {'numberOfPixels'          : 'getNumberOfPixels',
+                     'minimumIntegrationTime'  : 'getMinimumIntegrationTime',
+                     'maximumIntegrationTime'  : 'getMaximumIntegrationTime',
+                     'maximumBufferSize'       : 'getMaximumBufferSize'}
+
+_maximumOpenAttempts = 15
+
+
+def _deviceSerialNumber(device):
+    try:
+        return device.serial_number
+    except (ValueError, usb.core.USBError):
+        # No permission to read the string descriptor, or it is not there.
+        return None
+
+
+def findSerialNumbers(idVendor = 0x2457, idProduct = 0x2001):
+    """
+    Returns the serial numbers of all connected spectrometers with these ids, to open one of
+    them with PyUSBSpectrometer(serialNumber = ...).
+    """
+    serialNumbers = []
+    for device in usb.core.find(find_all = True, idVendor = idVendor, idProduct = idProduct):
+        serialNumber = _deviceSerialNumber(device)
+        if(serialNumber is not None):
+            serialNumbers.append(serialNumber)
+        usb.util.dispose_resources(device)
+    return serialNumbers
+
+
+def _backoff(attempt, firstDelay = 0.05, maximumDelay = 1.0):
+    """
+    Seconds to wait before retry attempt + 1: doubles every attempt, up to maximumDelay.
+    """
+    return min(maximumDelay, firstDelay * 2**attempt)
+
+
+def _truncateNpyFile(fileName, numberOfRows):
+    """
+    Shortens the first dimension of a .npy file to numberOfRows in place. The header keeps
+    its length, so the data does not move and the file is only cut after the last row.
+    """
+    with open(fileName, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if(version == (1, 0)):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+            headerStart = 10
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+            headerStart = 12
+        dataStart = f.tell()
+        
+        header = repr({'descr' : np.lib.format.dtype_to_descr(dtype), 
+                       'fortran_order' : fortranOrder, 
+                       'shape' : (int(numberOfRows),) + tuple(shape[1:])})
+        f.seek(headerStart)
+        f.write(header.encode('latin1').ljust(dataStart - headerStart - 1) + b'\n')
+        f.truncate(dataStart + numberOfRows * dtype.itemsize * int(np.prod(shape[1:])))
+        
+
+class _FlowController(object):
+    """
+    Chooses how many spectra each getSpectra request of an acquisition asks for, so that
+    getNumberInBuffer does not have to be asked before every request.
+    
+    After a request, the number of spectra left in the onboard buffer follows from the last
+    header: lastSpectrumIndex is the spectrum that was being measured when the reply was made.
+    From then on a spectrum is added every period, which is measured from the time stamps. 
+    getNumberInBuffer is only asked when there is no estimate: at the start, or after a reply
+    with fewer spectra than asked for.
+    
+    Asking for fewer spectra than are measured during one request cannot keep up, so with 
+    the measured request latency the controller waits until at least that many are in the buffer.
+    """
+    
+    def __init__(self, integrationTime, maximumChunkSize = 100, bufferSize = 50000):
+        self.period = 1e-6 * integrationTime # s
+        self.maximumChunkSize = maximumChunkSize
+        self.bufferSize = bufferSize
+        self.requestLatency = 0.0 # s, moving average
+        self.numberOfRequests = 0
+        self.numberOfStatusQueries = 0
+        self.acquiredSpectra = 0
+        self.chunkSizes = {} # chunk size: number of requests
+        self.maximumNumberInBuffer = 0
+        self.startTime = time.perf_counter()
+        self._numberInBuffer = None
+        self._estimateTime = 0.0
+        
+    def setNumberInBuffer(self, numberInBuffer):
+        self.numberOfStatusQueries += 1
+        self.maximumNumberInBuffer = max(self.maximumNumberInBuffer, numberInBuffer)
+        self._numberInBuffer = numberInBuffer
+        self._estimateTime = time.perf_counter()
+        
+    def estimatedNumberInBuffer(self):
+        if(self._numberInBuffer is None):
+            return None
+        return self._numberInBuffer + (time.perf_counter() - self._estimateTime) / self.period
+        
+    def minimumChunkSize(self):
+        return min(self.maximumChunkSize, max(1, int(np.ceil(self.requestLatency / self.period))))
+        
+    def nextChunkSize(self, remaining, inFlight = 0):
+        """
+        Returns the number of spectra to ask for, 0 if it is better to wait waitTime() first,
+        or None if the number in the buffer has to be asked first. inFlight spectra are asked 
+        for already, but not received yet.
+        """
+        estimate = self.estimatedNumberInBuffer()
+        if(estimate is None):
+            return None
+        estimate -= inFlight
+        if(estimate < min(self.minimumChunkSize(), remaining)):
+            return 0
+        return int(min(estimate, self.maximumChunkSize, remaining))
+        
+    def waitTime(self, remaining):
+        estimate = self.estimatedNumberInBuffer()
+        if(estimate is None):
+            return self.period
+        return max(min(self.minimumChunkSize(), remaining) - estimate, 0) * self.period
+        
+    def update(self, requested, headers, latency):
+        """
+        Updates the estimate with the headers of a reply that took latency seconds.
+        """
+        numberOfSpectra = len(headers)
+        self.numberOfRequests += 1
+        self.acquiredSpectra += numberOfSpectra
+        self.chunkSizes[numberOfSpectra] = self.chunkSizes.get(numberOfSpectra, 0) + 1
+        if(self.numberOfRequests == 1):
+            self.requestLatency = latency
+        else:
+            self.requestLatency = 0.8 * self.requestLatency + 0.2 * latency
+            
+        if(numberOfSpectra < requested or numberOfSpectra == 0):
+            self._numberInBuffer = None
+            return
+        if(numberOfSpectra > 1):
+            period = 1e-6 * (int(headers['timeStamp'][-1]) - int(headers['timeStamp'][0])) / (numberOfSpectra - 1)
+            if(period > 0):
+                self.period = period
+        numberInBuffer = int(headers['lastSpectrumIndex'][-1]) - int(headers['spectrumIndex'][-1]) - 1
+        if(numberInBuffer < 0 or numberInBuffer > self.bufferSize):
+            self._numberInBuffer = None
+        else:
+            self.maximumNumberInBuffer = max(self.maximumNumberInBuffer, numberInBuffer)
+            self._numberInBuffer = numberInBuffer
+            self._estimateTime = time.perf_counter()
+            
+    def statistics(self):
+        totalTime = time.perf_counter() - self.startTime
+        return {'numberOfRequests' : self.numberOfRequests,
+                'numberOfStatusQueries' : self.numberOfStatusQueries,
+                'maximumNumberInBuffer' : self.maximumNumberInBuffer,
+                'chunkSizes' : dict(sorted(self.chunkSizes.items())),
+                'meanChunkSize' : self.acquiredSpectra / max(self.numberOfRequests, 1),
+                'requestLatency' : self.requestLatency,
+                'spectraPerSecond' : self.acquiredSpectra / totalTime if totalTime > 0 else 0.0}
+        
+
+class IntegrityMonitor(object):
+    """
+    Checks the headers of every chunk while spectra are acquired, instead of all time stamps
+    after a burst. It finds gaps in spectrumIndex (spectra lost to a buffer overflow), time stamp
+    differences that deviate more than tolerance us from the expected period, and changes of the
+    integration time. The expected period is the median difference of the first chunk, and is
+    measured again after the integration time changed. The statistics of the differences are
+    running sums, so memory does not grow with the run, apart from the first maximumEvents events.
+    
+    Every problem is an event dictionary with type 'gap', 'timing' or 'integrationTime', the
+    position of the spectrum in the acquisition and its spectrumIndex, passed to callback(event)
+    as soon as the chunk is checked.
+    """
+    
+    def __init__(self, integrationTime = None, tolerance = 2, callback = None, maximumEvents = 1000):
+        self.integrationTime = integrationTime # us
+        self.tolerance = tolerance # us
+        self.callback = callback
+        self.maximumEvents = maximumEvents
+        self.numberOfSpectra = 0
+        self.numberOfGaps = 0
+        self.missingSpectra = 0
+        self.numberOfTimingErrors = 0
+        self.integrationTimeChanges = 0
+        self.expectedPeriod = None # us
+        self.events = []
+        # Time stamp differences between consecutive spectra, in us.
+        self.numberOfDeltas = 0
+        self.meanDelta = 0.0
+        self._m2Delta = 0.0
+        self.minimumDelta = None
+        self.maximumDelta = None
+        self._last = None # spectrumIndex, timeStamp and integrationTime of the last spectrum
+        
+    def _event(self, event):
+        if(len(self.events) < self.maximumEvents):
+            self.events.append(event)
+        if(self.callback is not None):
+            self.callback(event)
+            
+    def update(self, headers):
+        numberOfSpectra = len(headers)
+        if(numberOfSpectra == 0):
+            return
+        indices = headers['spectrumIndex'].astype(np.int64)
+        timeStamps = headers['timeStamp'].astype(np.int64)
+        integrationTimes = headers['integrationTime'].astype(np.int64)
+        # Position in the acquisition of the second spectrum of every difference.
+        firstPosition = self.numberOfSpectra + 1
+        if(self._last is not None):
+            indices = np.concatenate(([self._last[0]], indices))
+            timeStamps = np.concatenate(([self._last[1]], timeStamps))
+            integrationTimes = np.concatenate(([self._last[2]], integrationTimes))
+            firstPosition -= 1
+        self._last = (indices[-1], timeStamps[-1], integrationTimes[-1])
+        self.numberOfSpectra += numberOfSpectra
+        self.integrationTime = int(integrationTimes[-1])
+        
+        # spectrumIndex is a U32, it wraps around after 2**32 spectra.
+        indexSteps = np.diff(indices) & 0xFFFFFFFF
+        integrationTimeChanged = np.diff(integrationTimes) != 0
+        
+        for i in np.flatnonzero(indexSteps != 1):
+            self.numberOfGaps += 1
+            self.missingSpectra += max(int(indexSteps[i]) - 1, 0)
+            self._event({'type' : 'gap', 'position' : firstPosition + int(i), 'spectrumIndex' : int(indices[i + 1]),
+                         'missing' : int(indexSteps[i]) - 1})
+            
+        for i in np.flatnonzero(integrationTimeChanged):
+            self.integrationTimeChanges += 1
+            self.expectedPeriod = None
+            self._event({'type' : 'integrationTime', 'position' : firstPosition + int(i), 'spectrumIndex' : int(indices[i + 1]),
+                         'previous' : int(integrationTimes[i]), 'integrationTime' : int(integrationTimes[i + 1])})
+            
+        # Only differences between consecutive spectra with the same integration time say something about the timing.
+        valid = np.flatnonzero((indexSteps == 1) & ~integrationTimeChanged)
+        if(len(valid) == 0):
+            return
+        deltas = np.diff(timeStamps)[valid]
+        if(self.expectedPeriod is None):
+            self.expectedPeriod = float(np.median(deltas))
+        for i in np.flatnonzero(np.abs(deltas - self.expectedPeriod) > self.tolerance):
+            self.numberOfTimingErrors += 1
+            self._event({'type' : 'timing', 'position' : firstPosition + int(valid[i]), 'spectrumIndex' : int(indices[valid[i] + 1]),
+                         'delta' : int(deltas[i]), 'expectedPeriod' : self.expectedPeriod})
+        
+        # Running mean and variance, merged with those of this chunk.
+        numberOfDeltas = len(deltas)
+        chunkMean = float(deltas.mean())
+        total = self.numberOfDeltas + numberOfDeltas
+        difference = chunkMean - self.meanDelta
+        self._m2Delta += float(((deltas - chunkMean)**2).sum()) + difference**2 * self.numberOfDeltas * numberOfDeltas / total
+        self.meanDelta += difference * numberOfDeltas / total
+        self.numberOfDeltas = total
+        minimum = int(deltas.min())
+        maximum = int(deltas.max())
+        self.minimumDelta = minimum if self.minimumDelta is None else min(self.minimumDelta, minimum)
+        self.maximumDelta = maximum if self.maximumDelta is None else max(self.maximumDelta, maximum)
+        
+    def deadTime(self):
+        """
+        Mean time between spectra minus the integration time in us, None before two spectra.
+        """
+        if(self.numberOfDeltas == 0 or self.integrationTime is None):
+            return None
+        return self.meanDelta - self.integrationTime
+        
+    def isIntact(self):
+        return self.numberOfGaps == 0 and self.numberOfTimingErrors == 0
+        
+    def report(self):
+        return {'numberOfSpectra' : self.numberOfSpectra,
+                'isIntact' : self.isIntact(),
+                'numberOfGaps' : self.numberOfGaps,
+                'missingSpectra' : self.missingSpectra,
+                'numberOfTimingErrors' : self.numberOfTimingErrors,
+                'integrationTimeChanges' : self.integrationTimeChanges,
+                'expectedPeriod' : self.expectedPeriod,
+                'meanDelta' : self.meanDelta if self.numberOfDeltas > 0 else None,
+                'jitter' : (self._m2Delta / self.numberOfDeltas)**0.5 if self.numberOfDeltas > 0 else None,
+                'minimumDelta' : self.minimumDelta,
+                'maximumDelta' : self.maximumDelta,
+                'deadTime' : self.deadTime(),
+                'events' : list(self.events)}
+
+class _SpectrumRing(object):
+    """
+    Preallocated ring of spectrum slots, written by one thread and read by another.
+    The writer only advances writeIndex, the reader only advances readIndex. Both
+    only increase, the slot of an index is index % size. Assigning an int64 is atomic,
+    and the writer publishes writeIndex after the slots are filled, so no lock is needed.
+    
+    headers, spectra and counters (int64 writeIndex, readIndex, droppedSpectra) can be given,
+    for example in shared memory, so the writer and reader can be in different processes.
+    With dtype None the spectra are allocated at the first write, in the dtype of those spectra.
+    """
+    
+    def __init__(self, size, spectrumLength, dtype = np.float64, headers = None, spectra = None, counters = None):
+        self.size = size
+        self.spectrumLength = spectrumLength
+        if(headers is None):
+            headers = np.zeros(size, dtype = spectrumHeaderDtype)
+        if(spectra is None and dtype is not None):
+            spectra = np.zeros((size, spectrumLength), dtype = dtype)
+        if(counters is None):
+            counters = np.zeros(3, dtype = np.int64)
+        self.headers = headers
+        self.spectra = spectra
+        self._counters = counters
+        
+    @property
+    def writeIndex(self):
+        return int(self._counters[0])
+        
+    @writeIndex.setter
+    def writeIndex(self, value):
+        self._counters[0] = value
+        
+    @property
+    def readIndex(self):
+        return int(self._counters[1])
+        
+    @readIndex.setter
+    def readIndex(self, value):
+        self._counters[1] = value
+        
+    @property
+    def droppedSpectra(self):
+        return int(self._counters[2])
+        
+    @droppedSpectra.setter
+    def droppedSpectra(self, value):
+        self._counters[2] = value
+        
+    def numberAvailable(self):
+        return self.writeIndex - self.readIndex
+        
+    def write(self, headers, spectra):
+        """
+        Copies spectra into the ring. If the reader does not keep up and the ring is 
+        full, the newest spectra are dropped and counted in droppedSpectra.
+        """
+        if(len(headers) == 0):
+            return 0
+        numberOfSpectra = min(len(headers), self.size - self.numberAvailable())
+        self.droppedSpectra += len(headers) - numberOfSpectra
+        if(self.spectra is None and numberOfSpectra > 0):
+            self.spectra = np.zeros((self.size, self.spectrumLength), dtype = spectra.dtype)
+        
+        start = self.writeIndex % self.size
+        first = min(numberOfSpectra, self.size - start)
+        self.headers[start:start + first] = headers[:first]
+        self.spectra[start:start + first] = spectra[:first]
+        self.headers[:numberOfSpectra - first] = headers[first:numberOfSpectra]
+        self.spectra[:numberOfSpectra - first] = spectra[first:numberOfSpectra]
+        self.writeIndex += numberOfSpectra
+        return numberOfSpectra
+        
+    def read(self, maxNumberOfSpectra = None):
+        """
+        Returns copies of the headers and spectra that are available and frees their slots.
+        """
+        numberOfSpectra = self.numberAvailable()
+        if(maxNumberOfSpectra is not None):
+            numberOfSpectra = min(numberOfSpectra, maxNumberOfSpectra)
+        slots = np.arange(self.readIndex, self.readIndex + numberOfSpectra) % self.size
+        headers = self.headers[slots]
+        if(self.spectra is None):
+            return headers, np.empty((0, self.spectrumLength))
+        spectra = self.spectra[slots]
+        self.readIndex += numberOfSpectra
+        return headers, spectra
+
+
+class _ClockOffset(object):
+    """
+    Relates the time stamps of a spectrometer, in us on its own clock, to time.perf_counter().
+    After every reply, the host time it arrived minus timeStampLastSpectrum, when the reply was
+    made, is an upper bound of the offset between the clocks. The smallest bound is kept, so
+    host times are late by at most the shortest USB latency seen. With the time the request was
+    sent, there is a lower bound as well, and host times are the middle of the two.
+    """
+    
+    def __init__(self):
+        self.offset = None # s, the upper bound
+        self.minimumOffset = None # s, the lower bound
+        
+    def update(self, arrivalTime, headers, sendTime = None):
+        """
+        Returns True if the upper bound changed.
+        """
+        if(len(headers) == 0):
+            return False
+        timeStamp = 1e-6 * float(headers['timeStampLastSpectrum'][-1])
+        if(sendTime is not None and (self.minimumOffset is None or sendTime - timeStamp > self.minimumOffset)):
+            self.minimumOffset = sendTime - timeStamp
+        if(self.offset is None or arrivalTime - timeStamp < self.offset):
+            self.offset = arrivalTime - timeStamp
+            return True
+        return False
+        
+    def hostTime(self, timeStamp):
+        """
+        The perf_counter time of timeStamp (us, an int or an array), nan if the offset is unknown.
+        """
+        if(self.offset is None):
+            return np.full(np.shape(timeStamp), np.nan) if np.ndim(timeStamp) else float('nan')
+        offset = self.offset if self.minimumOffset is None else 0.5 * (self.offset + self.minimumOffset)
+        return 1e-6 * np.asarray(timeStamp, dtype = np.float64) + offset
+        
+    def requestTime(self, timeStamp):
+        """
+        When to send a request so it reaches the spectrometer at timeStamp (us), or soon after.
+        """
+        offset = self.offset if self.minimumOffset is None else self.minimumOffset
+        return 1e-6 * timeStamp + offset
+
+
+class _TriggerGrouper(object):
+    """
+    Groups the spectra of a triggered acquisition into events, one per trigger. After a trigger the
+    spectrometer measures spectraPerTrigger spectra back to back, so within an event the time
+    stamps are a period apart, for every step in spectrumIndex. A larger difference is the next 
+    trigger. An event is complete when the spectrum at position spectraPerTrigger - 1 after the
+    first has arrived, or, if spectra were lost, when the next trigger shows.
+    
+    The period starts as the integration time in the headers and follows the time stamps of
+    consecutive spectra. The trigger period is the median difference of the last 16 events.
+    
+    An event is a dictionary with the triggerNumber, counted from 0, the headers and spectra of 
+    the trigger, missingSpectra, the number of its spectra that were lost, complete, and the
+    triggerTime, on the perf_counter clock, estimated as the time stamp of the first spectrum
+    minus one period.
+    """
+    
+    def __init__(self, spectraPerTrigger, clockOffset):
+        self.spectraPerTrigger = spectraPerTrigger
+        self.clockOffset = clockOffset
+        self.period = None # us
+        self.numberOfEvents = 0
+        self.numberOfIncompleteEvents = 0
+        self.missingSpectra = 0
+        self._eventStarts = collections.deque(maxlen = 17) # time stamps of the first spectra
+        self._headers = []
+        self._spectra = []
+        self._startTimeStamp = None
+        self._lastTimeStamp = None
+        self._lastIndex = None
+        self._missing = 0
+        self._emptyReplies = 0 # in a row
+        
+    def triggerPeriod(self):
+        """
+        The trigger period in us, None before three events.
+        """
+        if(len(self._eventStarts) < 3):
+            return None
+        return float(np.median(np.diff(np.array(self._eventStarts, dtype = np.float64))))
+        
+    def pendingSpectra(self):
+        return sum(len(headers) for headers in self._headers)
+        
+    def nextEventTime(self):
+        """
+        The perf_counter time to ask for the event that is being received, or else the next one,
+        so the request arrives when it is complete. None if that cannot be estimated yet.
+        """
+        if(self.period is None or self.clockOffset.offset is None):
+            return None
+        if(self._startTimeStamp is not None):
+            start = self._startTimeStamp
+        elif(self.triggerPeriod() is not None):
+            start = self._eventStarts[-1] + self.triggerPeriod()
+        else:
+            return None
+        return self.clockOffset.requestTime(start + (self.spectraPerTrigger - 1) * self.period)
+        
+    def pollInterval(self, firstInterval = None):
+        """
+        How long to wait after an empty reply. The first time firstInterval, by default the length 
+        of an event, at most a quarter of the trigger period and 10 ms, at least 0.1 ms. While no
+        trigger comes, the wait doubles with every empty reply in a row, up to a quarter of the 
+        trigger period or 10 ms, whichever is longer, and it starts over with the next spectrum.
+        """
+        quarterPeriod = None if self.triggerPeriod() is None else 0.25e-6 * self.triggerPeriod()
+        interval = firstInterval
+        if(interval is None):
+            interval = 0.01
+            if(self.period is not None):
+                interval = min(interval, 1e-6 * self.spectraPerTrigger * self.period)
+            if(quarterPeriod is not None):
+                interval = min(interval, quarterPeriod)
+            interval = max(interval, 1e-4)
+        if(self._startTimeStamp is not None or self._emptyReplies <= 1):
+            # The rest of an event comes right away.
+            return interval
+        maximumInterval = max(interval, 0.01, quarterPeriod or 0)
+        return min(interval * 2**min(self._emptyReplies - 1, 30), maximumInterval)
+        
+    def nextReadTime(self, now, pollInterval = None):
+        """
+        When to ask for spectra next: when the next event should be complete, or after the poll 
+        interval if that is not known or has passed, like for a trigger that comes late.
+        """
+        eventTime = self.nextEventTime()
+        if(eventTime is None or eventTime <= now):
+            return now + self.pollInterval(pollInterval)
+        return eventTime
+        
+    def add(self, headers, spectra):
+        """
+        Adds a chunk of spectra. Returns the events that are complete.
+        """
+        events = []
+        if(len(headers) == 0):
+            self._emptyReplies += 1
+            return events
+        self._emptyReplies = 0
+        if(self.period is None):
+            self.period = float(headers['integrationTime'][0])
+        timeStamps = headers['timeStamp'].astype(np.int64)
+        indices = headers['spectrumIndex'].astype(np.int64)
+        first = 0
+        for i in range(len(headers)):
+            timeStamp = int(timeStamps[i])
+            if(self._startTimeStamp is not None):
+                steps = (int(indices[i]) - self._lastIndex) % 2**32
+                delta = timeStamp - self._lastTimeStamp
+                position = round((timeStamp - self._startTimeStamp) / self.period)
+                if(steps == 0 or delta > (steps + 0.5) * self.period or position >= self.spectraPerTrigger):
+                    # The next trigger, the spectra at the end of the event were lost.
+                    self._append(headers[first:i], spectra[first:i])
+                    first = i
+                    events.append(self._close(self.spectraPerTrigger - self.pendingSpectra()))
+                else:
+                    self._missing += steps - 1
+                    if(steps == 1 and delta > 0):
+                        self.period += 0.1 * (delta - self.period)
+            if(self._startTimeStamp is None):
+                self._startTimeStamp = timeStamp
+                self._eventStarts.append(timeStamp)
+            self._lastTimeStamp = timeStamp
+            self._lastIndex = int(indices[i])
+            if(round((timeStamp - self._startTimeStamp) / self.period) >= self.spectraPerTrigger - 1):
+                self._append(headers[first:i + 1], spectra[first:i + 1])
+                first = i + 1
+                events.append(self._close(self._missing))
+        self._append(headers[first:], spectra[first:])
+        return events
+        
+    def flush(self):
+        """
+        Returns the event that is being received as an incomplete event, or None.
+        """
+        if(self._startTimeStamp is None):
+            return None
+        return self._close(self.spectraPerTrigger - self.pendingSpectra())
+        
+    def _append(self, headers, spectra):
+        if(len(headers) > 0):
+            self._headers.append(headers)
+            self._spectra.append(spectra)
+        
+    def _close(self, missingSpectra):
+        headers = np.concatenate(self._headers) if len(self._headers) != 1 else self._headers[0]
+        spectra = np.concatenate(self._spectra) if len(self._spectra) != 1 else self._spectra[0]
+        missingSpectra = max(missingSpectra, 0)
+        event = {'triggerNumber' : self.numberOfEvents, 'headers' : headers, 'spectra' : spectra,
+                 'missingSpectra' : missingSpectra, 'complete' : missingSpectra == 0,
+                 'triggerTime' : float(self.clockOffset.hostTime(self._startTimeStamp - self.period))}
+        self.numberOfEvents += 1
+        if(missingSpectra > 0):
+            self.numberOfIncompleteEvents += 1
+            self.missingSpectra += missingSpectra
+        self._headers = []
+        self._spectra = []
+        self._startTimeStamp = None
+        self._missing = 0
+        return event
+
+
+class _QueryStatistics(object):
+    """
+    Counts the queries, bytes sent and received and OBP errors per command, with a histogram
+    of the latencies: bin i counts the latencies from 2**(i-1) up to 2**i us, bin 0 those below 1 us.
+    Also adds up the time getSpectra replies take to transfer and to decode. Times are
+    in ns from perf_counter_ns until summary().
+    """
+    numberOfBins = 32
+
+    def __init__(self, commandNames, callback = None):
+        self.commandNames = commandNames # messageType: command name
+        self.callback = callback
+        self.commands = {}
+        self.errors = {} # OBP error code: number of replies
+        self.transferTime = 0
+        self.decodeTime = 0
+        self.startTime = time.perf_counter_ns()
+
+    def record(self, messageType, latency, bytesSent, bytesReceived, errorCode):
+        name = self.commandNames.get(messageType, messageType)
+        command = self.commands.get(name)
+        if(command is None):
+            command = {'calls' : 0, 'bytesSent' : 0, 'bytesReceived' : 0, 'errors' : 0,
+                       'totalLatency' : 0, 'histogram' : [0] * self.numberOfBins}
+            self.commands[name] = command
+        command['calls'] += 1
+        command['bytesSent'] += bytesSent
+        command['bytesReceived'] += bytesReceived
+        command['totalLatency'] += latency
+        command['histogram'][min((latency // 1000).bit_length(), self.numberOfBins - 1)] += 1
+        if(errorCode != 0):
+            command['errors'] += 1
+            self.errors[errorCode] = self.errors.get(errorCode, 0) + 1
+        if(self.callback is not None):
+            self.callback(name, 1e-9 * latency, bytesSent, bytesReceived, errorCode)
+
+    def summary(self):
+        commands = {}
+        for name, command in self.commands.items():
+            commands[name] = {'calls' : command['calls'],
+                              'bytesSent' : command['bytesSent'],
+                              'bytesReceived' : command['bytesReceived'],
+                              'errors' : command['errors'],
+                              'meanLatency' : 1e-9 * command['totalLatency'] / command['calls'],
+                              'latencyHistogram' : {2**i : count for i, count in enumerate(command['histogram']) if count > 0}}
+        return {'commands' : commands,
+                'errors' : dict(sorted(self.errors.items())),
+                'transferTime' : 1e-9 * self.transferTime,
+                'decodeTime' : 1e-9 * self.decodeTime,
+                'duration' : 1e-9 * (time.perf_counter_ns() - self.startTime)}
+
+
+# Offset in the capture file and length (metadata and pixels) of a spectrum, see captureBurst.
+captureIndexDtype = np.dtype([('offset', '<u8'), ('length', '<u4')])
+
+
+class _RawCaptureWriter(object):
+    """
+    Writes the getSpectra replies of captureBurst to a file as they are, and keeps the index
+    of the spectra in them. fetch() takes the place of _getRawSpectra in the acquisition loop,
+    and only returns the metadata, as headers, with None for the spectra.
+    """
+    
+    def __init__(self, spectrometer, fileName):
+        self.spectrometer = spectrometer
+        self.fileName = fileName
+        self.file = open(fileName, 'wb')
+        self.offset = 0
+        self.frameOffsets = []
+        self.frameLengths = []
+        
+    def fetch(self, numberOfSpectra):
+        with self.spectrometer._usbLock:
+            reply = self.spectrometer._query('getSpectra', message = int(numberOfSpectra), zeroCopy = True)
+            self.file.write(reply)
+            metaData, offsets, lengths = PyUSBSpectrometer._frameLayout(reply[44:-24])
+        # The frames start after the 44 byte OBP header.
+        self.frameOffsets.append(offsets + (self.offset + 44))
+        self.frameLengths.append(lengths)
+        self.offset += len(reply)
+        return metaData, None
+        
+    def close(self):
+        self.file.close()
+        index = np.zeros(sum(len(offsets) for offsets in self.frameOffsets), dtype = captureIndexDtype)
+        if(len(index) > 0):
+            index['offset'] = np.concatenate(self.frameOffsets)
+            index['length'] = np.concatenate(self.frameLengths)
+        np.save(self.fileName + '.index.npy', index)
+
+
+class _USBLock(object):
+    """
+    The RLock for the USB transactions, which counts the threads waiting for it. _SpectraPipeline
+    holds it while requests are in flight, and stops sending new ones while another thread waits,
+    so that thread only waits for the replies in flight rather than until the acquisition stops.
+    """
+    
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._waitingLock = threading.Lock()
+        self.waiting = 0
+        
+    def acquire(self, blocking = True, timeout = -1):
+        # Also the way back in for the thread which holds it already.
+        if(self._lock.acquire(blocking = False)):
+            return True
+        if(not blocking):
+            return False
+        with self._waitingLock:
+            self.waiting += 1
+        try:
+            return self._lock.acquire(timeout = timeout)
+        finally:
+            with self._waitingLock:
+                self.waiting -= 1
+                
+    def release(self):
+        self._lock.release()
+        
+    def __enter__(self):
+        self.acquire()
+        return self
+        
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _SpectraPipeline(object):
+    """
+    Keeps up to depth getSpectra requests in flight, so the spectrometer already answers the next
+    request while a reply is being read and decoded, and the link does not wait a round trip per
+    chunk. Every request carries a sequence number in the OBP regarding field, which the reply
+    echoes. Replies come in the order of the requests; a reply for a later request means the
+    ones before it were lost, those count as empty. A reply with error 13 (empty buffer) is an 
+    empty chunk as well.
+    
+    The USB lock is held while requests are in flight, since the reply to another command
+    would end up between the getSpectra replies. While another thread waits for it, no
+    requests are sent, so the ones in flight drain and the lock is released for that command.
+    """
+    
+    def __init__(self, spectrometer, depth):
+        self.spectrometer = spectrometer
+        self.depth = depth
+        self.inFlight = collections.deque() # (sequence number, number of spectra, send time)
+        self.spectraInFlight = 0
+        self.sequenceNumber = 0
+        self.lastReceiveTime = 0.0
+        self.errorCodes = {} # error code: number of replies
+        self.numberOfLostReplies = 0
+        self.numberOfSkippedReplies = 0
+        
+    def send(self, numberOfSpectra):
+        if(len(self.inFlight) == 0):
+            self.spectrometer._usbLock.acquire()
+        # Regarding 0 is left for the requests outside of the pipeline.
+        self.sequenceNumber = self.sequenceNumber % 0xFFFFFFFF + 1
+        try:
+            self.requestLength = self.spectrometer._writeRequest(self.spectrometer._commands['getSpectra'], int(numberOfSpectra), 
+                                                                 regarding = self.sequenceNumber)
+        except:
+            if(len(self.inFlight) == 0):
+                self.spectrometer._usbLock.release()
+            raise
+        self.inFlight.append((self.sequenceNumber, int(numberOfSpectra), time.perf_counter()))
+        self.spectraInFlight += int(numberOfSpectra)
+        
+    def _pop(self):
+        request = self.inFlight.popleft()
+        self.spectraInFlight -= request[1]
+        if(len(self.inFlight) == 0):
+            self.spectrometer._usbLock.release()
+        return request
+        
+    def receive(self):
+        """
+        Reads the reply to the oldest request in flight. Returns the header records, the spectra,
+        the number of spectra asked for and the time the reply took, from when it was sent or 
+        the previous reply arrived, whichever is later.
+        """
+        spectrometer = self.spectrometer
+        getSpectra = spectrometer._commands['getSpectra']
+        startTime = time.perf_counter_ns()
+        while(True):
+            reply = spectrometer._readReply()
+            regarding = _regarding.unpack_from(reply, 12)[0]
+            sequenceNumbers = [request[0] for request in self.inFlight]
+            if(reply[8:12] == getSpectra and regarding in sequenceNumbers):
+                break
+            # Not for a request in flight, like a late reply of another command.
+            self.numberOfSkippedReplies += 1
+            print('Skipped a reply to {} regarding {}.'.format(bytes(reply[8:12]), regarding))
+        for i in range(sequenceNumbers.index(regarding)):
+            self._pop()
+            self.numberOfLostReplies += 1
+        sequenceNumber, numberOfSpectra, sendTime = self.inFlight[0]
+        
+        receiveTime = time.perf_counter()
+        latency = receiveTime - max(sendTime, self.lastReceiveTime)
+        self.lastReceiveTime = receiveTime
+        errorCode = struct.unpack_from('<H', reply, 6)[0]
+        statistics = spectrometer._statistics
+        # The reply is in the read buffer, which the next query overwrites. Popping the last
+        # request releases the lock, so that happens after decoding.
+        try:
+            if(errorCode == 0):
+                transferTime = time.perf_counter_ns()
+                headers, spectra = spectrometer._processRawSpectalData(reply, asRecords = True)
+                if(statistics is not None):
+                    statistics.transferTime += transferTime - startTime
+                    statistics.decodeTime += time.perf_counter_ns() - transferTime
+        finally:
+            self._pop()
+        if(errorCode != 0):
+            self.errorCodes[errorCode] = self.errorCodes.get(errorCode, 0) + 1
+            if(errorCode != 13):
+                print('ERROR CODE: ', errorCode, ' in reply to getSpectra.')
+            headers = np.zeros(0, dtype = spectrumHeaderDtype)
+            spectra = np.empty((0, spectrometer.getNumberOfPixels()), dtype = spectrometer.spectrumDtype())
+        if(statistics is not None):
+            statistics.record(getSpectra, int(1e9 * latency), self.requestLength, len(reply), errorCode)
+        return headers, spectra, numberOfSpectra, latency
+        
+    def close(self):
+        """
+        Reads and discards the replies still in flight.
+        """
+        try:
+            while(len(self.inFlight) > 0):
+                self.receive()
+        finally:
+            while(len(self.inFlight) > 0):
+                self._pop()
+                
+    def statistics(self):
+        return {'depth' : self.depth,
+                'errorCodes' : dict(self.errorCodes),
+                'numberOfLostReplies' : self.numberOfLostReplies,
+                'numberOfSkippedReplies' : self.numberOfSkippedReplies}
+
+
+# Immediate data length and immediate data of an OBP request, from byte 23 on.
+_immediateInt = struct.Struct('<BI12x')
+_immediateBytes = struct.Struct('<B16s')
+# The regarding field at byte 12, which the spectrometer copies from a request into its reply.
+_regarding = struct.Struct('<I')
+
+
+@functools.lru_cache(maxsize = 32)
+def _frameDtype(pixelDataFormatCode, spectrumLengthBytes):
+    """
+    Structured dtype of one spectrum as it is sent by the spectrometer: the metadata
+    followed by the pixels. The 4 bytes after every spectrum are not part of the dtype,
+    they are skipped with the stride of the array.
+    """
+    if(pixelDataFormatCode not in _pixelDataFormats):
+        raise ValueError('Data type not recognised: {}'.format(pixelDataFormatCode))
+    _, bytesPerDatapoint, wireDtype, _ = _pixelDataFormats[pixelDataFormatCode]
+    numberOfPixels = spectrumLengthBytes // bytesPerDatapoint
+    if(bytesPerDatapoint == 3):
+        pixelShape = (numberOfPixels, 3)
+    else:
+        pixelShape = (numberOfPixels,)
+    return np.dtype({'names'   : ['metaData', 'pixels'],
+                     'formats' : [_metaDataDtype, (wireDtype, pixelShape)],
+                     'offsets' : [0, 64],
+                     'itemsize': 64 + spectrumLengthBytes})
 
 
 class PyUSBSpectrometer(Spectrometer):
     
-    def __init__(self, pathToUSBBackend = 'C:\\Program Files\\libusb-1.0.24\\MinGW64\\dll\\', idVendor=0x2457, idProduct=0x2001):
+    def __init__(self, pathToUSBBackend = 'C:\\Program Files\\libusb-1.0.24\\MinGW64\\dll\\', idVendor=0x2457, idProduct=0x2001, device = None,
+                 fastOpen = False, selfTest = None, calibrationCache = defaultCalibrationCache, serialNumber = None):
     
         """
         
@@ -25,7 +923,27 @@ class PyUSBSpectrometer(Spectrometer):
         This script accesses the spectrometer with the usb python package and the libusb backend.
         
         Obtain a specrum with intensities(), and obtain a burst of spectra with burst(self, acquireNumberOfSpectra, dtype = np.float64), 
-        with acquireNumberOfSpectra the number of spectra. burst() should use the onboard memory chip.
+        with acquireNumberOfSpectra the number of spectra. burst() should use the onboard memory chip. The headers of a 
+        burst are a record array with spectrumHeaderDtype. For continuous acquisition, startAcquisition() empties
+        the onboard buffer in a background thread, and readAvailable() returns what was acquired so far. 
+        iterSpectra() yields the spectra in blocks, for acquisitions that do not fit in memory, and recordBurst() 
+        writes a burst straight to a .npy file. reducedBurst() only keeps a running reduction of the spectra,
+        and captureBurst() saves the replies undecoded, to be decoded later with rawCapture.RawCapture.
+        enableStatistics() and stats() show where the time goes. Set requestsInFlight to 2 or more to
+        keep that many getSpectra requests in flight, which hides the USB round trip.
+        
+        serialNumber selects one of several spectrometers, see findSerialNumbers(). Without it the first 
+        one is taken. device replaces the USB device, for example with an emulatedSpectrometer.EmulatedOBPDevice. It needs
+        the write() and read() methods of usb.core.Device, and wavelengths().
+        
+        With fastOpen the wavelength calibration and the properties that do not change are taken 
+        from a file in calibrationCache, named after the serial number. Only if there is no such 
+        file, the wavelengths are read with seabreeze, which releases and finds the device again.
+        The cache is written when the wavelengths were read, with fastOpen or with a calibrationCache 
+        other than the default, but never for a device that was passed in, nor if calibrationCache 
+        is None. A cache file with a wavelength for every pixel is not used otherwise.
+        selfTest runs intensities() and a burst of 500 spectra, which also measures the dead time.
+        By default it only runs without fastOpen, otherwise ping() checks that the spectrometer replies.
         """
     
         
@@ -34,58 +952,45 @@ class PyUSBSpectrometer(Spectrometer):
             sys.path.append(pathToUSBBackend)
             
 
-        print('Looking for connected spectrometers:')
-        
-        try:
-            self._spectrometer = usb.core.find(idVendor=idVendor, idProduct=idProduct)
-            backend = None
-        except Exception as e:
-            print(e, ', attempting with hardcoded locaton for the DLL file.')
-            backend = usb.backend.libusb1.get_backend(find_library = lambda x: 'C:\\Users\\pnaspeets\\octviewer\\libusb-1.0.24\\MinGW64\\dll\\libusb-1.0.dll')
-            print(backend)
-            try:
-                self._spectrometer = usb.core.find(backend=backend, idVendor=idVendor, idProduct=idProduct)
-            except:
-                print('No local backend found: ', e)
-        
-        if(self._spectrometer is None):
-            print('Spectrometer with id: ' , idProduct, ' not found.')
-            self._spectrometer = usb.core.find(idVendor=idVendor)
-        serialNumber = str(self._spectrometer.serial_number)
-        usb.util.dispose_resources(self._spectrometer)
-        
-        time.sleep(0.1)    
-
-        if(serialNumber ==  'OFX01948' ):
-            import seabreeze.spectrometers as sb
-            for i in range(15):
-                try:
-                    _spectrometer = sb.Spectrometer.from_first_available()
-                    break
-                except:
-                    time.sleep(1)                
-                    if(i == 10):
-                        print('Cannot connect to USB spectrometer.')
-                
-            self._wavelengths = _spectrometer.wavelengths()
-            _spectrometer.close()
+        self._serialNumber = serialNumber
+        if(device is None):
+            self._findDevice(idVendor, idProduct)
+            if(not fastOpen):
+                self._readSeabreezeWavelengths(idVendor, idProduct)
         else:
-            raise NotImplementedError("For some reason the old spectrometer does not work with USB commands.")
-        
-        time.sleep(0.1)
-        if(backend is None):
-            self._spectrometer = usb.core.find(idVendor=idVendor, idProduct=idProduct)
-        else:
-            self._spectrometer = usb.core.find(backend = backend, idVendor=idVendor, idProduct=idProduct)
-        if(self._spectrometer is None):
-            try:
-                self._spectrometer = usb.core.find(idVendor=idVendor)
-            except Exception as e:
-                print(e)
-                self._spectrometer = usb.core.find(backend = backend, idVendor=idVendor)
-        
+            self._spectrometer = device
+            if(not fastOpen):
+                self._wavelengths = device.wavelengths()
             
         self._spectrometer.set_configuration()
+        
+        # One USB transaction at a time, also when the acquisition thread is running.
+        self._usbLock = _USBLock()
+        self._stopAcquisition = threading.Event()
+        self._acquisitionThread = None
+        self._ring = None
+        self._flowStatistics = {}
+        self._integrityMonitor = None
+        self.integrityCallback = None
+        # Triggered acquisition, see startTriggeredAcquisition().
+        self._triggerGrouper = None
+        self._triggerEvents = None
+        self._triggerStatistics = {}
+        # Number of getSpectra requests kept in flight by burst() and startAcquisition(), see _SpectraPipeline.
+        self.requestsInFlight = 1
+        self._liveViewThread = None
+        self._stopLiveView = threading.Event()
+        
+        # Replies are read into these buffers, which are reused, see _queryPyUSB.
+        self._headerBuffer = array.array('B', bytes(100))
+        self._readBuffer = array.array('B')
+        self._responseBuffer = bytearray(4096)
+
+        # A _QueryStatistics while enableStatistics() is on. None costs one check per query.
+        self._statistics = None
+
+        # Device properties that only change when they are set. See refreshProperties().
+        self._properties = {}
          
         self._commands = {'reset'                       : b'\x00\x00\x00\x00', 
                         'getSerialNumber'               : b'\x00\x01\x00\x00', 
@@ -130,73 +1035,398 @@ class PyUSBSpectrometer(Spectrometer):
                             101 :  'Bad Firmware',
                             102 :  'Incorrect Packet Length'
                             }
+        
+        # A request without data for every command. Only the immediate data is filled in before sending, see _encodeRequest.
+        self._requestTemplates = {}
+        for messageType in self._commands.values():
+            for requestAck in (True, False):
+                self._requestTemplates[(messageType, requestAck)] = array.array('B', self.makeOBPMessage(b'', messageType, requestAck = requestAck))
          
 
+        wavelengthsRead = not fastOpen
+        if(fastOpen and not (calibrationCache is not None and self._loadCalibration(calibrationCache))):
+            print('No cached calibration, reading the wavelengths.')
+            wavelengthsRead = True
+            if(device is None):
+                self._readSeabreezeWavelengths(idVendor, idProduct)
+                self._spectrometer.set_configuration()
+            else:
+                self._wavelengths = device.wavelengths()
+        
         print('Setting trigger and exposure time.')
         self.triggerMode(0)
         self.setIntegrationTime(self.getMinimumIntegrationTime())
         self.setBuffering(False)
         
-        print('Spectrometer test: ', end='')
-        spectrum = self.intensities()
         self._deadTime = -999
-        testResult = False
+        if(selfTest is None):
+            selfTest = not fastOpen
+        if(selfTest):
+            print('Spectrometer test: ', end='')
+            spectrum = self.intensities()
+            testResult = False
         
-        if(len(spectrum) == self.getNumberOfPixels() and np.any(spectrum > 0)):
-            try:
-                self.burst(500)
-            except:
-                testResult = False
+            if(len(spectrum) == self.getNumberOfPixels() and np.any(spectrum > 0)):
+                try:
+                    self.burst(500)
+                except:
+                    testResult = False
             
-            print('Spectrometer dead time: ', self._deadTime)
-            if(self._deadTime != -999):
-                testResult = True
+                print('Spectrometer dead time: ', self._deadTime)
+                if(self._deadTime != -999):
+                    testResult = True
+                else:
+                    testResult = False
+                    
             else:
                 testResult = False
-                    
-        else:
-            testResult = False
-        if(testResult):
-            print('Test passed.')
-        else:
-            print('Test failed.')
+            if(testResult):
+                print('Test passed.')
+            else:
+                print('Test failed.')
+        elif(not self.ping()):
+            print('Spectrometer does not reply.')
+            
+        # An emulator or another stand-in device must not replace the calibration of a spectrometer.
+        if(wavelengthsRead and calibrationCache is not None and device is None and 
+                (fastOpen or calibrationCache != defaultCalibrationCache)):
+            self._saveCalibration(calibrationCache)
                             
                               
  
-    def intensities(self):
-        answer = self._query('getNumberOfPixels')
-        numberOfPixels = struct.unpack('<H',answer[24:26])[0]
-        spectrum = np.empty(numberOfPixels)        
-        answer = self._query(self._commands['getSingleSpectrum'])      
+    def _findDevice(self, idVendor, idProduct):
+        print('Looking for connected spectrometers:')
+        
+        try:
+            self._spectrometer = self._find(None, idVendor, idProduct)
+            backend = None
+        except Exception as e:
+            print(e, ', attempting with hardcoded locaton for the DLL file.')
+            backend = usb.backend.libusb1.get_backend(find_library = lambda x: 'C:\\Users\\pnaspeets\\octviewer\\libusb-1.0.24\\MinGW64\\dll\\libusb-1.0.dll')
+            print(backend)
+            try:
+                self._spectrometer = self._find(backend, idVendor, idProduct)
+            except:
+                print('No local backend found: ', e)
+        
+        if(self._spectrometer is None):
+            if(self._serialNumber is not None):
+                raise RuntimeError('No spectrometer with serial number {}.'.format(self._serialNumber))
+            print('Spectrometer with id: ' , idProduct, ' not found.')
+            self._spectrometer = usb.core.find(idVendor=idVendor)
+        self._backend = backend
+        
+        
+    def _find(self, backend, idVendor, idProduct):
+        """
+        usb.core.find for the spectrometer with self._serialNumber, or the first one if that is None.
+        """
+        if(self._serialNumber is None):
+            return usb.core.find(backend = backend, idVendor = idVendor, idProduct = idProduct)
+        return usb.core.find(backend = backend, idVendor = idVendor, idProduct = idProduct, 
+                             custom_match = lambda device: _deviceSerialNumber(device) == self._serialNumber)
+        
+        
+    def _readSeabreezeWavelengths(self, idVendor, idProduct):
+        """
+        Reads the wavelength calibration with seabreeze. The USB device is released for that 
+        and found again afterwards, which takes a while.
+        """
+        backend = self._backend
+        serialNumber = str(self._spectrometer.serial_number)
+        usb.util.dispose_resources(self._spectrometer)
+        
+        time.sleep(0.1)    
+
+        if(serialNumber ==  'OFX01948' or serialNumber == self._serialNumber):
+            import seabreeze.spectrometers as sb
+            _spectrometer = None
+            for i in range(_maximumOpenAttempts):
+                try:
+                    if(self._serialNumber is None):
+                        _spectrometer = sb.Spectrometer.from_first_available()
+                    else:
+                        _spectrometer = sb.Spectrometer.from_serial_number(self._serialNumber)
+                    break
+                except:
+                    time.sleep(_backoff(i))
+            if(_spectrometer is None):
+                raise RuntimeError('Cannot connect to USB spectrometer.')
+                
+            self._wavelengths = _spectrometer.wavelengths()
+            _spectrometer.close()
+        else:
+            raise NotImplementedError("For some reason the old spectrometer does not work with USB commands.")
+        
+        time.sleep(0.1)
+        self._spectrometer = self._find(backend, idVendor, idProduct)
+        if(self._spectrometer is None and self._serialNumber is None):
+            try:
+                self._spectrometer = usb.core.find(idVendor=idVendor)
+            except Exception as e:
+                print(e)
+                self._spectrometer = usb.core.find(backend = backend, idVendor=idVendor)
+        if(self._spectrometer is None):
+            raise RuntimeError('Spectrometer {} not found again after reading the wavelengths.'.format(self._serialNumber or serialNumber))
+        
         
+    def _calibrationFileName(self, calibrationCache):
+        serialNumber = self.getSerialNumberBytes().rstrip(b'\x00').decode('ascii', 'replace')
+        serialNumber = ''.join(c for c in serialNumber if c.isalnum() or c in '-_')
+        return os.path.join(calibrationCache, serialNumber + '.json')
         
-        payload = answer[44:-20]
-        iterator = struct.iter_unpack('<H',payload)
+        
+    def _loadCalibration(self, calibrationCache):
+        """
+        Takes the wavelengths and the properties that do not change from the cache file for 
+        the serial number of this spectrometer. Returns False if there is no such file, or if
+        its number of wavelengths is not the number of pixels of the spectrometer.
+        """
+        try:
+            with open(self._calibrationFileName(calibrationCache)) as f:
+                calibration = json.load(f)
+            wavelengths = np.array(calibration['wavelengths'], dtype = np.float64)
+            properties = calibration['properties']
+        except (OSError, ValueError, KeyError):
+            return False
+        if(len(wavelengths) != self.getNumberOfPixels()):
+            print('The cached calibration has {} wavelengths for {} pixels, not using it.'.format(len(wavelengths), self.getNumberOfPixels()))
+            return False
+        self._wavelengths = wavelengths
+        for name in _staticProperties:
+            if(name in properties):
+                self._properties[name] = properties[name]
+        return True
+        
+        
+    def _saveCalibration(self, calibrationCache):
+        properties = {}
+        for name in _staticProperties:
+            properties[name] = self._getProperty(name, _staticProperties[name])
+        calibration = {'wavelengths' : [float(w) for w in self._wavelengths], 
+                       'properties' : properties}
+        fileName = self._calibrationFileName(calibrationCache)
+        try:
+            os.makedirs(calibrationCache, exist_ok = True)
+            # Written next to the cache file first, so a file that is being written is never read.
+            with open(fileName + '.tmp', 'w') as f:
+                json.dump(calibration, f)
+            os.replace(fileName + '.tmp', fileName)
+        except OSError as e:
+            print('Could not write the calibration cache: ', e)
+            
+            
+    def ping(self):
+        """
+        Returns True if the spectrometer replies to a request without an error.
+        """
+        try:
+            answer = self._query('getSerialNumber')
+        except Exception as e:
+            print('No reply: ', e)
+            return False
+        return answer[6:8] == b'\x00\x00'
         
 
-        for i in range(len(payload)//2):
-            spectrum[i] = next(iterator)[0]
-        if(len(spectrum) < numberOfPixels or len(answer) < 128):
-            time.sleep(0.01)
+    def intensities(self, maximumRetries = 10, dtype = np.float64, out = None):
+        """
+        Returns a spectrum. While the live view runs, this is a copy of its newest spectrum, 
+        and the spectrometer is not asked. With dtype None the spectrum is U16, as sent.
+        out is an array, or a slice of one, with a value for every pixel. The spectrum is 
+        written into it, in the dtype of out, and out is returned. A feedback loop that 
+        passes the same out every time does not allocate.
+        """
+        numberOfPixels = self.getNumberOfPixels()
+        if(out is None):
+            out = np.empty(numberOfPixels, dtype = np.uint16 if dtype is None else dtype)
+        elif(out.shape != (numberOfPixels,)):
+            raise ValueError('out has shape {}, expected ({},).'.format(out.shape, numberOfPixels))
+        
+        if(self._liveViewThread is not None):
+            np.copyto(out, self.latest(), casting = 'unsafe')
+            return out
+        
+        for i in range(maximumRetries + 1):
+            if(self._readSingleSpectrum(out)):
+                return out
+            time.sleep(_backoff(i, firstDelay = 0.005, maximumDelay = 0.1))
             print('Device blocked. Retrying: ')
-            return self.intensities()
+        raise RuntimeError('No spectrum after {} retries.'.format(maximumRetries))
+        
+        
+    def _readSingleSpectrum(self, spectrum):
+        """
+        Reads a spectrum with getSingleSpectrum into spectrum, of any dtype. Returns False if the 
+        reply is too short, spectrum is not changed then.
+        """
+        with self._usbLock:
+            answer = self._query('getSingleSpectrum', zeroCopy = True)
+            payload = answer[44:-20]
+            if(len(payload) < 2 * len(spectrum) or len(answer) < 128):
+                return False
+            spectrum[:] = np.frombuffer(payload, dtype = '<u2', count = len(spectrum))
+        return True
+        
+        
+    def startLiveView(self):
+        """
+        Starts a thread that keeps reading the newest spectrum in trigger mode 0. latest() and 
+        intensities() then return the newest spectrum without waiting for the spectrometer.
+        Returns when the first spectrum has arrived. Buffered acquisitions stop the live view.
+        """
+        if(self._liveViewThread is not None):
+            return
+        if(self._properties.get('triggerMode') != 0):
+            self.triggerMode(0)
+        numberOfPixels = self.getNumberOfPixels()
+        # Two buffers: the thread writes into the one that is not the front buffer.
+        self._liveBuffers = [np.zeros(numberOfPixels, dtype = np.uint16), np.zeros(numberOfPixels, dtype = np.uint16)]
+        # (front buffer, sequence number, time of arrival), replaced in one assignment.
+        self._liveSpectrum = (0, 0, 0.0)
+        self._firstLiveSpectrum = threading.Event()
+        self._stopLiveView.clear()
+        self._liveViewThread = threading.Thread(target = self._liveViewLoop, name = 'PyUSBSpectrometer live view', daemon = True)
+        self._liveViewThread.start()
+        self._firstLiveSpectrum.wait(1.0)
+        
+        
+    def _liveViewLoop(self):
+        try:
+            while(not self._stopLiveView.is_set()):
+                front, sequenceNumber, arrivalTime = self._liveSpectrum
+                if(self._readSingleSpectrum(self._liveBuffers[1 - front])):
+                    self._liveSpectrum = (1 - front, sequenceNumber + 1, time.perf_counter())
+                    self._firstLiveSpectrum.set()
+        except Exception as e:
+            print('Live view stopped: ', e)
+            
+            
+    def latest(self, copy = False, withInfo = False):
+        """
+        Returns the newest spectrum of the live view, as U16. Without copy it is the buffer 
+        itself, which the live view overwrites after the next spectrum. With withInfo, also
+        returns the sequence number of the spectrum and its age in s, to detect stale data.
+        """
+        if(self._liveViewThread is None):
+            print('Live view is not running, start it with startLiveView().')
+            return None
+        front, sequenceNumber, arrivalTime = self._liveSpectrum
+        spectrum = self._liveBuffers[front]
+        if(copy):
+            spectrum = spectrum.copy()
+        if(withInfo):
+            return spectrum, sequenceNumber, time.perf_counter() - arrivalTime
         return spectrum
         
         
+    def stopLiveView(self):
+        if(self._liveViewThread is not None):
+            self._stopLiveView.set()
+            self._liveViewThread.join()
+            self._liveViewThread = None
+        
+        
     def reset(self):
+        self._properties.clear()
         self._query('reset')
         
+    def refreshProperties(self):
+        """
+        Asks the spectrometer again for the properties that are cached: number of pixels, 
+        integration time and its limits, buffer sizes, spectra per trigger and serial number.
+        """
+        self._properties.clear()
+        self.getNumberOfPixels()
+        self.getIntegrationTime()
+        self.getMinimumIntegrationTime()
+        self.getMaximumIntegrationTime()
+        self.getMaximumBufferSize()
+        self.getBufferSize()
+        self.getNumberOfSpectraPerTrigger()
+        self.getSerialNumberBytes()
+        return dict(self._properties)
+        
+    def _getProperty(self, name, command, structFormat = '<I'):
+        """
+        Returns a cached device property, and asks the spectrometer if it is not cached yet.
+        A reply with an error is not cached.
+        """
+        if(name in self._properties):
+            return self._properties[name]
+        answer = self._query(command)
+        value = struct.unpack_from(structFormat, answer, 24)[0]
+        if(answer[6:8] == b'\x00\x00'):
+            self._properties[name] = value
+        return value
+        
+    def _setProperty(self, name, value, answer):
+        """
+        Writes a value that was sent to the spectrometer through to the cache, 
+        unless the spectrometer replied with an error. answer is None if no reply was asked for.
+        """
+        if(answer is None or answer[6:8] == b'\x00\x00'):
+            self._properties[name] = value
+        else:
+            self._properties.pop(name, None)
+        
     def getDeadTime(self):
         return self._deadTime    
         
+    def getFlowStatistics(self):
+        """
+        Chunk sizes, number of requests and status queries, request latency and throughput
+        of the last burst.
+        """
+        return self._flowStatistics
+
+    def _newIntegrityMonitor(self, integrationTime):
+        self._integrityMonitor = IntegrityMonitor(integrationTime, callback = self.integrityCallback)
+        return self._integrityMonitor
+        
+    def getIntegrityReport(self):
+        """
+        Gaps in spectrumIndex, unexpected time stamp differences, integration time changes, jitter 
+        and dead time of the running or last acquisition, see IntegrityMonitor. Set 
+        integrityCallback to a function to get every problem as an event as soon as it is found.
+        """
+        if(self._integrityMonitor is None):
+            return {}
+        return self._integrityMonitor.report()
+        
+    def enableStatistics(self, callback = None):
+        """
+        Starts counting queries, bytes, latencies and errors per command, see stats(). Resets
+        the counts if they were already on. callback(commandName, latency, bytesSent,
+        bytesReceived, errorCode) is called after every query, with the latency in s, from
+        the thread that made the query while it holds the USB lock, so keep it short.
+        """
+        self._statistics = _QueryStatistics({messageType : name for name, messageType in self._commands.items()}, callback = callback)
+
+    def disableStatistics(self):
+        self._statistics = None
+
+    def stats(self):
+        """
+        Per command: calls, bytesSent, bytesReceived, errors, meanLatency in s and a
+        latencyHistogram of {upper bound in us: number of queries}. Further the number of
+        replies per OBP error code, the time spent transferring and decoding spectra, and
+        under 'flow' the statistics of the last burst, see getFlowStatistics(). Empty if
+        enableStatistics() was not called.
+        """
+        if(self._statistics is None):
+            return {}
+        statistics = self._statistics.summary()
+        statistics['flow'] = self._flowStatistics
+        return statistics
+
     def setIntegrationTime(self, integrationTime):
         message = struct.pack('<I', integrationTime)
-        self._query('setIntegrationTime', message = message)
+        answer = self._query('setIntegrationTime', message = message)
+        self._setProperty('integrationTime', integrationTime, answer)
 
         
     def getIntegrationTime(self):
-        answer = self._query('getIntegrationTime')
-        return struct.unpack('<I', answer[24:28])[0]    
+        return self._getProperty('integrationTime', 'getIntegrationTime')
     
            
     @property
@@ -210,25 +1440,20 @@ class PyUSBSpectrometer(Spectrometer):
                 
     
     def getMaximumIntegrationTime(self):
-        answer = self._query('getMaximumIntegrationTime')
-        return struct.unpack('<I', answer[24:28])[0]    
+        return self._getProperty('maximumIntegrationTime', 'getMaximumIntegrationTime')
     
     def getMinimumIntegrationTime(self):
-        answer = self._query('getMinimumIntegrationTime')
-        return struct.unpack('<I', answer[24:28])[0]    
+        return self._getProperty('minimumIntegrationTime', 'getMinimumIntegrationTime')
     
     def getSerialNumberBytes(self):
-        answer = self._query('getSerialNumber')
-        return answer[24:40]  
+        return self._getProperty('serialNumber', 'getSerialNumber', structFormat = '16s')
         
         
     def getMaximumBufferSize(self):
-        answer = self._query('getMaximumBufferSize')
-        return struct.unpack('<I', answer[24:28])[0]
+        return self._getProperty('maximumBufferSize', 'getMaximumBufferSize')
 
     def getBufferSize(self):
-        answer = self._query('getBufferSize')
-        return struct.unpack('<I', answer[24:28])[0]
+        return self._getProperty('bufferSize', 'getBufferSize')
         
     def getNumberInBuffer(self):
         answer = self._query('getNumberInBuffer')
@@ -238,9 +1463,28 @@ class PyUSBSpectrometer(Spectrometer):
         
         
     def getNumberOfPixels(self):
-        answer = self._query('getNumberOfPixels')
         #strictly speaking this is undefined behaviour, since spectrometer sends a U16, and not a U32.
-        return struct.unpack('<I', answer[24:28])[0]
+        return self._getProperty('numberOfPixels', 'getNumberOfPixels')
+        
+    def spectrumDtype(self):
+        """
+        The dtype of the spectra as the spectrometer sends them: uint16, uint32 or float32. Taken 
+        from the pixelDataFormatCode of the last spectra that were decoded, U16 before that, 
+        as the FX sends.
+        """
+        return _pixelDataFormats[self._properties.get('pixelDataFormatCode', 1)][3]
+        
+    def _spectraDtype(self, dtype):
+        """
+        The dtype to allocate spectra in. For dtype None that is spectrumDtype(), or None while 
+        no spectra were decoded yet: only the metadata of the spectra tells the pixel format, 
+        so the arrays are allocated when the first chunk has arrived.
+        """
+        if(dtype is None):
+            if('pixelDataFormatCode' not in self._properties):
+                return None
+            return self.spectrumDtype()
+        return dtype
         
     def softwareTrigger(self):
         """
@@ -255,20 +1499,138 @@ class PyUSBSpectrometer(Spectrometer):
   
    
    
-    def getRawSpectra(self, maxNumberOfSpectra = 15):
+    def _startBuffering(self, bufferSize, triggerMode = 0, spectraPerTrigger = None):
+        """
+        Sets the spectrometer up for buffered acquisition. Returns the integration
+        time and the number of pixels. By default it measures continuously, with
+        bufferSize spectra per trigger.
+        """
+        if(self._liveViewThread is not None):
+            print('Stopping the live view for buffered acquisition.')
+            self.stopLiveView()
+        self.triggerMode(triggerMode)
+        
+        self.setBuffering(True)
+        self.clearBuffer()
+        integrationTime = self.getIntegrationTime()
+        spectrumLength = self.getNumberOfPixels()
+        
+        if(not self.isBuffering()):
+            print('A problem has occured with the buffer.')        
+        self.setBufferSize(bufferSize)
+        if(self.getBufferSize() != bufferSize):
+            print('Could not create buffer space. Requested buffer space: {}, currently: {}'.format(bufferSize, self.getBufferSize()))        
+        self.setNumberOfSpectraPerTrigger(bufferSize if spectraPerTrigger is None else spectraPerTrigger)
+        return integrationTime, spectrumLength
+        
+        
+    def _stopBuffering(self):
+        # Switched off first, so no spectra are added after the buffer is cleared.
+        self.setBuffering(False)
+        self.clearBuffer()
+        
+        
+    def _getRawSpectra(self, numberOfSpectra, asRecords = False):
+        """
+        Like getRawSpectra, but without asking how many spectra are in the buffer first.
+        Ask for at most the number of spectra in the buffer, an empty buffer gives an error 13.
+        """
+        with self._usbLock:
+            statistics = self._statistics
+            if(statistics is None):
+                byteSpectra = self._query('getSpectra', message = int(numberOfSpectra), zeroCopy = True)
+                return self._processRawSpectalData(byteSpectra, asRecords = asRecords)
+
+            startTime = time.perf_counter_ns()
+            byteSpectra = self._query('getSpectra', message = int(numberOfSpectra), zeroCopy = True)
+            transferTime = time.perf_counter_ns()
+            result = self._processRawSpectalData(byteSpectra, asRecords = asRecords)
+            statistics.transferTime += transferTime - startTime
+            statistics.decodeTime += time.perf_counter_ns() - transferTime
+            return result
+        
+   
+    def _nextChunk(self, flowController, remaining, integrityMonitor = None, fetch = None, pipeline = None):
+        """
+        One step of an acquisition loop. Asks for as many spectra as flowController advises, 
+        at most remaining, or waits if too few are in the buffer. Returns the header records 
+        and spectra, or None if it waited. The headers are checked by integrityMonitor.
+        fetch(numberOfSpectra) replaces _getRawSpectra, it returns headers and spectra as well.
+        With a _SpectraPipeline, see _nextPipelinedChunk.
+        """
+        if(pipeline is not None):
+            return self._nextPipelinedChunk(pipeline, flowController, remaining, integrityMonitor)
+        chunkSize = flowController.nextChunkSize(remaining)
+        if(chunkSize is None):
+            flowController.setNumberInBuffer(self.getNumberInBuffer())
+            chunkSize = flowController.nextChunkSize(remaining)
+        if(chunkSize == 0):
+            time.sleep(flowController.waitTime(remaining))
+            return None
+        
+        requestTime = time.perf_counter()
+        if(fetch is None):
+            chunkHeaders, chunkSpectra = self._getRawSpectra(chunkSize, asRecords = True)
+        else:
+            chunkHeaders, chunkSpectra = fetch(chunkSize)
+        flowController.update(chunkSize, chunkHeaders, time.perf_counter() - requestTime)
+        if(integrityMonitor is not None):
+            integrityMonitor.update(chunkHeaders)
+        return chunkHeaders, chunkSpectra
+        
+   
+    def _nextPipelinedChunk(self, pipeline, flowController, remaining, integrityMonitor = None):
+        """
+        _nextChunk with requests in flight. While fewer than pipeline.depth are in flight, new 
+        requests are sent as flowController advises, for the estimate of the buffer less the 
+        spectra asked for already. remaining includes those. Then the oldest reply is read. 
+        Nothing is sent after stopAcquisition(), so the loop can continue until none are in flight.
+        Neither while another thread waits for the USB lock, which it gets once the replies are read.
+        """
+        while(len(pipeline.inFlight) < pipeline.depth and not self._stopAcquisition.is_set()
+              and self._usbLock.waiting == 0):
+            chunkSize = flowController.nextChunkSize(remaining - pipeline.spectraInFlight, inFlight = pipeline.spectraInFlight)
+            if(chunkSize is None):
+                if(len(pipeline.inFlight) > 0):
+                    # The reply will tell.
+                    break
+                flowController.setNumberInBuffer(self.getNumberInBuffer())
+                continue
+            if(chunkSize == 0):
+                break
+            pipeline.send(chunkSize)
+            
+        if(len(pipeline.inFlight) == 0):
+            if(not self._stopAcquisition.is_set()):
+                time.sleep(flowController.waitTime(remaining))
+            return None
+        chunkHeaders, chunkSpectra, requested, latency = pipeline.receive()
+        flowController.update(requested, chunkHeaders, latency)
+        if(integrityMonitor is not None):
+            integrityMonitor.update(chunkHeaders)
+        return chunkHeaders, chunkSpectra
+        
+        
+    def _newPipeline(self):
+        if(self.requestsInFlight > 1):
+            return _SpectraPipeline(self, self.requestsInFlight)
+        return None
+        
+   
+    def getRawSpectra(self, maxNumberOfSpectra = 15, asRecords = False):
         """
         This method is as a discount. It gives UP TO the number of 
         requested spectra. 15 is the amount recommended by the
         manual. They claim 15 gives per request gives the highest
         throughput.
+        
+        The headers are a list of dictionaries, or a record array with 
+        spectrumHeaderDtype if asRecords is True.
         """
         
         spectraInBuffer = self.getNumberInBuffer()
         getSpectra = np.amin([spectraInBuffer, maxNumberOfSpectra])
-        
-        message = struct.pack('<I', getSpectra)        
-        byteSpectra = self._query('getSpectra', message = message)
-        return self._processRawSpectalData(byteSpectra)
+        return self._getRawSpectra(getSpectra, asRecords = asRecords)
         
    
         
@@ -282,21 +1644,22 @@ class PyUSBSpectrometer(Spectrometer):
         
         
     def setBufferSize(self, bufferSize):
-        bufferSize = np.amin([self.getMaximumBufferSize(), bufferSize])
+        bufferSize = int(np.amin([self.getMaximumBufferSize(), bufferSize]))
         message = struct.pack('<I', bufferSize)
-        self._query('setBufferSize', message = message)
+        answer = self._query('setBufferSize', message = message)
+        self._setProperty('bufferSize', bufferSize, answer)
 
-    def clearBuffer(self):
-        self._query('clearBuffer')
+    def clearBuffer(self, requestAck = True):
+        self._query('clearBuffer', requestAck = requestAck)
         
         
     def setNumberOfSpectraPerTrigger(self, numberOfSpectra):
         message = struct.pack('<I', numberOfSpectra)
-        self._query('setNumberOfSpectraPerTrigger', message = message)
+        answer = self._query('setNumberOfSpectraPerTrigger', message = message)
+        self._setProperty('numberOfSpectraPerTrigger', numberOfSpectra, answer)
         
     def getNumberOfSpectraPerTrigger(self):
-        answer = self._query('getNumberOfSpectraPerTrigger')
-        return struct.unpack('<I', answer[24:28])[0]            
+        return self._getProperty('numberOfSpectraPerTrigger', 'getNumberOfSpectraPerTrigger')
 
 
     def triggerMode(self, triggerMode):
@@ -315,7 +1678,8 @@ class PyUSBSpectrometer(Spectrometer):
         
 
         message = struct.pack('<I', triggerMode)
-        self._query('setTriggerMode', message = message)
+        answer = self._query('setTriggerMode', message = message)
+        self._setProperty('triggerMode', triggerMode, answer)
         
         
 
@@ -326,40 +1690,162 @@ class PyUSBSpectrometer(Spectrometer):
 
 
 
-    def burst(self, acquireNumberOfSpectra, dtype = np.float64):
+    def burst(self, acquireNumberOfSpectra, dtype = np.float64, reduction = None, out = None, headersOut = None):
+        """
+        Acquires acquireNumberOfSpectra spectra using the onboard buffer. Returns the headers 
+        as a record array with spectrumHeaderDtype, so headers['timeStamp'] is an array with
+        all time stamps, and the spectra as a 2D array. reduction, like a 
+        spectrumReduction.StreamingReduction, gets every chunk as well, see reducedBurst().
+        
+        With dtype None the spectra are kept in spectrumDtype(), as sent: uint16 for the FX, a 
+        quarter of the memory of float64. Convert them when needed, for example block by block 
+        with correctionPipeline().apply(), which returns float64.
+        out and headersOut are arrays, or slices of arrays, with room for acquireNumberOfSpectra 
+        spectra and headers. They are filled instead of new arrays, out in its own dtype.
+        If the burst is stopped, only the spectra acquired until then are returned.
+        """
         startTime = time.time()
     
         bufferSize = 50000
-        maximumChunkSize = 15
+        allocated = []
+        def allocateSpectra(spectraDtype):
+            allocated.append(np.empty((acquireNumberOfSpectra, spectrumLength), dtype = spectraDtype))
+            return allocated[0]
         
+        try:
+            integrationTime, spectrumLength = self._startBuffering(bufferSize)
+            if(headersOut is None):
+                headers = np.zeros(acquireNumberOfSpectra, dtype = spectrumHeaderDtype)
+            else:
+                headers = headersOut[:acquireNumberOfSpectra]
+            spectraDtype = self._spectraDtype(dtype)
+            if(out is not None):
+                spectra = out[:acquireNumberOfSpectra]
+            elif(spectraDtype is not None):
+                spectra = np.empty((acquireNumberOfSpectra, spectrumLength), dtype = spectraDtype)
+            else:
+                spectra = None
+            if(spectra is not None and spectra.shape != (acquireNumberOfSpectra, spectrumLength)):
+                raise ValueError('out has shape {}, expected {}.'.format(spectra.shape, (acquireNumberOfSpectra, spectrumLength)))
+            if(len(headers) != acquireNumberOfSpectra):
+                raise ValueError('headersOut has room for {} headers, expected {}.'.format(len(headers), acquireNumberOfSpectra))
+            
+            acquiredSpectra = self._acquireInto(headers, spectra, integrationTime, startTime, reduction = reduction, allocateSpectra = allocateSpectra)
+        finally:
+            self._stopBuffering()
         
-        self.triggerMode(0)
+        if(spectra is None):
+            spectra = allocated[0] if allocated else np.empty((acquireNumberOfSpectra, spectrumLength), dtype = self.spectrumDtype())
+        return headers[:acquiredSpectra], spectra[:acquiredSpectra]
         
-        self.setBuffering(True)
-        self.clearBuffer()
-        integrationTime = self.getIntegrationTime()
-        spectrumLength = self.getNumberOfPixels()
         
-
+    def reducedBurst(self, acquireNumberOfSpectra, reduction):
+        """
+        Like burst(), but the spectra are not kept. Every chunk is passed to reduction.update(headers, 
+        spectra) as it arrives, with the spectra in the dtype the spectrometer sends. reduction is for 
+        example a spectrumReduction.StreamingReduction. Returns reduction, which is complete when 
+        the burst is.
+        """
+        startTime = time.time()
+        bufferSize = 50000
+        try:
+            integrationTime, spectrumLength = self._startBuffering(bufferSize)
+            self._acquireInto(None, None, integrationTime, startTime, reduction = reduction, 
+                              acquireNumberOfSpectra = acquireNumberOfSpectra)
+        finally:
+            self._stopBuffering()
+        return reduction
         
         
-        if(not self.isBuffering()):
-            print('A problem has occured with the buffer.')        
-        self.setBufferSize(bufferSize)
-        if(self.getBufferSize() != bufferSize):
-            print('Could not create buffer space. Requested buffer space: {}, currently: {}'.format(bufferSize, self.getBufferSize()))        
-        self.setNumberOfSpectraPerTrigger(bufferSize)
-    
+    def recordBurst(self, fileName, acquireNumberOfSpectra, dtype = None):
+        """
+        Like burst(), but the spectra are written straight into a memory mapped .npy file, 
+        and the headers into a second file that ends with .headers.npy. The run can be larger 
+        than the memory. If the burst is stopped early, the files are shortened to the spectra 
+        that were acquired. Open them with np.load(fileName, mmap_mode='r').
+        
+        With dtype None the spectra are stored as sent, see spectrumDtype(), and the spectra
+        file is created when the first spectra tell the pixel format. Another dtype is cast to
+        unchecked, so only give one that holds the values. Returns the number of spectra recorded.
+        """
+        startTime = time.time()
+        
+        bufferSize = 50000
+        spectraFileName, headersFileName = self._recordingFileNames(fileName)
+        spectraDtype = self._spectraDtype(dtype)
+        # The headers memmap, and the spectra memmap once it is opened.
+        memmaps = []
+        def openSpectra(spectraDtype):
+            memmaps.append(np.lib.format.open_memmap(spectraFileName, mode = 'w+', dtype = spectraDtype, shape = (acquireNumberOfSpectra, spectrumLength)))
+            return memmaps[1]
+        
+        try:
+            integrationTime, spectrumLength = self._startBuffering(bufferSize)
+            memmaps.append(np.lib.format.open_memmap(headersFileName, mode = 'w+', dtype = spectrumHeaderDtype, shape = (acquireNumberOfSpectra,)))
+            acquiredSpectra = self._acquireInto(memmaps[0], None if spectraDtype is None else openSpectra(spectraDtype), 
+                                                integrationTime, startTime, allocateSpectra = openSpectra)
+            if(len(memmaps) == 1):
+                # Stopped before any spectrum told the pixel format.
+                openSpectra(self.spectrumDtype())
+        finally:
+            self._stopBuffering()
+            for memmap in memmaps:
+                memmap.flush()
+            # The files have to be unmapped before they can be shortened.
+            del memmaps[:]
+        
+        if(acquiredSpectra < acquireNumberOfSpectra):
+            _truncateNpyFile(spectraFileName, acquiredSpectra)
+            _truncateNpyFile(headersFileName, acquiredSpectra)
+        return acquiredSpectra
         
-
-            
         
-        headers = np.array([{} for i in range(acquireNumberOfSpectra)])
-        spectra = np.empty((acquireNumberOfSpectra, spectrumLength ),dtype=dtype)
+    @staticmethod
+    def _recordingFileNames(fileName):
+        if(not fileName.endswith('.npy')):
+            fileName = fileName + '.npy'
+        return fileName, fileName[:-4] + '.headers.npy'
         
         
-        chunkSize = np.amin([acquireNumberOfSpectra,maximumChunkSize])
-
+    def captureBurst(self, fileName, acquireNumberOfSpectra):
+        """
+        Like burst(), but the getSpectra replies are appended unchanged to fileName, and nothing
+        is decoded apart from the metadata the acquisition loop needs. An index with the offset
+        and length of every spectrum in the file is saved as fileName + '.index.npy', and the 
+        wavelengths as fileName + '.wavelengths.npy'. Open the capture with rawCapture.RawCapture.
+        Returns the number of spectra captured.
+        """
+        startTime = time.time()
+        bufferSize = 50000
+        writer = None
+        try:
+            integrationTime, spectrumLength = self._startBuffering(bufferSize)
+            writer = _RawCaptureWriter(self, fileName)
+            acquiredSpectra = self._acquireInto(None, None, integrationTime, startTime, 
+                                                acquireNumberOfSpectra = acquireNumberOfSpectra, fetch = writer.fetch)
+        finally:
+            self._stopBuffering()
+            if(writer is not None):
+                writer.close()
+        np.save(fileName + '.wavelengths.npy', self._wavelengths)
+        return acquiredSpectra
+        
+        
+    def _acquireInto(self, headers, spectra, integrationTime, startTime, reduction = None, acquireNumberOfSpectra = None, fetch = None,
+                     allocateSpectra = None):
+        """
+        The acquisition loop of burst(). Fills headers and spectra, which can be any array with
+        room for the spectra, like a memory map. Buffering has to be started already.
+        Returns the number of spectra acquired, which is less than len(spectra) if the burst
+        was stopped. Chunks are also passed to reduction.update(). Without headers and spectra 
+        (None), acquireNumberOfSpectra says how many spectra to acquire. fetch is passed on to _nextChunk.
+        Without fetch, requestsInFlight requests are kept in flight. If there are headers but
+        spectra is None, allocateSpectra(dtype) returns the spectra array, in the dtype of the
+        first chunk.
+        """
+        if(acquireNumberOfSpectra is None):
+            acquireNumberOfSpectra = len(headers)
+        maximumChunkSize = 100
         
         acquiredSpectra = 0
         
@@ -370,88 +1856,362 @@ class PyUSBSpectrometer(Spectrometer):
             #print('If there is any ERROR 13 from now on, there really is an ERROR 13.')
         
         
-        self.stopBurst = False
+        self._stopAcquisition.clear()
         self.clearBuffer()
-        startLoop = True
-        while(acquiredSpectra < acquireNumberOfSpectra):
-            inBuffer = self.getNumberInBuffer()
-            if( (acquireNumberOfSpectra - acquiredSpectra) < chunkSize):
-                chunkSize = (acquireNumberOfSpectra - acquiredSpectra)
-                
-            if(startLoop):
-                self.clearBuffer()
-                startLoop = False
-            while(self.getNumberInBuffer() < chunkSize  ):
-                time.sleep(1e-6 * integrationTime )
-            
-            chunkHeaders, chunkSpectra = self.getRawSpectra(chunkSize)
-            headers[acquiredSpectra:acquiredSpectra+chunkSize] = chunkHeaders
-            spectra[acquiredSpectra:acquiredSpectra+chunkSize] = chunkSpectra
-            acquiredSpectra += chunkSize
-            if(acquiredSpectra % 1000 == 0):
-                print('{} spectra acquired in {} s. {} in buffer.'.format(acquiredSpectra,time.time() - startTime, self.getNumberInBuffer()))
-            if(self.stopBurst):
-                self.stopBurst = False
-                break
-        
-        if(len(headers) > 1 and 'timeStamp' in headers[0] and 'timeStamp' in headers[-1]):
-            t0 = headers[0]['timeStamp']
-            t1 = headers[-1]['timeStamp']
-        else:
-            t0 = -999
-            t1 = 999
+        flowController = _FlowController(integrationTime, maximumChunkSize = maximumChunkSize)
+        integrityMonitor = self._newIntegrityMonitor(integrationTime)
+        # The capture writes the replies itself, one at a time.
+        pipeline = self._newPipeline() if fetch is None else None
+        lastPrintTime = time.perf_counter()
+        try:
+            while(acquiredSpectra < acquireNumberOfSpectra):
+                chunk = self._nextChunk(flowController, acquireNumberOfSpectra - acquiredSpectra, integrityMonitor, fetch = fetch, pipeline = pipeline)
+                if(chunk is not None and len(chunk[0]) > 0):
+                    chunkHeaders, chunkSpectra = chunk
+                    chunkSize = len(chunkHeaders)
+                    if(headers is not None):
+                        if(spectra is None):
+                            spectra = allocateSpectra(chunkSpectra.dtype)
+                        headers[acquiredSpectra:acquiredSpectra+chunkSize] = chunkHeaders
+                        spectra[acquiredSpectra:acquiredSpectra+chunkSize] = chunkSpectra
+                    if(reduction is not None):
+                        reduction.update(chunkHeaders, chunkSpectra)
+                    acquiredSpectra += chunkSize
+                    # Printing is slow, at most once per second.
+                    if(time.perf_counter() - lastPrintTime > 1.0):
+                        lastPrintTime = time.perf_counter()
+                        print('{} spectra acquired in {} s. About {:.0f} in buffer.'.format(acquiredSpectra,time.time() - startTime, flowController.estimatedNumberInBuffer() or 0))
+                # The replies in flight are still read after a stop.
+                if(self._stopAcquisition.is_set() and (pipeline is None or len(pipeline.inFlight) == 0)):
+                    break
+        finally:
+            if(pipeline is not None):
+                pipeline.close()
         
-        dt = 1e-3*(t1 - t0)/acquiredSpectra
-        self._deadTime = 1e3*dt - integrationTime # in us
+        deadTime = integrityMonitor.deadTime()
+        self._deadTime = -999 if deadTime is None else deadTime # in us
         totalTime = time.time() - startTime
-        print('{} spectra acquired in {:.4f} s.  Per spectrum T =  {:.4f} ms. {:.4f} kHz. (overhead is {:.4f} s)'.format(acquiredSpectra, totalTime, dt, 1/dt, totalTime - acquiredSpectra*dt*1e-3  ))
+        if(deadTime is not None):
+            dt = 1e-3 * integrityMonitor.meanDelta
+            print('{} spectra acquired in {:.4f} s.  Per spectrum T =  {:.4f} ms. {:.4f} kHz. (overhead is {:.4f} s)'.format(acquiredSpectra, totalTime, dt, 1/dt, totalTime - acquiredSpectra*dt*1e-3  ))
         print('Dead time: {:.4f} us'.format(self._deadTime))  
-        if(len(headers) > 2 and self._deadTime > 211.12455):
-            delays = np.diff([h['timeStamp'] for h in headers])
+        self._flowStatistics = flowController.statistics()
+        if(pipeline is not None):
+            self._flowStatistics['pipeline'] = pipeline.statistics()
+        print('{} requests with on average {:.1f} spectra, {} buffer queries. Request latency {:.3f} ms.'.format(
+            self._flowStatistics['numberOfRequests'], self._flowStatistics['meanChunkSize'], 
+            self._flowStatistics['numberOfStatusQueries'], 1e3 * self._flowStatistics['requestLatency']))
+        if(not integrityMonitor.isIntact()):
+            print('UNEXPECTED TIME STAMPS: {} gaps with {} missing spectra, {} time stamp differences off the period of {} us (min {} us, max {} us). Check buffer overflow, see getIntegrityReport().'.format(
+                integrityMonitor.numberOfGaps, integrityMonitor.missingSpectra, integrityMonitor.numberOfTimingErrors, 
+                integrityMonitor.expectedPeriod, integrityMonitor.minimumDelta, integrityMonitor.maximumDelta))
+        
+        return acquiredSpectra
+        
+        
+    def iterSpectra(self, chunkSize = 1000, numberOfSpectra = None, dtype = np.float64, numberOfBuffers = 2):
+        """
+        Generator for long acquisitions. Yields headers and spectra in blocks of chunkSize 
+        spectra as they arrive, until numberOfSpectra are acquired (without end if None) or 
+        until stopAcquisition() is called. Memory use only depends on chunkSize. With dtype
+        None the spectra are in spectrumDtype(), as sent.
+        
+        The blocks are views on numberOfBuffers preallocated buffers that are reused, so 
+        copy a block if it is still needed after the next numberOfBuffers - 1 blocks. The 
+        onboard buffer is cleared and switched off when the generator finishes or is closed, 
+        so also when a loop over it ends early.
+        """
+        bufferSize = 50000
+        maximumChunkSize = 100
+        
+        headerBuffers = [np.zeros(chunkSize, dtype = spectrumHeaderDtype) for i in range(numberOfBuffers)]
+        spectraDtype = self._spectraDtype(dtype)
+        spectraBuffers = None
+        acquiredSpectra = 0
+        bufferIndex = 0
+        try:
+            integrationTime, spectrumLength = self._startBuffering(bufferSize)
+            self.softwareTrigger()
+            self._stopAcquisition.clear()
+            self.clearBuffer()
+            flowController = _FlowController(integrationTime, maximumChunkSize = maximumChunkSize)
+            integrityMonitor = self._newIntegrityMonitor(integrationTime)
+            while(numberOfSpectra is None or acquiredSpectra < numberOfSpectra):
+                headers = headerBuffers[bufferIndex]
+                if(numberOfSpectra is None):
+                    blockSize = chunkSize
+                else:
+                    blockSize = min(chunkSize, numberOfSpectra - acquiredSpectra)
+                    
+                inBlock = 0
+                while(inBlock < blockSize and not self._stopAcquisition.is_set()):
+                    chunk = self._nextChunk(flowController, blockSize - inBlock, integrityMonitor)
+                    # An error reply is an empty chunk.
+                    if(chunk is None or len(chunk[0]) == 0):
+                        continue
+                    chunkHeaders, chunkSpectra = chunk
+                    if(spectraBuffers is None):
+                        if(spectraDtype is None):
+                            spectraDtype = chunkSpectra.dtype
+                        spectraBuffers = [np.empty((chunkSize, spectrumLength), dtype = spectraDtype) for i in range(numberOfBuffers)]
+                    spectra = spectraBuffers[bufferIndex]
+                    headers[inBlock:inBlock + len(chunkHeaders)] = chunkHeaders
+                    spectra[inBlock:inBlock + len(chunkHeaders)] = chunkSpectra
+                    inBlock += len(chunkHeaders)
+                    
+                acquiredSpectra += inBlock
+                if(inBlock > 0):
+                    yield headers[:inBlock], spectra[:inBlock]
+                if(self._stopAcquisition.is_set()):
+                    break
+                bufferIndex = (bufferIndex + 1) % numberOfBuffers
+        finally:
+            self._stopBuffering()
+        
+        
+    @property
+    def stopBurst(self):
+        """
+        Setting stopBurst to True does the same as stopAcquisition() for a burst in another thread.
+        Kept for scripts that set the flag directly.
+        """
+        return self._stopAcquisition.is_set()
+        
+    @stopBurst.setter
+    def stopBurst(self, value):
+        if(value):
+            self._stopAcquisition.set()
+        else:
+            self._stopAcquisition.clear()
+        
+        
+    def startAcquisition(self, ringSize = 100000, maximumChunkSize = 100, dtype = np.float64, ring = None):
+        """
+        Starts a thread that keeps emptying the onboard buffer into a ring of ringSize spectra,
+        so the onboard buffer does not overflow while the spectra are processed. Get the 
+        spectra with readAvailable(), and stop with stopAcquisition(). dtype None keeps the 
+        spectra in spectrumDtype() in the ring. ring replaces the ring, for example one in shared 
+        memory that another process reads, see multiSpectrometer.
+        """
+        if(self._acquisitionThread is not None):
+            print('Acquisition is already running.')
+            return
+        
+        bufferSize = 50000
+        integrationTime, spectrumLength = self._startBuffering(bufferSize)
+        if(ring is None):
+            ring = _SpectrumRing(ringSize, spectrumLength, dtype = self._spectraDtype(dtype))
+        self._ring = ring
+        
+        self.softwareTrigger()
+        self._stopAcquisition.clear()
+        self.clearBuffer()
+        self._acquisitionThread = threading.Thread(target = self._acquisitionLoop, args = (integrationTime, maximumChunkSize), 
+                                                   name = 'PyUSBSpectrometer acquisition', daemon = True)
+        self._acquisitionThread.start()
+        
+        
+    def _acquisitionLoop(self, integrationTime, maximumChunkSize):
+        flowController = _FlowController(integrationTime, maximumChunkSize = maximumChunkSize)
+        integrityMonitor = self._newIntegrityMonitor(integrationTime)
+        pipeline = self._newPipeline()
+        try:
+            while(not self._stopAcquisition.is_set() or (pipeline is not None and len(pipeline.inFlight) > 0)):
+                chunk = self._nextChunk(flowController, maximumChunkSize * self.requestsInFlight, integrityMonitor, pipeline = pipeline)
+                # An error reply is an empty chunk.
+                if(chunk is not None and len(chunk[0]) > 0):
+                    self._ring.write(*chunk)
+        except Exception as e:
+            print('Acquisition stopped: ', e)
+            self._stopAcquisition.set()
+        finally:
+            if(pipeline is not None):
+                pipeline.close()
+        self._flowStatistics = flowController.statistics()
+        if(pipeline is not None):
+            self._flowStatistics['pipeline'] = pipeline.statistics()
             
-            mint = np.amin(delays)
-            maxt = np.amin(delays)
-            minIndex = np.argmin(delays)
-            maxIndex = np.argmax(delays)
-            print('Large dead time {:.1f}. Largest difference between time stamps: {}.'.format(self._deadTime, maxt-mint))
             
-            if(maxt- mint > 2 ):
-               
-                print('\n\n\nUNEXPECTED TIME STAMP. Integation time changed, or spectrum skipped. Check buffer overflow.\n\n')
-                print('Unexpected time delay. Min Delta t ({}): {:.2f}, max Delta t ({}): {:.2f}'.format(minIndex, mint,maxIndex, maxt))
-                print('Difference: ', maxt- mint)
-                print('\n\n')
-                winsound.Beep(1047, 63) 
-                winsound.Beep(1047, 63) 
-                winsound.Beep(1047, 63) 
-                winsound.Beep(1047, 63)
+    def readAvailable(self, maxNumberOfSpectra = None):
+        """
+        Returns the headers and spectra acquired since the last call, at most maxNumberOfSpectra.
+        """
+        if(self._ring is None):
+            return np.zeros(0, dtype = spectrumHeaderDtype), np.empty((0, 0))
+        return self._ring.read(maxNumberOfSpectra)
+        
+        
+    def numberOfDroppedSpectra(self):
+        """
+        Number of spectra read from the spectrometer that did not fit in the ring, because
+        readAvailable() was not called often enough.
+        """
+        if(self._ring is None):
+            return 0
+        return self._ring.droppedSpectra
+        
+        
+    def stopAcquisition(self):
+        """
+        Stops the acquisition thread, a triggered acquisition, or a burst running in another thread.
+        """
+        self._stopAcquisition.set()
+        if(self._acquisitionThread is not None):
+            self._acquisitionThread.join()
+            self._acquisitionThread = None
+            self._stopBuffering()
+            
             
+    def startTriggeredAcquisition(self, spectraPerTrigger = 1, triggerMode = 3, callback = None, maximumChunkSize = 100,
+                                  dtype = np.float64, pollInterval = None, maximumEvents = 10000):
+        """
+        Acquires spectraPerTrigger spectra for every trigger, in triggerMode (see triggerMode(), 
+        3 is the hardware trigger input), and delivers them per trigger as soon as the last one 
+        is in. The events are dictionaries with the headers and spectra of one trigger, see 
+        _TriggerGrouper, and the latency from the trigger to the delivery in s. They go to 
+        callback(event), which runs on the acquisition thread and should be quick, or without 
+        callback to a queue of maximumEvents events that is read with readEvent().
+        
+        Between triggers nothing is asked from the spectrometer. The thread sleeps until the 
+        next event should be complete, from the trigger period measured so far, and asks for 
+        the spectra right away, without getNumberInBuffer. While no trigger comes it asks again after
+        pollInterval s, by default see _TriggerGrouper.pollInterval(), and backs off from there
+        while the replies stay empty. Stop with stopAcquisition().
+        """
+        if(self._acquisitionThread is not None):
+            print('Acquisition is already running.')
+            return
         
+        bufferSize = 50000
+        self._startBuffering(bufferSize, triggerMode = triggerMode, spectraPerTrigger = spectraPerTrigger)
+        self._triggerGrouper = _TriggerGrouper(spectraPerTrigger, _ClockOffset())
+        self._triggerEvents = queue.Queue(maximumEvents) if callback is None else None
+        self._triggerStatistics = {'droppedEvents' : 0, 'numberOfRequests' : 0, 'latencies' : collections.deque(maxlen = 10000)}
         
+        self._stopAcquisition.clear()
         self.clearBuffer()
-        self.setBuffering(False)
+        self._acquisitionThread = threading.Thread(target = self._triggeredLoop, 
+                                                   args = (callback, maximumChunkSize, self._spectraDtype(dtype), pollInterval), 
+                                                   name = 'PyUSBSpectrometer triggered acquisition', daemon = True)
+        self._acquisitionThread.start()
         
-        return headers, spectra
+        
+    def _triggeredLoop(self, callback, maximumChunkSize, dtype, pollInterval):
+        grouper = self._triggerGrouper
+        # The pipeline takes an empty buffer (error 13) as an empty reply, where _query would print it.
+        pipeline = _SpectraPipeline(self, 1)
+        nextReadTime = time.perf_counter()
+        try:
+            while(not self._stopAcquisition.is_set()):
+                waitTime = nextReadTime - time.perf_counter()
+                if(waitTime > 0 and self._stopAcquisition.wait(waitTime)):
+                    break
+                sendTime = time.perf_counter()
+                pipeline.send(maximumChunkSize)
+                headers, spectra, numberOfSpectra, latency = pipeline.receive()
+                arrivalTime = time.perf_counter()
+                self._triggerStatistics['numberOfRequests'] += 1
+                grouper.clockOffset.update(arrivalTime, headers, sendTime = sendTime)
+                if(dtype is not None):
+                    spectra = spectra.astype(dtype, copy = False)
+                for event in grouper.add(headers, spectra):
+                    self._deliverEvent(event, callback)
+                if(len(headers) == numberOfSpectra):
+                    # There may be more in the buffer.
+                    nextReadTime = arrivalTime
+                else:
+                    nextReadTime = grouper.nextReadTime(arrivalTime, pollInterval)
+            event = grouper.flush()
+            if(event is not None):
+                self._deliverEvent(event, callback)
+        except Exception as e:
+            print('Triggered acquisition stopped: ', e)
+            self._stopAcquisition.set()
+        finally:
+            pipeline.close()
+        self._triggerStatistics['pipeline'] = pipeline.statistics()
+        
+        
+    def _deliverEvent(self, event, callback):
+        event['latency'] = time.perf_counter() - event['triggerTime']
+        self._triggerStatistics['latencies'].append(event['latency'])
+        if(callback is not None):
+            callback(event)
+            return
+        try:
+            self._triggerEvents.put_nowait(event)
+        except queue.Full:
+            self._triggerStatistics['droppedEvents'] += 1
+            
+            
+    def readEvent(self, timeout = None):
+        """
+        The next event of a triggered acquisition, waiting at most timeout s for it (forever if 
+        None). Returns None if there is none.
+        """
+        if(self._triggerEvents is None):
+            return None
+        try:
+            return self._triggerEvents.get(timeout = timeout)
+        except queue.Empty:
+            return None
+            
+            
+    def getTriggerStatistics(self):
+        """
+        The events, incomplete events and lost spectra of the last triggered acquisition, the
+        events that did not fit in the queue, the measured periods in us, the number of 
+        getSpectra requests and the trigger to delivery latency in s over the last 10000 events.
+        """
+        grouper = self._triggerGrouper
+        if(grouper is None):
+            return {}
+        statistics = {'numberOfEvents' : grouper.numberOfEvents,
+                      'numberOfIncompleteEvents' : grouper.numberOfIncompleteEvents,
+                      'missingSpectra' : grouper.missingSpectra,
+                      'droppedEvents' : self._triggerStatistics['droppedEvents'],
+                      'period' : grouper.period,
+                      'triggerPeriod' : grouper.triggerPeriod(),
+                      'numberOfRequests' : self._triggerStatistics['numberOfRequests']}
+        latencies = np.array(self._triggerStatistics['latencies'])
+        latencies = latencies[np.isfinite(latencies)]
+        if(len(latencies) > 0):
+            statistics['latency'] = {'mean' : float(latencies.mean()),
+                                     'median' : float(np.median(latencies)),
+                                     'p99' : float(np.percentile(latencies, 99)),
+                                     'max' : float(latencies.max())}
+        if('pipeline' in self._triggerStatistics):
+            statistics['pipeline'] = self._triggerStatistics['pipeline']
+        return statistics
                
 
         
         
-    def _query(self, query, message = 0, writeEndpoint = 0x01, readEndpoint = 0x81):
+    def _query(self, query, message = 0, writeEndpoint = 0x01, readEndpoint = 0x81, requestAck = True, zeroCopy = False):
+        """
+        Sends a command and returns the reply. With requestAck False, the spectrometer does not
+        reply to commands that return no data, so nothing is read and None is returned. Only use
+        that for commands that set something.
+        
+        With zeroCopy the reply is a memoryview on a buffer that is reused for the next reply. 
+        Hold self._usbLock until the reply is not needed anymore.
+        """
         if(type(query) == str):
             messageType = self._commands[query]
         else:
             messageType = query
         
-        answer =  self._queryPyUSB(messageType, message = message, writeEndpoint = writeEndpoint, readEndpoint = readEndpoint)
+        answer =  self._queryPyUSB(messageType, message = message, writeEndpoint = writeEndpoint, readEndpoint = readEndpoint, 
+                                   requestAck = requestAck, zeroCopy = zeroCopy)
         
-        if(answer[6:8] != b'\x00\x00'):
+        if(answer is not None and answer[6:8] != b'\x00\x00'):
             errorCode = struct.unpack('<H', answer[6:8])[0]
             if(errorCode in self._errorMessages):
                 errorMessage = self._errorMessages[errorCode]
             else:
                 errorMessage = ''
             print('ERROR: '.format(errorMessage, errorCode) )
-            command = answer[8:12]
+            command = bytes(answer[8:12])
             commandString = ''
             
             if(errorMessage == ''):
@@ -466,101 +2226,293 @@ class PyUSBSpectrometer(Spectrometer):
         return answer
     
 
-    def _queryPyUSB(self, messageType, message = 0, writeEndpoint = 0x01, readEndpoint = 0x81):
-
-        if(type(message) == int):
-            message = struct.pack('<I', message)
-        elif(message is None):
+    def _encodeRequest(self, messageType, message, requestAck = True, regarding = 0):
+        """
+        Returns the request for messageType with message as immediate data. message is
+        bytes, or an int that is sent as U32. Only the immediate data and the regarding field 
+        of the template for the command are overwritten, so the request has to be sent before 
+        the next call. Messages longer than 16 bytes do not fit in the immediate data, those 
+        are made by makeOBPMessage, with regarding 0.
+        """
+        isInt = isinstance(message, (int, np.integer))
+        if(not isInt and len(message) > 16):
+            return self.makeOBPMessage(message, messageType, requestAck = requestAck)
+        
+        template = self._requestTemplates.get((messageType, requestAck))
+        if(template is None):
+            template = array.array('B', self.makeOBPMessage(b'', messageType, requestAck = requestAck))
+            self._requestTemplates[(messageType, requestAck)] = template
+        _regarding.pack_into(template, 12, regarding)
+        if(isInt):
+            _immediateInt.pack_into(template, 23, 4, message)
+        else:
+            _immediateBytes.pack_into(template, 23, len(message), message)
+        return template
+        
+        
+    def _resizedReadBuffer(self, size):
+        """
+        Returns self._readBuffer with length size. pyusb reads as many bytes as the array is 
+        long. Shrinking and growing within the allocated memory does not reallocate the array.
+        """
+        readBuffer = self._readBuffer
+        if(len(readBuffer) > size):
+            del readBuffer[size:]
+        elif(len(readBuffer) < size):
+            readBuffer.frombytes(bytes(size - len(readBuffer)))
+        return readBuffer
+        
+        
+    def _queryPyUSB(self, messageType, message = 0, writeEndpoint = 0x01, readEndpoint = 0x81, requestAck = True, zeroCopy = False):
+        """
+        Sends a request with _writeRequest and reads the reply with _readReply. The reply is a 
+        memoryview on a reused buffer with zeroCopy, otherwise a copy as bytes.
+        """
+        if(message is None):
             message = b''
-        message = self.makeOBPMessage(message, messageType)
-        self._spectrometer.write(writeEndpoint,message, 100)
-        response = self._spectrometer.read(readEndpoint, 100)
-        response = response.tobytes()
-        remainingBytes = struct.unpack('<I', response[40:44])[0] - 20
-        if(remainingBytes > 0):
-            response = response +  self._spectrometer.read(readEndpoint, remainingBytes).tobytes()
+        with self._usbLock:
+            statistics = self._statistics
+            if(statistics is not None):
+                startTime = time.perf_counter_ns()
+            requestLength = self._writeRequest(messageType, message, writeEndpoint = writeEndpoint, requestAck = requestAck)
+            if(not requestAck):
+                if(statistics is not None):
+                    statistics.record(messageType, time.perf_counter_ns() - startTime, requestLength, 0, 0)
+                return None
+            response = self._readReply(readEndpoint)
+            if(statistics is not None):
+                statistics.record(messageType, time.perf_counter_ns() - startTime, requestLength, len(response),
+                                  struct.unpack_from('<H', response, 6)[0])
+            if(not zeroCopy):
+                response = bytes(response)
         
         if(response[6:8] != b'\x00\x00'):
             print('ERROR CODE: ', struct.unpack('<H', response[6:8])[0] )
-            print('Problem with command: ', response[8:12] )
+            print('Problem with command: ', bytes(response[8:12]) )
             if(messageType != response[8:12] ):
                 print('Problem with command: ', messageType)
         return response
+        
+        
+    def _writeRequest(self, messageType, message, writeEndpoint = 0x01, requestAck = True, regarding = 0):
+        """
+        Sends a request without reading the reply. Returns the length of the request.
+        Hold self._usbLock until the reply is read.
+        """
+        request = self._encodeRequest(messageType, message, requestAck = requestAck, regarding = regarding)
+        self._spectrometer.write(writeEndpoint, request, 100)
+        return len(request)
+        
+        
+    def _readReply(self, readEndpoint = 0x81):
+        """
+        Reads the next reply. The first read gives the 44 byte OBP header and the first 20 bytes 
+        after it. The header tells how many bytes are remaining. pyusb can only read into the 
+        start of an array, so the rest is read into a reused array and copied once behind the 
+        header in self._responseBuffer. Returns a memoryview on that buffer, which is reused 
+        for the next reply.
+        """
+        headerLength = self._spectrometer.read(readEndpoint, self._headerBuffer)
+        remainingBytes = struct.unpack_from('<I', self._headerBuffer, 40)[0] - 20
+        if(remainingBytes > 0):
+            readBuffer = self._resizedReadBuffer(remainingBytes)
+            remainingBytes = self._spectrometer.read(readEndpoint, readBuffer)
+        else:
+            remainingBytes = 0
+        
+        responseLength = headerLength + remainingBytes
+        if(len(self._responseBuffer) < responseLength):
+            # A new buffer, because a memoryview on the old one may still exist.
+            self._responseBuffer = bytearray(responseLength)
+        response = memoryview(self._responseBuffer)[:responseLength]
+        response[:headerLength] = memoryview(self._headerBuffer)[:headerLength]
+        if(remainingBytes > 0):
+            response[headerLength:] = memoryview(self._readBuffer)[:remainingBytes]
+        return response
             
     
     
 
     @staticmethod
-    def _parseRawSpectrum(rawByteString):
-        header = {}
+    def _headersFromMetaData(metaData):
+        """
+        Converts a record array with metadata (see _metaDataDtype) into a list of header dictionaries.
+        """
+        headers = []
+        for (protocol, metaDataLengthBytes, spectrumLengthBytes, timeStamp, integrationTime, pixelDataFormatCode, 
+                spectrumIndex, lastSpectrumIndex, timeStampLastSpectrum, numberOfAveraging) in metaData.tolist():
+            pixelDataFormat, bytePerDatapoint = _pixelDataFormats[pixelDataFormatCode][:2]
+            headers.append({'protocol' : protocol,
+                            'metaDataLengthBytes' : metaDataLengthBytes,
+                            'spectrumLength' : spectrumLengthBytes // bytePerDatapoint,
+                            'timeStamp' : timeStamp,
+                            'integrationTime' : integrationTime,
+                            'pixelDataFormatCode' : pixelDataFormatCode,
+                            'pixelDataFormat' : pixelDataFormat,
+                            'bytePerDatapoint' : bytePerDatapoint,
+                            'spectrumIndex' : spectrumIndex,
+                            'lastSpectrumIndex' : lastSpectrumIndex, # index of spectrum that is measured when this spectrum was grabbed from the spectrometer
+                            'timeStampLastSpectrum' : timeStampLastSpectrum, # heuristic for grabbing (not measuring time, but the time at grab.) time. Does not seem to work, though.
+                            'numberOfAveraging' : numberOfAveraging,
+                            'spectrumLengthBytes' : spectrumLengthBytes})
+        return headers
+        
+        
+    @staticmethod
+    def _headerRecordsFromMetaData(metaData, headers = None):
+        """
+        Copies a record array with metadata (see _metaDataDtype) into headers, a record array
+        with spectrumHeaderDtype. A new array is made if headers is None.
+        """
+        if(headers is None):
+            headers = np.empty(len(metaData), dtype = spectrumHeaderDtype)
+        for name in _metaDataDtype.names:
+            headers[name] = metaData[name]
+        headers['bytePerDatapoint'] = _bytesPerDatapoint[metaData['pixelDataFormatCode']]
+        headers['spectrumLength'] = metaData['spectrumLengthBytes'] // headers['bytePerDatapoint']
+        return headers
+        
+        
+    @staticmethod
+    def _convertPixels(pixels, pixelDataFormatCode):
+        """
+        Converts the pixels field of _frameDtype to spectra. Always returns a copy, so the
+        result does not refer to the buffer with the USB data.
+        """
+        if(_pixelDataFormats[pixelDataFormatCode][1] == 3):
+            padded = np.zeros(pixels.shape[:-1] + (4,), dtype = np.uint8)
+            padded[..., :3] = pixels
+            return padded.view('<u4').reshape(pixels.shape[:-1]).astype(np.uint32, copy = False)
+        return pixels.astype(_pixelDataFormats[pixelDataFormatCode][3])
+        
         
-        dataFormats = ['U16', 'U24', 'U32', 'SPFP'] #unsigned integer 16, 24, 32. single precision floating point.
-        bytesPerDatapoints = [2,3,4,8]
-        header['protocol'] = struct.unpack('<H', rawByteString[0:2])[0]
-        header['metaDataLengthBytes'] = struct.unpack('<H', rawByteString[2:4])[0]
-        if(header['metaDataLengthBytes'] != 64):
+    @staticmethod
+    def _parseRawSpectrum(rawByteString):
+        metaData = np.frombuffer(rawByteString, dtype = _metaDataDtype, count = 1)
+        if(metaData['metaDataLengthBytes'][0] != 64):
             print('Unexpected metadata length.')
-        header['spectrumLength'] = struct.unpack('<I', rawByteString[4:8])[0]
-        header['timeStamp'] = struct.unpack('<Q', rawByteString[8:16])[0]
-        header['integrationTime'] = struct.unpack('<I', rawByteString[16:20])[0]
-        header['pixelDataFormatCode'] = struct.unpack('<I', rawByteString[20:24])[0]
-        header['pixelDataFormat'] = dataFormats[header['pixelDataFormatCode']-1]
-        header['bytePerDatapoint'] = bytesPerDatapoints[header['pixelDataFormatCode']-1]
-        header['spectrumIndex'] = struct.unpack('<I', rawByteString[24:28])[0]
-        # index of spectrum that is measured when this spectrum was grabbed from the spectrometer
-        header['lastSpectrumIndex'] = struct.unpack('<I', rawByteString[28:32]) [0]
-        header['timeStampLastSpectrum'] = struct.unpack('<Q', rawByteString[32:40])[0]# heuristic for grabbing (not measuring time, but the time at grab.) time. Does not seem to work, though.
-        header['numberOfAveraging'] = struct.unpack('<H', rawByteString[40:42])[0]
-        header['spectrumLengthBytes'] = header['spectrumLength']
-        
-        header['spectrumLength'] //= header['bytePerDatapoint']
-        
-
-        
-        if(header['pixelDataFormat'] == 'U16'):
-            spectrum = np.empty(header['spectrumLength'], dtype = np.uint16)
-            structFormat = '<H'    
-        elif(header['pixelDataFormat'] == 'U24'):
-            spectrum = np.empty(header['spectrumLength'], dtype = np.uint32) #no uint24
-            structFormat = ''
-        elif(header['pixelDataFormat'] == 'U32'):
-            spectrum = np.empty(header['spectrumLength'], dtype = np.uint32)
-            structFormat = '<H'
-        elif(header['pixelDataFormat'] == 'SPFP'):
-            spectrum = np.empty(header['spectrumLength'], dtype = float)
-            structFormat = '<f'
-        else:
-            print('Data type not recognised.')
-            
-        if(structFormat == ''):
-            for i in range(header['spectrumLength']):
-                spectrum[i] = int.from_bytes(rawByteString[64:header['spectrumLengthBytes']+64][3*i:3*i+3],'little',signed=False)
-        else:
-            iterator = struct.iter_unpack(structFormat,rawByteString[64:header['spectrumLengthBytes']+64])
-            for i in range(header['spectrumLength']):
-                spectrum[i] = next(iterator)[0]                
+        pixelDataFormatCode = int(metaData['pixelDataFormatCode'][0])
+        frame = np.frombuffer(rawByteString, dtype = _frameDtype(pixelDataFormatCode, int(metaData['spectrumLengthBytes'][0])), count = 1)
+        header = PyUSBSpectrometer._headersFromMetaData(metaData)[0]
+        spectrum = PyUSBSpectrometer._convertPixels(frame['pixels'], pixelDataFormatCode)[0]
         return header, spectrum
 
 
+    @staticmethod
+    def _frameLayout(byteString):
+        """
+        Finds the spectra in the frames of a getSpectra reply, like decodeRawSpectra, without 
+        converting the pixels. Returns a copy of the metadata, and the offset in byteString and 
+        the length in bytes (metadata and pixels) of every spectrum.
+        """
+        if(len(byteString) < 64):
+            return np.empty(0, dtype = _metaDataDtype), np.empty(0, dtype = np.int64), np.empty(0, dtype = np.int64)
+        
+        spectrumLengthBytes = int(np.frombuffer(byteString, dtype = _metaDataDtype, count = 1)['spectrumLengthBytes'][0])
+        stride = 64 + spectrumLengthBytes + 4
+        numberOfSpectra = (len(byteString) + 4) // stride
+        metaData = np.ndarray((numberOfSpectra,), dtype = _metaDataDtype, buffer = byteString, strides = (stride,))
+        # The 4 bytes after the last spectrum may be cut off, as in decodeRawSpectra.
+        if(len(byteString) - numberOfSpectra * stride <= 0 and 
+                np.all(metaData['metaDataLengthBytes'] == 64) and 
+                np.all(metaData['spectrumLengthBytes'] == spectrumLengthBytes)):
+            offsets = np.arange(numberOfSpectra, dtype = np.int64) * stride
+            return metaData.copy(), offsets, np.full(numberOfSpectra, 64 + spectrumLengthBytes, dtype = np.int64)
+        
+        # Spectra of different lengths, one by one.
+        metaData = []
+        offsets = []
+        offset = 0
+        while(len(byteString) - offset >= 64):
+            frameMetaData = np.frombuffer(byteString, dtype = _metaDataDtype, count = 1, offset = offset)
+            frameLength = int(frameMetaData['metaDataLengthBytes'][0]) + int(frameMetaData['spectrumLengthBytes'][0])
+            if(offset + frameLength > len(byteString)):
+                break
+            metaData.append(frameMetaData)
+            offsets.append(offset)
+            offset += frameLength + 4
+        if(len(metaData) == 0):
+            return np.empty(0, dtype = _metaDataDtype), np.empty(0, dtype = np.int64), np.empty(0, dtype = np.int64)
+        metaData = np.concatenate(metaData)
+        lengths = metaData['metaDataLengthBytes'].astype(np.int64) + metaData['spectrumLengthBytes']
+        return metaData, np.array(offsets, dtype = np.int64), lengths
+        
+        
+    @staticmethod
+    def decodeRawSpectra(byteString, numberOfPixels = 0):
+        """
+        Decodes all spectra of a getSpectra reply at once. byteString starts at the first
+        metadata block, so without the 44 byte OBP header. Each spectrum is followed by 4
+        bytes, which may be cut off for the last spectrum.
+        
+        All spectra in a reply have the same length and pixel format, so the reply is read
+        as an array of fixed size records. Returns the metadata as a record array 
+        (see _metaDataDtype) and the spectra as a 2D array. Raises a ValueError if the 
+        spectra in the reply are not alike. Without spectra, the spectra are an empty U16 array
+        with numberOfPixels columns.
+        """
+        if(len(byteString) < 64):
+            return np.empty(0, dtype = _metaDataDtype), np.empty((0, numberOfPixels), dtype = _pixelDataFormats[1][3])
+        
+        firstMetaData = np.frombuffer(byteString, dtype = _metaDataDtype, count = 1)[0]
+        pixelDataFormatCode = int(firstMetaData['pixelDataFormatCode'])
+        spectrumLengthBytes = int(firstMetaData['spectrumLengthBytes'])
+        frameDtype = _frameDtype(pixelDataFormatCode, spectrumLengthBytes)
+        stride = frameDtype.itemsize + 4
+        numberOfSpectra = (len(byteString) + 4) // stride
+        
+        frames = np.ndarray((numberOfSpectra,), dtype = frameDtype, buffer = byteString, strides = (stride,))
+        metaData = frames['metaData']
+        if(len(byteString) - numberOfSpectra * stride > 0 or
+                np.any(metaData['metaDataLengthBytes'] != 64) or 
+                np.any(metaData['spectrumLengthBytes'] != spectrumLengthBytes) or 
+                np.any(metaData['pixelDataFormatCode'] != pixelDataFormatCode)):
+            raise ValueError('Spectra in one reply have a different format.')
+            
+        return metaData.copy(), PyUSBSpectrometer._convertPixels(frames['pixels'], pixelDataFormatCode)
+
     
-    def _processRawSpectalData(self, byteString):
-        if(byteString[0] == 193 and byteString[1] == 192):
-            byteString = byteString[44:-24]
+    @staticmethod
+    def _decodeRawSpectraOneByOne(byteString):
+        """
+        Slow path of decodeRawSpectra for replies with spectra of different lengths.
+        Returns the metadata as a record array and the spectra as a list.
+        """
+        metaData = []
         spectra = []
-        headers = []
-        
-        while(len(byteString) > 0):
+        offset = 0
+        while(offset < len(byteString)):
             
-            if(len(byteString) < 129 and len(byteString) > 0 ):
-                print('Groot probleem. ', len(byteString) )
+            if(len(byteString) - offset < 129):
+                print('Groot probleem. ', len(byteString) - offset )
                 break
             else:
-                header, spectrum = self._parseRawSpectrum(byteString)
-                headers.append(header)
+                metaData.append(np.frombuffer(byteString, dtype = _metaDataDtype, count = 1, offset = offset))
+                header, spectrum = PyUSBSpectrometer._parseRawSpectrum(byteString[offset:])
                 spectra.append(spectrum)
 
-                byteString = byteString[header['metaDataLengthBytes'] +header['spectrumLengthBytes']+4: ]    
-        return headers, spectra
+                offset += header['metaDataLengthBytes'] +header['spectrumLengthBytes']+4
+        if(len(metaData) == 0):
+            return np.empty(0, dtype = _metaDataDtype), spectra
+        return np.concatenate(metaData), spectra
+        
+    
+    def _processRawSpectalData(self, byteString, asRecords = False):
+        if(byteString[0] == 193 and byteString[1] == 192):
+            byteString = memoryview(byteString)[44:-24]
+        try:
+            metaData, spectra = self.decodeRawSpectra(byteString)
+        except ValueError as e:
+            print(e, 'Decoding spectra one by one.')
+            metaData, spectra = self._decodeRawSpectraOneByOne(byteString)
+        if(len(metaData) > 0):
+            self._properties['pixelDataFormatCode'] = int(metaData['pixelDataFormatCode'][-1])
+        else:
+            spectra = np.empty((0, self.getNumberOfPixels()), dtype = self.spectrumDtype())
+        
+        if(asRecords):
+            return self._headerRecordsFromMetaData(metaData), spectra
+        return self._headersFromMetaData(metaData), spectra
 
 
     @staticmethod
@@ -611,3 +2563,11 @@ class PyUSBSpectrometer(Spectrometer):
     
     def wavelengths(self):
         return self._wavelengths
+        
+    def correctionPipeline(self, targetWavelengths = None, dark = None, nonlinearity = None, gain = None):
+        """
+        Returns a spectrumCorrection.CorrectionPipeline for the wavelengths of this spectrometer.
+        Its apply() corrects the spectra of a burst, or the blocks of iterSpectra(), in one go.
+        """
+        return CorrectionPipeline(self.wavelengths(), targetWavelengths = targetWavelengths, dark = dark, 
+                                  nonlinearity = nonlinearity, gain = gain)
@@ -0,0 +1,96 @@
+"""
+Replays a capture made by PyUSBSpectrometer.captureBurst().
+
+    capture = RawCapture('run.obp')
+    headers, spectra = capture.read(1000, 2000)
+    headers, spectra = capture.decodeAll(numberOfProcesses = 8)
+
+The capture file holds the getSpectra replies as they came from the spectrometer. The index next
+to it gives the offset and length of every spectrum, so any range of spectra is decoded without
+reading the rest of the file.
+"""
+import os
+import numpy as np
+
+from pyUSBSpectrometer import PyUSBSpectrometer, _frameDtype, _metaDataDtype, spectrumHeaderDtype
+from parallelDecoding import ParallelDecoder
+
+
+class RawCapture(object):
+    """
+    Decodes spectra of a capture file on demand. The file is memory mapped, only the spectra
+    that are read are decoded. The headers are a record array with spectrumHeaderDtype, as
+    from burst().
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.index = np.load(fileName + '.index.npy')
+        if(os.path.getsize(fileName) > 0):
+            self._data = np.memmap(fileName, dtype = np.uint8, mode = 'r')
+        else:
+            self._data = np.zeros(0, dtype = np.uint8)
+        if(os.path.exists(fileName + '.wavelengths.npy')):
+            self.wavelengths = np.load(fileName + '.wavelengths.npy')
+        else:
+            self.wavelengths = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        if(not isinstance(key, slice) or key.step not in (None, 1)):
+            raise TypeError('Read a capture with a range of spectra, like capture[100:200].')
+        start, stop, step = key.indices(len(self))
+        return self.read(start, stop)
+
+    def read(self, start = 0, stop = None):
+        """
+        Decodes spectra start up to stop. Returns the headers and the spectra as a 2D array.
+        If the spectra in the range differ in length or pixel format, the spectra are a list.
+        """
+        if(stop is None or stop > len(self)):
+            stop = len(self)
+        index = self.index[start:max(start, stop)]
+        if(len(index) == 0):
+            return np.zeros(0, dtype = spectrumHeaderDtype), np.empty((0, 0))
+
+        frameLength = int(index['length'][0])
+        if(np.all(index['length'] == frameLength)):
+            frames = self._data[index['offset'].astype(np.int64)[:, None] + np.arange(frameLength)]
+            metaData = frames[:, :64].copy().view(_metaDataDtype)[:, 0]
+            pixelDataFormatCode = int(metaData['pixelDataFormatCode'][0])
+            if(np.all(metaData['pixelDataFormatCode'] == pixelDataFormatCode)):
+                decoded = frames.view(_frameDtype(pixelDataFormatCode, frameLength - 64))[:, 0]
+                spectra = PyUSBSpectrometer._convertPixels(decoded['pixels'], pixelDataFormatCode)
+                return PyUSBSpectrometer._headerRecordsFromMetaData(metaData), spectra
+
+        metaData = []
+        spectra = []
+        for offset, length in index.tolist():
+            frame = self._data[offset:offset + length]
+            metaData.append(np.frombuffer(frame, dtype = _metaDataDtype, count = 1))
+            spectra.append(PyUSBSpectrometer._parseRawSpectrum(frame)[1])
+        return PyUSBSpectrometer._headerRecordsFromMetaData(np.concatenate(metaData)), spectra
+
+    def iterChunks(self, chunkSize = 1000):
+        """
+        Yields the headers and spectra in chunks of chunkSize spectra, for example to run them
+        through a StreamingReduction or a CorrectionPipeline as if they were acquired again.
+        """
+        for start in range(0, len(self), chunkSize):
+            yield self.read(start, start + chunkSize)
+
+    def decodeAll(self, numberOfProcesses = None, chunkSize = 20000):
+        """
+        Decodes the whole capture on a ParallelDecoder with numberOfProcesses processes (all
+        cores if None), chunkSize spectra per task. The workers map the capture file and write
+        into shared memory, which is copied once into the arrays that are returned.
+        """
+        if(len(self) <= chunkSize or np.any(self.index['length'] != self.index['length'][0])):
+            return self.read()
+        offset = int(self.index['offset'][0])
+        pixelDataFormatCode = int(np.frombuffer(self._data[offset:offset + 64], dtype = _metaDataDtype)['pixelDataFormatCode'][0])
+        with ParallelDecoder(numberOfProcesses, chunkSize = chunkSize) as decoder:
+            with decoder.decodeFrames(self.fileName, self.index['offset'], int(self.index['length'][0]), pixelDataFormatCode) as decoded:
+                return decoded.toArrays()
@@ -0,0 +1,134 @@
+"""
+Dark subtraction, nonlinearity and gain correction and resampling onto a wavelength grid, for
+a whole chunk of spectra at once.
+
+    correction = spectrometer.correctionPipeline(np.arange(400.0, 900.0, 0.5), dark = darkSpectrum)
+    headers, spectra = spectrometer.burst(10000, dtype = np.uint16)
+    corrected = correction.apply(spectra)
+
+The same pipeline can correct the blocks of iterSpectra() or readAvailable(); pass out to
+write into a buffer of your own.
+"""
+import numpy as np
+
+
+class CorrectionPipeline(object):
+    """
+    Corrects spectra with shape (number of spectra, pixels), or a single spectrum, in this order:
+
+    dark: subtracted, one value per pixel.
+    nonlinearity: polynomial coefficients c0, c1, ... as in the Ocean calibration, the counts
+        are divided by c0 + c1 counts + c2 counts**2 + ...
+    gain: multiplied with, one value per pixel.
+    targetWavelengths: the spectra are linearly interpolated from wavelengths onto these,
+        like np.interp, and clamped to the first and last pixel outside of wavelengths.
+
+    The resampling is a sparse matrix with two weights per row. It is stored as the index of the
+    pixel left of every target wavelength and the weight of the pixel right of it, computed
+    once, and applied to all spectra of a chunk with two gathers.
+    """
+    blockSize = 32
+
+    def __init__(self, wavelengths, targetWavelengths = None, dark = None, nonlinearity = None, gain = None):
+        self.wavelengths = np.asarray(wavelengths, dtype = np.float64)
+        self.dark = None if dark is None else np.asarray(dark, dtype = np.float64)
+        self.nonlinearity = None if nonlinearity is None else np.asarray(nonlinearity, dtype = np.float64)
+        self.gain = None if gain is None else np.asarray(gain, dtype = np.float64)
+        self._buffers = {}
+        self.setTargetWavelengths(targetWavelengths)
+
+    def setTargetWavelengths(self, targetWavelengths):
+        """
+        Computes the resampling onto targetWavelengths, or switches it off with None.
+        """
+        self.targetWavelengths = None
+        self._leftPixels = None
+        self._rightPixels = None
+        self._rightWeights = None
+        if(targetWavelengths is None):
+            return
+        if(np.any(np.diff(self.wavelengths) <= 0)):
+            raise ValueError('The wavelengths have to increase to resample.')
+        self.targetWavelengths = np.asarray(targetWavelengths, dtype = np.float64)
+        leftPixels = np.searchsorted(self.wavelengths, self.targetWavelengths, side = 'right') - 1
+        leftPixels = np.clip(leftPixels, 0, len(self.wavelengths) - 2)
+        left = self.wavelengths[leftPixels]
+        right = self.wavelengths[leftPixels + 1]
+        self._leftPixels = leftPixels
+        self._rightPixels = leftPixels + 1
+        self._rightWeights = np.clip((self.targetWavelengths - left) / (right - left), 0.0, 1.0)
+
+    def outputWavelengths(self):
+        if(self.targetWavelengths is None):
+            return self.wavelengths
+        return self.targetWavelengths
+
+    def _buffer(self, name, numberOfColumns):
+        """
+        A float64 scratch array of blockSize rows, reused for every block.
+        """
+        buffer = self._buffers.get(name)
+        if(buffer is None or buffer.shape[1] != numberOfColumns):
+            buffer = np.empty((self.blockSize, numberOfColumns))
+            self._buffers[name] = buffer
+        return buffer
+
+    def apply(self, spectra, out = None):
+        """
+        Returns the corrected spectra as float64. out is a float64 array for the result, with
+        as many columns as outputWavelengths(). Without resampling out can be spectra itself,
+        if that is float64, to correct in place.
+        """
+        spectra = np.asarray(spectra)
+        single = spectra.ndim == 1
+        if(single):
+            spectra = spectra[None, :]
+            if(out is not None):
+                out = out[None, :]
+        outputShape = (len(spectra), len(self.outputWavelengths()))
+        if(out is None):
+            out = np.empty(outputShape)
+        elif(out.shape != outputShape):
+            raise ValueError('out has shape {}, expected {}.'.format(out.shape, outputShape))
+
+        # Block by block, so the scratch arrays stay in the cache.
+        for start in range(0, len(spectra), self.blockSize):
+            end = min(start + self.blockSize, len(spectra))
+            self._applyBlock(spectra[start:end], out[start:end])
+
+        if(single):
+            return out[0]
+        return out
+
+    def _applyBlock(self, spectra, out):
+        numberOfSpectra = len(spectra)
+        if(self.targetWavelengths is None):
+            work = out
+        else:
+            work = self._buffer('work', spectra.shape[1])[:numberOfSpectra]
+
+        if(self.dark is not None):
+            np.subtract(spectra, self.dark, out = work)
+        elif(work is not spectra):
+            np.copyto(work, spectra)
+
+        if(self.nonlinearity is not None):
+            # Horner's scheme for the polynomial, in one scratch array.
+            polynomial = self._buffer('polynomial', spectra.shape[1])[:numberOfSpectra]
+            polynomial.fill(self.nonlinearity[-1])
+            for coefficient in self.nonlinearity[-2::-1]:
+                polynomial *= work
+                polynomial += coefficient
+            work /= polynomial
+
+        if(self.gain is not None):
+            work *= self.gain
+
+        if(self.targetWavelengths is not None):
+            # mode 'clip' does not buffer out, the indices are in range anyway.
+            right = self._buffer('right', out.shape[1])[:numberOfSpectra]
+            np.take(work, self._leftPixels, axis = 1, out = out, mode = 'clip')
+            np.take(work, self._rightPixels, axis = 1, out = right, mode = 'clip')
+            right -= out
+            right *= self._rightWeights
+            out += right
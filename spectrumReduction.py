@@ -0,0 +1,167 @@
+"""
+Reduces spectra while they are acquired, so the frames do not have to be kept.
+
+    reduction = StreamingReduction(coAdd = 100, timeBin = 10000)
+    spectrometer.reducedBurst(1000000, reduction)
+    reduction.mean, reduction.standardDeviation, reduction.coAdded
+
+update() takes every chunk as it is decoded, in the dtype of the spectrometer (uint16 for the
+FX), and reduces it with a few array operations. Sums are accumulated in int64 for integer
+spectra, float64 otherwise, so they do not overflow. The mean, variance and envelope take memory
+for one spectrum each, however long the run is. The co-added spectra and time bins add one
+spectrum every coAdd spectra or timeBin us.
+"""
+import numpy as np
+
+
+def _accumulatorDtype(dtype):
+    if(np.issubdtype(dtype, np.integer)):
+        return np.int64
+    return np.float64
+
+
+class StreamingReduction(object):
+    """
+    Running mean and variance per pixel, combined per chunk as in Welford's algorithm, and
+    the minimum and maximum per pixel. With coAdd, every coAdd consecutive spectra are summed
+    into one. With timeBin, the spectra are averaged in bins of timeBin us of the time stamps.
+    """
+
+    def __init__(self, coAdd = None, timeBin = None):
+        self.coAdd = coAdd
+        self.timeBin = timeBin
+        self.numberOfSpectra = 0
+        self._mean = None
+        self._m2 = None # sum of squared differences from the mean
+        self.minimum = None
+        self.maximum = None
+
+        self._coAdded = []
+        self._coAddSum = None
+        self._coAddCount = 0
+
+        self._timeBinStart = None # time stamp of the first spectrum, us
+        self._timeBins = [] # (bin, sum, count) of the bins that are complete
+        self._currentBin = None
+        self._binSum = None
+        self._binCount = 0
+
+    def update(self, headers, spectra):
+        """
+        Adds a chunk of spectra, with shape (number of spectra, pixels), and their headers.
+        The headers are only used for the time bins.
+        """
+        numberOfSpectra = len(spectra)
+        if(numberOfSpectra == 0):
+            return
+        accumulatorDtype = _accumulatorDtype(spectra.dtype)
+
+        if(self._mean is None):
+            self._mean = np.zeros(spectra.shape[1])
+            self._m2 = np.zeros(spectra.shape[1])
+            self.minimum = spectra.min(axis = 0)
+            self.maximum = spectra.max(axis = 0)
+        else:
+            np.minimum(self.minimum, spectra.min(axis = 0), out = self.minimum)
+            np.maximum(self.maximum, spectra.max(axis = 0), out = self.maximum)
+
+        # Mean and squared differences of the chunk, merged with those of the spectra before.
+        chunkMean = spectra.sum(axis = 0, dtype = accumulatorDtype) / numberOfSpectra
+        differences = spectra - chunkMean
+        chunkM2 = np.einsum('ij,ij->j', differences, differences)
+        total = self.numberOfSpectra + numberOfSpectra
+        delta = chunkMean - self._mean
+        self._mean += delta * (numberOfSpectra / total)
+        self._m2 += chunkM2 + delta**2 * (self.numberOfSpectra * numberOfSpectra / total)
+        self.numberOfSpectra = total
+
+        if(self.coAdd is not None):
+            self._updateCoAdded(spectra, accumulatorDtype)
+        if(self.timeBin is not None):
+            self._updateTimeBins(headers['timeStamp'], spectra, accumulatorDtype)
+
+    def _updateCoAdded(self, spectra, accumulatorDtype):
+        if(self._coAddSum is None):
+            self._coAddSum = np.zeros(spectra.shape[1], dtype = accumulatorDtype)
+
+        # Fill up the block that was started in an earlier chunk.
+        first = min(len(spectra), self.coAdd - self._coAddCount)
+        self._coAddSum += spectra[:first].sum(axis = 0, dtype = accumulatorDtype)
+        self._coAddCount += first
+        if(self._coAddCount < self.coAdd):
+            return
+        self._coAdded.append(self._coAddSum.copy())
+
+        numberOfBlocks = (len(spectra) - first) // self.coAdd
+        end = first + numberOfBlocks * self.coAdd
+        if(numberOfBlocks > 0):
+            blocks = spectra[first:end].reshape(numberOfBlocks, self.coAdd, spectra.shape[1])
+            self._coAdded.extend(blocks.sum(axis = 1, dtype = accumulatorDtype))
+        self._coAddSum[:] = spectra[end:].sum(axis = 0, dtype = accumulatorDtype)
+        self._coAddCount = len(spectra) - end
+
+    def _updateTimeBins(self, timeStamps, spectra, accumulatorDtype):
+        timeStamps = timeStamps.astype(np.int64)
+        if(self._timeBinStart is None):
+            self._timeBinStart = int(timeStamps[0])
+        bins = (timeStamps - self._timeBinStart) // self.timeBin
+
+        # The time stamps increase, so each bin is one run of spectra in the chunk.
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+        sums = np.add.reduceat(spectra, starts, axis = 0, dtype = accumulatorDtype)
+        counts = np.diff(np.append(starts, len(bins)))
+        for timeBin, binSum, count in zip(bins[starts], sums, counts):
+            if(timeBin != self._currentBin):
+                if(self._currentBin is not None):
+                    self._timeBins.append((self._currentBin, self._binSum, self._binCount))
+                self._currentBin = int(timeBin)
+                self._binSum = binSum
+                self._binCount = 0
+            else:
+                self._binSum += binSum
+            self._binCount += int(count)
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def variance(self):
+        """
+        Sample variance per pixel, None for less than two spectra.
+        """
+        if(self.numberOfSpectra < 2):
+            return None
+        return self._m2 / (self.numberOfSpectra - 1)
+
+    @property
+    def standardDeviation(self):
+        variance = self.variance
+        if(variance is None):
+            return None
+        return np.sqrt(variance)
+
+    @property
+    def coAdded(self):
+        """
+        The sums of every coAdd spectra, as an array with shape (number of blocks, pixels).
+        The last coAdd - 1 spectra at most are not in a block yet.
+        """
+        if(len(self._coAdded) == 0):
+            return np.zeros((0, 0 if self._mean is None else len(self._mean)))
+        return np.array(self._coAdded)
+
+    def timeBins(self):
+        """
+        Returns the start times of the bins in us from the first spectrum, the mean spectrum
+        of every bin and the number of spectra in every bin. The last bin can still grow.
+        """
+        timeBins = list(self._timeBins)
+        if(self._currentBin is not None):
+            timeBins.append((self._currentBin, self._binSum, self._binCount))
+        if(len(timeBins) == 0):
+            return np.zeros(0, dtype = np.int64), np.zeros((0, 0)), np.zeros(0, dtype = np.int64)
+        startTimes = np.array([timeBin for timeBin, binSum, count in timeBins], dtype = np.int64) * self.timeBin
+        counts = np.array([count for timeBin, binSum, count in timeBins], dtype = np.int64)
+        means = np.array([binSum for timeBin, binSum, count in timeBins]) / counts[:, None]
+        return startTimes, means, counts
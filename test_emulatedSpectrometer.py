@@ -0,0 +1,221 @@
+"""
+Regression tests of the acquisition logic, against an EmulatedOBPDevice instead of a spectrometer.
+
+    python -m pytest test_emulatedSpectrometer.py
+"""
+import time
+import threading
+import numpy as np
+import pytest
+
+from pyUSBSpectrometer import PyUSBSpectrometer, _TriggerGrouper, _ClockOffset, spectrumHeaderDtype
+from emulatedSpectrometer import EmulatedOBPDevice
+from parallelDecoding import ParallelDecoder
+
+
+# pixelDataFormatCode: dtype of the decoded spectra.
+nativeDtypes = {1 : np.uint16, 2 : np.uint32, 3 : np.uint32, 4 : np.float32}
+
+
+def openEmulated(pixelDataFormatCode = 1, **kwargs):
+    device = EmulatedOBPDevice(numberOfPixels = 256, integrationTime = 10, pixelDataFormatCode = pixelDataFormatCode, **kwargs)
+    return device, PyUSBSpectrometer(device = device, fastOpen = True, calibrationCache = None)
+
+
+def expectedSpectra(device, headers):
+    """
+    The spectra the emulator sends for these headers: its base spectrum plus spectrumIndex % 256.
+    """
+    indices = headers['spectrumIndex'].astype(np.int64)
+    return device._baseSpectrum[np.newaxis, :] + (indices % 256)[:, np.newaxis]
+
+
+def checkContiguous(device, headers, spectra):
+    assert np.all(np.diff(headers['spectrumIndex'].astype(np.int64)) == 1)
+    assert np.array_equal(spectra, expectedSpectra(device, headers).astype(spectra.dtype))
+
+
+def getSpectraReplies(spectrometer, numbersOfSpectra):
+    """
+    Raw getSpectra replies, with the OBP header, as the spectrometer sends them.
+    """
+    spectrometer._startBuffering(1000)
+    spectrometer.softwareTrigger()
+    time.sleep(0.05)
+    return [bytes(spectrometer._query('getSpectra', message = n)) for n in numbersOfSpectra]
+
+
+@pytest.mark.parametrize('pixelDataFormatCode', [1, 2, 3, 4])
+def test_decodingIsEquivalent(pixelDataFormatCode):
+    device, spectrometer = openEmulated(pixelDataFormatCode)
+    replies = getSpectraReplies(spectrometer, [4, 7])
+
+    body = memoryview(replies[0])[44:-24]
+    metaData, spectra = PyUSBSpectrometer.decodeRawSpectra(body)
+    oneByOneMetaData, oneByOneSpectra = PyUSBSpectrometer._decodeRawSpectraOneByOne(body)
+    assert spectra.dtype == nativeDtypes[pixelDataFormatCode]
+    assert np.array_equal(metaData, oneByOneMetaData)
+    assert np.array_equal(spectra, np.array(oneByOneSpectra))
+    headers = PyUSBSpectrometer._headerRecordsFromMetaData(metaData)
+    assert np.array_equal(spectra, expectedSpectra(device, headers).astype(spectra.dtype))
+
+    decoded = [spectrometer._processRawSpectalData(reply, asRecords = True) for reply in replies]
+    with ParallelDecoder(2, useThreads = True, chunkSize = 3) as decoder:
+        with decoder.decodeStream(b''.join(replies)) as shared:
+            assert np.array_equal(shared.headers, np.concatenate([headers for headers, spectra in decoded]))
+            assert np.array_equal(shared.spectra, np.concatenate([spectra for headers, spectra in decoded]))
+
+
+@pytest.mark.parametrize('pixelDataFormatCode', [3, 4])
+def test_nativeDtypeOfFirstAcquisition(pixelDataFormatCode):
+    # Values above 65535 show when U32 spectra are wrapped into uint16.
+    device, spectrometer = openEmulated(pixelDataFormatCode)
+    device._baseSpectrum = device._baseSpectrum + 100000
+    headers, spectra = spectrometer.burst(500, dtype = None)
+    assert spectra.dtype == nativeDtypes[pixelDataFormatCode]
+    checkContiguous(device, headers, spectra)
+
+    device, spectrometer = openEmulated(pixelDataFormatCode)
+    device._baseSpectrum = device._baseSpectrum + 100000
+    for headers, spectra in spectrometer.iterSpectra(100, numberOfSpectra = 300, dtype = None):
+        assert spectra.dtype == nativeDtypes[pixelDataFormatCode]
+        checkContiguous(device, headers, spectra)
+
+    device, spectrometer = openEmulated(pixelDataFormatCode)
+    device._baseSpectrum = device._baseSpectrum + 100000
+    spectrometer.startAcquisition(dtype = None)
+    time.sleep(0.2)
+    spectrometer.stopAcquisition()
+    headers, spectra = spectrometer.readAvailable()
+    assert len(headers) > 0
+    assert spectra.dtype == nativeDtypes[pixelDataFormatCode]
+    checkContiguous(device, headers, spectra)
+
+
+@pytest.mark.parametrize('requestsInFlight', [1, 3])
+def test_burstAfterErrorReply(requestsInFlight):
+    device, spectrometer = openEmulated()
+    spectrometer.requestsInFlight = requestsInFlight
+    device.failNext('getSpectra', 7)
+    headers, spectra = spectrometer.burst(2000, dtype = None)
+    assert len(headers) == 2000
+    checkContiguous(device, headers, spectra)
+
+
+def test_iterSpectraAfterErrorReply():
+    device, spectrometer = openEmulated()
+    blocks = []
+    for i, (headers, spectra) in enumerate(spectrometer.iterSpectra(100, numberOfSpectra = 1000, dtype = None)):
+        if(i == 2):
+            device.failNext('getSpectra', 7)
+        blocks.append((headers.copy(), spectra.copy()))
+    headers = np.concatenate([headers for headers, spectra in blocks])
+    spectra = np.concatenate([spectra for headers, spectra in blocks])
+    assert len(headers) == 1000
+    checkContiguous(device, headers, spectra)
+
+
+def test_startAcquisitionAfterErrorReply():
+    device, spectrometer = openEmulated()
+    spectrometer.startAcquisition(dtype = None)
+    time.sleep(0.1)
+    device.failNext('getSpectra', 7)
+    time.sleep(0.1)
+    assert spectrometer._acquisitionThread.is_alive()
+    spectrometer.stopAcquisition()
+    headers, spectra = spectrometer.readAvailable()
+    assert len(headers) > 0
+    checkContiguous(device, headers, spectra)
+
+
+def test_emptyReplyDecodesToEmptySpectra():
+    metaData, spectra = PyUSBSpectrometer.decodeRawSpectra(b'', numberOfPixels = 256)
+    assert len(metaData) == 0
+    assert spectra.shape == (0, 256)
+
+
+def test_queryDuringPipelinedAcquisition():
+    # The pipeline holds the USB lock while requests are in flight, and has to let other commands in.
+    device = EmulatedOBPDevice(numberOfPixels = 2136, integrationTime = 10, usbLatency = 0.001)
+    spectrometer = PyUSBSpectrometer(device = device, fastOpen = True, calibrationCache = None)
+    spectrometer.requestsInFlight = 4
+    spectrometer.startAcquisition(dtype = None)
+    waits = []
+    blocks = []
+    for i in range(50):
+        startTime = time.perf_counter()
+        spectrometer._query('getNumberInBuffer')
+        waits.append(time.perf_counter() - startTime)
+        headers, spectra = spectrometer.readAvailable()
+        if(len(headers) > 0):
+            blocks.append((headers.copy(), spectra.copy()))
+        time.sleep(0.005)
+    assert spectrometer._acquisitionThread.is_alive()
+    spectrometer.stopAcquisition()
+    assert max(waits) < 0.2
+    checkContiguous(device, np.concatenate([headers for headers, spectra in blocks]),
+                    np.concatenate([spectra for headers, spectra in blocks]))
+
+
+def test_pollBackoffWhileNoTrigger():
+    grouper = _TriggerGrouper(1, _ClockOffset())
+    headers = np.zeros(1, dtype = spectrumHeaderDtype)
+    headers['integrationTime'] = 10
+    assert len(grouper.add(headers, np.zeros((1, 256)))) == 1
+    first = grouper.pollInterval()
+    assert first == 1e-4
+    intervals = []
+    for i in range(20):
+        grouper.add(np.zeros(0, dtype = spectrumHeaderDtype), np.empty((0, 256)))
+        intervals.append(grouper.pollInterval())
+    assert intervals[0] == first
+    assert all(a <= b for a, b in zip(intervals, intervals[1:]))
+    assert intervals[-1] == 0.01
+    headers['spectrumIndex'] = 1
+    headers['timeStamp'] = 1000000
+    grouper.add(headers, np.zeros((1, 256)))
+    assert grouper.pollInterval() == first
+
+
+def test_recordBurstStoppedEarly(tmp_path):
+    device, spectrometer = openEmulated(pixelDataFormatCode = 3)
+    device._baseSpectrum = device._baseSpectrum + 100000
+    fileName = str(tmp_path / 'burst.npy')
+    timer = threading.Timer(0.2, spectrometer.stopAcquisition)
+    timer.start()
+    acquiredSpectra = spectrometer.recordBurst(fileName, 200000)
+    timer.join()
+    assert 0 < acquiredSpectra < 200000
+    spectra = np.load(fileName, mmap_mode = 'r')
+    headers = np.load(str(tmp_path / 'burst.headers.npy'), mmap_mode = 'r')
+    assert len(spectra) == len(headers) == acquiredSpectra
+    assert spectra.dtype == np.uint32
+    checkContiguous(device, headers, spectra)
+    assert not device.buffering
+
+
+def test_iterSpectraSwitchesBufferingOff():
+    device, spectrometer = openEmulated()
+    blocks = spectrometer.iterSpectra(100, dtype = None)
+    for headers, spectra in blocks:
+        assert device.buffering
+        break
+    blocks.close()
+    assert not device.buffering
+    assert spectrometer.getNumberInBuffer() == 0
+
+
+def test_calibrationCacheRoundTrip(tmp_path, capsys):
+    device, spectrometer = openEmulated()
+    spectrometer._saveCalibration(str(tmp_path))
+    capsys.readouterr()
+    cached = PyUSBSpectrometer(device = EmulatedOBPDevice(numberOfPixels = 256, integrationTime = 10), 
+                               fastOpen = True, calibrationCache = str(tmp_path))
+    assert 'No cached calibration' not in capsys.readouterr().out
+    assert np.array_equal(cached.wavelengths(), spectrometer.wavelengths())
+    
+    # The same serial number with another number of pixels.
+    other = PyUSBSpectrometer(device = EmulatedOBPDevice(numberOfPixels = 512, integrationTime = 10), 
+                              fastOpen = True, calibrationCache = str(tmp_path))
+    assert 'not using it' in capsys.readouterr().out
+    assert len(other.wavelengths()) == 512